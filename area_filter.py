@@ -0,0 +1,60 @@
+import threading
+# shapely is only needed to filter the posts by the polygons of the GeoJSON areas
+try:
+    import shapely
+    from shapely.geometry import shape
+except ImportError:
+    shapely = None
+    shape = None
+
+
+def coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class AreaFilter:
+    '''
+    Exact area (Polygon or MultiPolygon with holes) of a GeoJSON feature. The bbox queries of the area return
+    every post of the envelope, filter_page removes the posts outside the polygons from a result page before it
+    reaches the metadata output and the image downloads.
+
+    The geometry is prepared once, the posts of a page are tested vectorised (shapely >= 2.0).
+    The filter is shared by all queries (and threads) of the area.
+    '''
+    def __init__(self, geometry):
+        '''
+        :param geometry: GeoJSON geometry of the feature
+        '''
+        self.geometry = shape(geometry)
+        shapely.prepare(self.geometry)
+        self.lock = threading.Lock()
+        # posts tested and removed by filter_page
+        self.posts_tested = 0
+        self.posts_removed = 0
+
+    @staticmethod
+    def available():
+        # the shapely 2.0 api is used (prepare, vectorised functions)
+        return shapely is not None and int(shapely.__version__.split('.')[0]) >= 2
+
+    def filter_page(self, page_result):
+        '''
+        :return: copy of the result page with the posts inside the polygons only (posts on the boundary are kept)
+        '''
+        posts = page_result['photos']['photo']
+        if not posts:
+            return page_result
+        inside = shapely.intersects_xy(self.geometry,
+                                       [coordinate(post.get('longitude')) for post in posts],
+                                       [coordinate(post.get('latitude')) for post in posts])
+        kept = [post for post, post_inside in zip(posts, inside) if post_inside]
+        with self.lock:
+            self.posts_tested += len(posts)
+            self.posts_removed += len(posts) - len(kept)
+        filtered = dict(page_result)
+        filtered['photos'] = dict(page_result['photos'])
+        filtered['photos']['photo'] = kept
+        return filtered
@@ -0,0 +1,141 @@
+import math
+import heapq
+# shapely is only needed for covers of more than one bounding box
+try:
+    import shapely
+    from shapely.geometry import shape, box
+except ImportError:
+    shapely = None
+    shape = None
+    box = None
+
+# candidate cut positions (fraction of the width and height) tested when a box of the cover is split
+cut_fractions = (0.25, 0.5, 0.75)
+
+
+def geometry_coordinates(coordinates):
+    '''
+    Yield all positions of GeoJSON coordinates (Polygon rings or MultiPolygon polygons)
+    '''
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return None
+    for element in coordinates:
+        yield from geometry_coordinates(element)
+
+
+def envelope(geometry):
+    '''
+    Envelope of a GeoJSON geometry over all of its positions (all rings and polygons)
+
+    :return: min_x, min_y, max_x, max_y
+    '''
+    xs, ys = zip(*[(position[0], position[1]) for position in geometry_coordinates(geometry['coordinates'])])
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def outward(bounds, precision=6):
+    '''
+    Round bounds outwards to the precision of the flickr bbox, so no part of the geometry is cut off
+    '''
+    factor = 10 ** precision
+    min_x, min_y, max_x, max_y = bounds
+    return (math.floor(min_x * factor) / factor, math.floor(min_y * factor) / factor,
+            math.ceil(max_x * factor) / factor, math.ceil(max_y * factor) / factor)
+
+
+class BoxCover:
+    '''
+    Cover of a GeoJSON (Multi)Polygon by a small set of bounding boxes.
+
+    Starting from the envelope, the box with the most wasted area (area of the box outside the geometry, e.g.
+    the space between the parts of a MultiPolygon, holes or concave bays) is cut in two and both halves are
+    shrunk to the envelope of the geometry inside them. Of a few candidate cuts the one with the smallest
+    total box area is taken. Boxes are cut until max_boxes is reached or every box is filled by at least
+    min_fill of the geometry.
+
+        max_boxes: upper limit of boxes (more boxes: more queries, less posts outside the area)
+        min_fill: boxes with at least this share of their area inside the geometry are not cut further
+    '''
+    def __init__(self, geometry, max_boxes=8, min_fill=0.6):
+        self.geometry = shape(geometry)
+        if not self.geometry.is_valid:
+            self.geometry = shapely.make_valid(self.geometry)
+        shapely.prepare(self.geometry)
+        # bounds of the holes are additional cut positions, so the boxes can be cut along the holes
+        self.hole_bounds = [hole.bounds for polygon in shapely.get_parts(self.geometry) if polygon.geom_type == 'Polygon'
+                            for hole in polygon.interiors]
+        self.max_boxes = max_boxes
+        self.min_fill = min_fill
+
+    @staticmethod
+    def available():
+        # the shapely 2.0 api is used (prepare, vectorised functions)
+        return shapely is not None and int(shapely.__version__.split('.')[0]) >= 2
+
+    def part(self, bounds):
+        '''
+        :return: (bounds of the geometry inside bounds, area of the geometry inside) or None if it is empty
+        '''
+        inside = shapely.intersection(self.geometry, box(*bounds))
+        if inside.is_empty or inside.area == 0:
+            return None
+        return inside.bounds, inside.area
+
+    @staticmethod
+    def area(bounds):
+        return (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+
+    def cuts(self, bounds):
+        '''
+        Yield the halves of all candidate cuts of a box
+        '''
+        min_x, min_y, max_x, max_y = bounds
+        xs = [min_x + (max_x - min_x) * fraction for fraction in cut_fractions]
+        ys = [min_y + (max_y - min_y) * fraction for fraction in cut_fractions]
+        for hole_min_x, hole_min_y, hole_max_x, hole_max_y in self.hole_bounds:
+            xs += [x for x in (hole_min_x, hole_max_x) if min_x < x < max_x]
+            ys += [y for y in (hole_min_y, hole_max_y) if min_y < y < max_y]
+        for x in xs:
+            yield (min_x, min_y, x, max_y), (x, min_y, max_x, max_y)
+        for y in ys:
+            yield (min_x, min_y, max_x, y), (min_x, y, max_x, max_y)
+
+    def split(self, bounds):
+        '''
+        :return: the parts of the candidate cut with the smallest total box area as list of (bounds, area of the geometry inside)
+        '''
+        best = None
+        for halves in self.cuts(bounds):
+            parts = [part for part in (self.part(half) for half in halves) if part is not None]
+            total = sum(BoxCover.area(part_bounds) for part_bounds, inside_area in parts)
+            # on equal total area the cut which separates the best filled part wins (e.g. a side of a hole)
+            best_fill = max(inside_area / max(BoxCover.area(part_bounds), 1e-18) for part_bounds, inside_area in parts)
+            if best is None or (total, -best_fill) < best[0]:
+                best = ((total, -best_fill), parts)
+        return best[1]
+
+    def boxes(self):
+        '''
+        :return: list of (min_x, min_y, max_x, max_y) covering the geometry
+        '''
+        if self.geometry.is_empty:
+            return []
+        if self.geometry.area == 0:
+            # lines or points can not be covered more tightly than by their envelope
+            return [outward(self.geometry.bounds)]
+        bounds = self.geometry.bounds
+        # max heap of the wasted area: (-waste, index, bounds, area of the geometry inside)
+        heap = [(-(BoxCover.area(bounds) - self.geometry.area), 0, bounds, self.geometry.area)]
+        final = []
+        index = 1
+        while heap and len(heap) + len(final) < self.max_boxes:
+            waste, _, bounds, inside_area = heapq.heappop(heap)
+            box_area = BoxCover.area(bounds)
+            if box_area == 0 or inside_area / box_area >= self.min_fill:
+                final.append(bounds)
+                continue
+            for part_bounds, part_area in self.split(bounds):
+                heapq.heappush(heap, (-(BoxCover.area(part_bounds) - part_area), index, part_bounds, part_area))
+                index += 1
+        return [outward(bounds) for bounds in final + [bounds for waste, _, bounds, inside_area in heap]]
@@ -0,0 +1,253 @@
+'''
+End-to-end benchmark of FlickrFrame harvests against the local mock Flickr API (mock_flickr_server.py).
+
+Every scenario harvests the whole area of the synthetic posts in a fresh child process (so peak RSS is measured per
+harvest) and reports:
+    calls/post: photos.search calls (result pages and count probes) per harvested post
+    posts/s, images/s: harvested posts and downloaded images per second of the total time
+    completeness: harvested unique posts / posts matching the query on the server
+    peak RSS, total time and the wall time of the stages search, split, write and download
+    (the stages overlap: split includes the searches of the subqueries and threads may run concurrently)
+The posts, the server and the scenarios are deterministic, so results of two runs can be compared to spot
+regressions: --json saves the results, --baseline compares them against a saved run.
+The project folders are created in a temporary workspace which is removed at the end (also if the run is interrupted).
+
+usage: python benchmarks/bench_harvest.py [--posts 20000] [--scenarios time,space,hybrid,planned,streaming,images]
+                                          [--json results.json] [--baseline results.json]
+'''
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import threading
+import functools
+import contextlib
+import subprocess
+import urllib.request
+import multiprocessing
+from queue import Empty
+BENCHMARK_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, REPO_PATH)
+
+
+# FlickrFrame arguments of the scenarios (the bbox of the synthetic posts is added by the benchmark)
+SCENARIOS = {'time': {'split_strategy': 'time'},
+             'space': {'split_strategy': 'space'},
+             'hybrid': {'split_strategy': 'hybrid'},
+             'planned': {'split_strategy': 'hybrid', 'plan_queries': True},
+             'streaming': {'split_strategy': 'hybrid', 'streaming': True},
+             'images': {'split_strategy': 'hybrid', 'streaming': True, 'toget_images': True, 'image_size': 'small'}}
+STAGES = ['search', 'split', 'write', 'download']
+
+
+class StageTimer:
+    '''
+    Wall time of a stage over all threads: the time during which at least one call of the stage was running
+    (nested and concurrent calls are counted once)
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.started = None
+        self.seconds = 0.0
+
+    def wrap(self, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with self.lock:
+                if self.active == 0:
+                    self.started = time.perf_counter()
+                self.active += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    if self.active == 0:
+                        self.seconds += time.perf_counter() - self.started
+        return timed
+
+
+def server_stats(server_url):
+    with urllib.request.urlopen(f'{server_url}/stats') as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def count_posts(project_path):
+    '''
+    :return: amount of unique posts in the metadata outputs of the project
+    '''
+    import pandas as pd
+    import sqlite3
+    ids = set()
+    for path in glob.glob(os.path.join(project_path, 'metadata_*')):
+        if path.endswith('.sqlite'):
+            connection = sqlite3.connect(path)
+            table = connection.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name").fetchone()[0]
+            ids.update(str(row[0]) for row in connection.execute(f'SELECT photo_id FROM "{table}"'))
+            connection.close()
+        elif path.endswith('.parquet'):
+            ids.update(pd.read_parquet(path, columns=['photo_id'])['photo_id'].astype(str))
+        else:
+            ids.update(pd.read_csv(path, sep=';', usecols=['photo_id'], dtype=str)['photo_id'])
+    return len(ids)
+
+
+def harvest(scenario, server_url, creds_path, bbox, queue):
+    '''
+    Run one harvest of a scenario (in a child process) and put its measurements into the queue
+    '''
+    import flickrapi
+    flickrapi.FlickrAPI.REST_URL = f'{server_url}/services/rest/'
+    from flickr_framework import FlickrFrame
+    from query_flickr_api_improved import FlickrQuerier
+    from metadata_writer import MetadataStream
+
+    timers = {stage: StageTimer() for stage in STAGES}
+    FlickrQuerier.search_page = timers['search'].wrap(FlickrQuerier.search_page)
+    FlickrFrame.high_data_volume_handler = timers['split'].wrap(FlickrFrame.high_data_volume_handler)
+    FlickrQuerier.write_info = timers['write'].wrap(FlickrQuerier.write_info)
+    MetadataStream.write_page = timers['write'].wrap(MetadataStream.write_page)
+    FlickrQuerier.run_download_tasks = timers['download'].wrap(FlickrQuerier.run_download_tasks)
+
+    # the credentials file lies in the temporary workspace, the api log file is written to the working directory
+    workspace_path = os.path.dirname(creds_path)
+    os.chdir(workspace_path)
+    project_name = f'bench_harvest_{scenario}_{os.getpid()}'
+    project_path = os.path.join(workspace_path, project_name)
+    arguments = {'bbox': bbox, 'toget_images': False, 'resume': False, 'workspace_path': workspace_path,
+                 'calls_per_hour': 10 ** 9, 'burst': 10 ** 6}
+    arguments.update(SCENARIOS[scenario])
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            FlickrFrame(project_name, creds_path, **arguments)
+        total = time.perf_counter() - start
+        image_path = os.path.join(project_path, f'images_{project_name}')
+        images = len(glob.glob(os.path.join(image_path, '*.jpg')))
+        posts = count_posts(project_path)
+    finally:
+        shutil.rmtree(project_path, ignore_errors=True)
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put({'posts_harvested': posts, 'images': images, 'total_s': total, 'peak_rss_mb': peak_rss,
+               'stages_s': {stage: timer.seconds for stage, timer in timers.items()}})
+
+
+def run_scenario(scenario, server_url, creds_path, bbox, expected_posts):
+    before = server_stats(server_url)
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=harvest, args=(scenario, server_url, creds_path, bbox, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"Harvest of scenario '{scenario}' failed (exit code {process.exitcode})")
+    process.join()
+    after = server_stats(server_url)
+    calls = (after['search_calls'] - before['search_calls']) + (after['probe_calls'] - before['probe_calls'])
+    result.update({'scenario': scenario,
+                   'api_calls': calls,
+                   'calls_per_post': calls / max(1, result['posts_harvested']),
+                   'posts_per_s': result['posts_harvested'] / result['total_s'],
+                   'images_per_s': result['images'] / result['total_s'],
+                   'completeness': result['posts_harvested'] / max(1, expected_posts)})
+    return result
+
+
+def start_server(args):
+    '''
+    Start the mock server in a subprocess on a free port
+
+    :return: process, url of the server
+    '''
+    command = [sys.executable, os.path.join(BENCHMARK_PATH, 'mock_flickr_server.py'), '--port', '0',
+               '--posts', str(args.posts), '--distribution', args.distribution, '--seed', str(args.seed),
+               '--latency', str(args.latency), '--image-latency', str(args.image_latency)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if 'listening on' not in line:
+        server.kill()
+        raise RuntimeError(f'Mock server did not start: {line!r}')
+    return server, line.split('listening on ')[1].strip().rsplit('/services/rest/', 1)[0]
+
+
+def print_results(results, baseline=None):
+    print('--' * 30)
+    header = f"{'scenario':<10} {'calls':>6} {'calls/post':>10} {'posts/s':>9} {'images/s':>9} {'complete':>8} {'RSS MB':>7} {'total s':>8}  " + \
+             ' '.join(f'{stage:>8}' for stage in STAGES)
+    print(header)
+    for result in results:
+        print(f"{result['scenario']:<10} {result['api_calls']:>6} {result['calls_per_post']:>10.4f} {result['posts_per_s']:>9.0f} "
+              f"{result['images_per_s']:>9.0f} {result['completeness']:>8.1%} {result['peak_rss_mb']:>7.0f} {result['total_s']:>8.2f}  " +
+              ' '.join(f"{result['stages_s'][stage]:>8.2f}" for stage in STAGES))
+    if baseline is None:
+        return None
+    print('--' * 30)
+    print('change against the baseline (time and RSS: lower is better, calls: fewer is better)')
+    baseline = {result['scenario']: result for result in baseline['results']}
+    for result in results:
+        if result['scenario'] not in baseline:
+            continue
+        base = baseline[result['scenario']]
+        changes = []
+        for key in ['api_calls', 'total_s', 'peak_rss_mb', 'completeness']:
+            change = (result[key] - base[key]) / base[key] if base[key] else 0.0
+            changes.append(f'{key} {change:+.1%}')
+        print(f"{result['scenario']:<10} " + ', '.join(changes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=20000, help='amount of synthetic posts served by the mock server')
+    parser.add_argument('--distribution', default='hotspots', choices=['uniform', 'hotspots'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every search call by the server')
+    parser.add_argument('--image-latency', type=float, default=0.0, help='seconds added to every image request by the server')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare the results with a file saved by --json')
+    args = parser.parse_args()
+
+    from mock_flickr_server import BBOX, SyntheticPosts
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios {unknown}. Choose from {list(SCENARIOS)}.")
+        sys.exit(1)
+    bbox = [','.join(f'{coordinate:.6f}' for coordinate in BBOX)]
+    expected_posts = len(SyntheticPosts(args.posts, args.distribution, args.seed).matches({'bbox': bbox[0]}))
+
+    server, server_url = start_server(args)
+    workspace_path = tempfile.mkdtemp(prefix='bench_harvest_')
+    creds_path = os.path.join(workspace_path, 'FLICKR_API_KEY.txt')
+    results = []
+    try:
+        with open(creds_path, 'w') as f:
+            f.write('<KEY>\nbenchmarkkey\n<SECRET>\nbenchmarksecret\n')
+        for scenario in scenarios:
+            print(f"[*] Harvesting scenario '{scenario}'...")
+            results.append(run_scenario(scenario, server_url, creds_path, bbox, expected_posts))
+    finally:
+        server.kill()
+        shutil.rmtree(workspace_path, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'posts': args.posts, 'distribution': args.distribution, 'seed': args.seed, 'results': results}, f, indent=2)
+        print(f"[*] Saved results to {args.json}")
@@ -0,0 +1,267 @@
+'''
+Benchmark of the metadata CSV serialisation (write_info).
+
+Compares rows/sec of the previous write_info implementation (kept below as legacy_write_info) with the
+CSVMetadataWriter on a synthetic corpus of photos.search result pages.
+
+usage: python benchmarks/bench_write_info.py [--pages 400] [--repeat 3]
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from metadata_writer import CSVMetadataWriter
+
+
+WORDS = ['red', 'kite', 'rotmilan', 'bird', 'zug', 'lake', 'alps', 'sunset', 'Zürich', 'café', 'naïve', '🦅', 'schön', 'see;berg']
+
+
+def synthetic_pages(pages, per_page=250, seed=0):
+    '''
+    :return: result_dict (page_N: photos.search response) with realistic field contents
+    '''
+    rng = random.Random(seed)
+    result_dict = {}
+    photo_id = 0
+    for page in range(1, pages + 1):
+        posts = []
+        for _ in range(per_page):
+            photo_id += 1
+            post = {'id': str(photo_id),
+                    'owner': f'{rng.randint(10000000, 99999999)}@N0{rng.randint(0, 9)}',
+                    'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8))),
+                    'description': {'_content': '\n'.join(' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(rng.randint(0, 6)))},
+                    'dateupload': str(rng.randint(950659200, 1600000000)),
+                    'datetaken': '2015-06-0{} 12:00:00'.format(rng.randint(1, 9)),
+                    'views': str(rng.randint(0, 5000)),
+                    'tags': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 20))),
+                    'machine_tags': '',
+                    'license': str(rng.randint(0, 10)),
+                    'latitude': str(rng.uniform(46, 48)),
+                    'longitude': str(rng.uniform(7, 9)),
+                    'accuracy': '16',
+                    'woeid': str(rng.randint(100000, 999999)),
+                    'place_id': 'abc' + str(rng.randint(0, 999)),
+                    'url_s': f'https://live.staticflickr.com/1/{photo_id}_m.jpg',
+                    'url_m': f'https://live.staticflickr.com/1/{photo_id}.jpg'}
+            if rng.random() < 0.2:
+                # posts without geo information
+                post['latitude'] = 0
+                post['longitude'] = 0
+            posts.append(post)
+        result_dict[f'page_{page}'] = {'photos': {'page': page, 'pages': pages, 'photo': posts}, 'stat': 'ok'}
+    return result_dict
+
+
+def writer_write_info(results_list, csv_output_path):
+    writer = CSVMetadataWriter(csv_output_path)
+    writer.write_results(results_list)
+    writer.close()
+
+
+def legacy_write_info(results_list, csv_output_path):
+    csv_separator = ';'  #';' #~&~#
+    tag_connector = '+'
+
+    def remove_non_ascii(s):
+        return "".join(i for i in s if ord(i) < 126 and ord(i) > 31)
+
+    def create_header(data_dict):
+        header_string = f'photo_id{csv_separator}'
+        for tracker, element in enumerate(data_dict.keys(), 1):
+            if tracker < len(data_dict.keys()):
+                header_string = header_string + str(element) + csv_separator
+            elif tracker == len(data_dict.keys()):
+                header_string = header_string + str(element)
+        return header_string
+
+    def create_line(id, data_dict):
+        line = f'{id}{csv_separator}'
+        tracker = 1
+        for key, value in data_dict.items():
+            if tracker < len(data_dict.keys()):
+                line = line + str(value) + csv_separator
+            elif tracker == len(data_dict.keys()):
+                line = line + str(value)
+            tracker += 1
+        return line
+
+    processed_ids_set = set()
+    with open(csv_output_path, 'w', encoding='utf-8') as f:
+            index = 0
+            for results in results_list:
+                for page in results:
+                    for post in results[page]['photos']['photo']:
+                        index += 1
+                        post_id = post['id']
+                        # check if this post_id was already added to the output CSV
+                        if post_id in processed_ids_set:
+                            continue
+                        else:
+                            processed_ids_set.add(post_id)
+                            '''
+                            define which info fields should be fetched.
+                            ERASE ALL STRINGS OF CSV SEPERATOR! 
+                            '''
+                            # extract tags into an string separated by '+'!
+                            try:
+                                tag_string = tag_connector.join(post['tags'].replace(csv_separator, '').replace(tag_connector, '').split(' '))
+                            except Exception as e:
+                                # print(f'\r[-] Tag parsing error: {e} ', end='')
+                                tag_string = ''
+                            try:
+                                machine_tag_string = tag_connector.join(post['machine_tags'].replace(csv_separator, '').replace(tag_connector, '').split(' '))
+                            except Exception as e:
+                                # print(f'\r[-] Tag parsing error: {e} ', end='')
+                                machine_tag_string = ''
+                            '''
+                            text clean up
+                            of title and description
+                            - remove linebreaks etc.
+                            '''
+                            try:
+                                description = remove_non_ascii(post['description']['_content'].replace(csv_separator, ''))
+                            except Exception as e:
+                                # print(f'\r[-] Description parsing error: {e} ', end='')
+                                description = ''
+                            try:
+                                title = remove_non_ascii(post['title'].replace(csv_separator, ''))
+                            except Exception as e:
+                                # print(f'\r[-] Title parsing error: {e} ', end='')
+                                title = ''
+                            try:
+                                user_nsid = post['owner']
+                            except Exception as e:
+                                # print(f'\r[-] User_nsid parsing error: {e} ', end='')
+                                user_nsid = ''
+                            try:
+                                date_uploaded = post['dateupload'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Date_uploaded parsing error: {e} ', end='')
+                                date_uploaded = ''
+                            try:
+                                date_taken = post['datetaken'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Date_taken parsing error: {e} ', end='')
+                                date_taken = ''
+                            try:
+                                views = post['views'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Views parsing error: {e} ', end='')
+                                views = ''
+                            try:
+                                license = post['license'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Views parsing error: {e} ', end='')
+                                license = ''
+                            try:
+                                img_url_s = post['url_s'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Page_URL parsing error: {e} ', end='')
+                                img_url_s = ''
+                            try:
+                                img_url_m = post['url_m'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Page_URL parsing error: {e} ', end='')
+                                img_url_m = ''
+                            try:
+                                img_url_l = post['url_l'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Page_URL parsing error: {e} ', end='')
+                                img_url_l = ''
+                            try:
+                                img_url_o = post['url_o'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Page_URL parsing error: {e} ', end='')
+                                img_url_o = ''
+                            try:
+                                lat = post['latitude'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Latitude parsing error: {e} ', end='')
+                                lat = 99999
+                            try:
+                                lng = post['longitude'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Longitude parsing error: {e} ', end='')
+                                lng = 99999
+                            try:
+                                woeid = post['woeid'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Longitude parsing error: {e} ', end='')
+                                woeid = 99999
+                            try:
+                                place_id = post['place_id'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Longitude parsing error: {e} ', end='')
+                                place_id = 99999
+                            try:
+                                accuracy = post['accuracy'].replace(csv_separator, '')
+                            except Exception as e:
+                                # print(f'\r[-] Accuracy parsing error: {e} ', end='')
+                                accuracy = ''
+                            data = {
+                                'user_nsid': user_nsid,
+                                'title': title,
+                                'description': description,
+                                'date_uploaded': date_uploaded,
+                                'date_taken': date_taken,
+                                'views': views,
+                                'user_tags':  tag_string,
+                                'machine_tags': machine_tag_string,
+                                'license': license,
+                                #location information
+                                'lat': lat,
+                                'lng': lng,
+                                'woeid': woeid,
+                                'place_id': place_id,
+                                'accuracy': accuracy,
+                                # image urls in different sizes
+                                'image_url_small': img_url_s,
+                                'image_url_medium': img_url_m,
+                                'image_url_large': img_url_l,
+                                'image_url_original': img_url_o
+                                }
+
+                            if index == 1:
+                                header = create_header(data)
+                                f.write(f"{header}\n")
+
+                            line = create_line(post_id, data)
+                            f.write(f"{line}\n")
+
+
+def measure(write, results_list, csv_output_path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        write(results_list, csv_output_path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=400, help='result pages of 250 posts in the corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per implementation, the fastest is reported')
+    args = parser.parse_args()
+
+    results_list = [synthetic_pages(args.pages)]
+    rows = args.pages * 250
+    print(f"[*] Corpus: {args.pages} pages, {rows} posts")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy = measure(legacy_write_info, results_list, os.path.join(tmp_dir, 'legacy.csv'), args.repeat)
+        with open(os.devnull, 'w') as devnull:
+            # the writer reports its progress on stdout
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                current = measure(writer_write_info, results_list, os.path.join(tmp_dir, 'writer.csv'), args.repeat)
+            finally:
+                sys.stdout = stdout
+    print("--" * 30)
+    print(f"[+] legacy write_info:  {round(rows / legacy):>10} rows/s ({round(legacy, 2)}s)")
+    print(f"[+] CSVMetadataWriter:  {round(rows / current):>10} rows/s ({round(current, 2)}s)")
+    print(f"[+] speedup: {round(legacy / current, 2)}x")
@@ -0,0 +1,169 @@
+'''
+Crash and resume check of FlickrFrame against the local mock Flickr API (mock_flickr_server.py).
+
+Every scenario harvests the area of the synthetic posts in a child process which is killed right after the
+crash_after-th finished window was checkpointed (os._exit, like a power loss nothing is flushed or closed). A second
+child process resumes the harvest from the checkpoints. The outputs of the project have to contain every post
+matching the query exactly once, otherwise the check fails (exit code 1).
+In the scenario 'cache_only' an offline run with an empty search cache precedes the crashed online run in the same
+process, the online run must not reuse the offline cache object. In the delta scenarios a finished delta harvest of
+the posts uploaded until earlier_harvest_until precedes the crashed delta harvest of the newer posts.
+The project folders are created in a temporary workspace which is removed at the end (also if the check is interrupted).
+
+usage: python benchmarks/check_resume.py [--posts 20000] [--crash-after 3]
+                                         [--scenarios collect,streaming,streaming_parquet,streaming_sqlite,cache_only,
+                                                      delta,delta_parquet]
+'''
+import os
+import sys
+import glob
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from bench_harvest import REPO_PATH, start_server
+sys.path.insert(0, REPO_PATH)
+
+
+# FlickrFrame arguments of the scenarios (the bbox of the synthetic posts is added by the check)
+SCENARIOS = {'collect': {'split_strategy': 'hybrid'},
+             'streaming': {'split_strategy': 'hybrid', 'streaming': True},
+             'streaming_parquet': {'split_strategy': 'hybrid', 'streaming': True, 'output_format': 'parquet'},
+             'streaming_sqlite': {'split_strategy': 'hybrid', 'streaming': True, 'output_format': 'sqlite'},
+             'cache_only': {'split_strategy': 'hybrid', 'offline_first': True},
+             'delta': {'split_strategy': 'hybrid', 'streaming': True, 'delta': True, 'earlier_harvest_until': 1500000000},
+             'delta_parquet': {'split_strategy': 'hybrid', 'streaming': True, 'delta': True, 'output_format': 'parquet',
+                               'earlier_harvest_until': 1500000000}}
+# exit code of the crashed harvest
+CRASH_EXIT_CODE = 3
+
+
+def read_ids(project_path):
+    '''
+    :return: list of the photo ids of all rows in the metadata outputs of the project
+    '''
+    import pandas as pd
+    ids = []
+    for path in glob.glob(os.path.join(project_path, 'metadata_*')):
+        if path.endswith('.sqlite'):
+            connection = sqlite3.connect(path)
+            ids.extend(str(row[0]) for row in connection.execute('SELECT photo_id FROM posts'))
+            connection.close()
+        elif path.endswith('.parquet'):
+            ids.extend(pd.read_parquet(path, columns=['photo_id'])['photo_id'].astype(str))
+        elif path.endswith('.csv') and os.path.getsize(path) > 0:
+            ids.extend(pd.read_csv(path, sep=';', usecols=['photo_id'], dtype=str)['photo_id'])
+    return ids
+
+
+def harvest(scenario, project_name, server_url, creds_path, bbox, crash_after):
+    '''
+    Run the harvest of a scenario (in a child process), killed after crash_after checkpointed windows (None: no crash)
+    '''
+    import flickrapi
+    flickrapi.FlickrAPI.REST_URL = f'{server_url}/services/rest/'
+    from flickr_framework import FlickrFrame
+    from checkpoint_store import CheckpointStore
+
+    # the credentials file lies in the temporary workspace, the api log file is written to the working directory
+    workspace_path = os.path.dirname(creds_path)
+    os.chdir(workspace_path)
+    arguments = {'bbox': bbox, 'toget_images': False, 'workspace_path': workspace_path, 'calls_per_hour': 10 ** 9, 'burst': 10 ** 6}
+    arguments.update(SCENARIOS[scenario])
+    offline_first = arguments.pop('offline_first', False)
+    earlier_harvest_until = arguments.pop('earlier_harvest_until', None)
+    if offline_first:
+        arguments['cache_path'] = os.path.join(workspace_path, f'{project_name}_cache.sqlite')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if crash_after is not None:
+            if offline_first:
+                # offline run without cached responses, nothing is checkpointed
+                FlickrFrame(project_name, creds_path, cache_only=True, **arguments)
+            if earlier_harvest_until is not None:
+                FlickrFrame(project_name, creds_path, max_upload_date=earlier_harvest_until, **arguments)
+            save_window = CheckpointStore.save_window
+            windows = []
+
+            def crashing_save_window(self, *args, **kwargs):
+                save_window(self, *args, **kwargs)
+                windows.append(args)
+                if len(windows) >= crash_after:
+                    os._exit(CRASH_EXIT_CODE)
+            CheckpointStore.save_window = crashing_save_window
+        FlickrFrame(project_name, creds_path, **arguments)
+
+
+def run_process(*args):
+    process = multiprocessing.get_context('spawn').Process(target=harvest, args=args)
+    process.start()
+    process.join()
+    return process.exitcode
+
+
+def check_scenario(scenario, server_url, creds_path, bbox, crash_after, expected_posts):
+    '''
+    :return: True if the resumed harvest contains every expected post exactly once
+    '''
+    project_name = f'check_resume_{scenario}_{os.getpid()}'
+    project_path = os.path.join(os.path.dirname(creds_path), project_name)
+    try:
+        exitcode = run_process(scenario, project_name, server_url, creds_path, bbox, crash_after)
+        if exitcode != CRASH_EXIT_CODE:
+            print(f"[-] {scenario}: harvest did not reach {crash_after} windows (exit code {exitcode})")
+            return False
+        exitcode = run_process(scenario, project_name, server_url, creds_path, bbox, None)
+        if exitcode != 0:
+            print(f"[-] {scenario}: resumed harvest failed (exit code {exitcode})")
+            return False
+        ids = read_ids(project_path)
+    finally:
+        shutil.rmtree(project_path, ignore_errors=True)
+    passed = len(ids) == len(set(ids)) == expected_posts
+    print(f"[{'+' if passed else '-'}] {scenario}: {len(set(ids))} unique posts in {len(ids)} rows, {expected_posts} expected")
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=20000, help='amount of synthetic posts served by the mock server')
+    parser.add_argument('--distribution', default='hotspots', choices=['uniform', 'hotspots'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--crash-after', type=int, default=3, help='checkpointed windows after which the harvest is killed')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios: ' + ', '.join(SCENARIOS))
+    args = parser.parse_args()
+    # start_server of the benchmark adds latencies to the server
+    args.latency = 0.0
+    args.image_latency = 0.0
+
+    from mock_flickr_server import BBOX, SyntheticPosts
+    from metadata_writer import ParquetMetadataWriter
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios {unknown}. Choose from {list(SCENARIOS)}.")
+        sys.exit(1)
+    if not ParquetMetadataWriter.available():
+        for scenario in [scenario for scenario in scenarios if SCENARIOS[scenario].get('output_format') == 'parquet']:
+            print(f"[!] pyarrow is not installed. Skipping scenario '{scenario}'.")
+            scenarios.remove(scenario)
+    bbox = [','.join(f'{coordinate:.6f}' for coordinate in BBOX)]
+    expected_posts = len(SyntheticPosts(args.posts, args.distribution, args.seed).matches({'bbox': bbox[0]}))
+
+    server, server_url = start_server(args)
+    workspace_path = tempfile.mkdtemp(prefix='check_resume_')
+    creds_path = os.path.join(workspace_path, 'FLICKR_API_KEY.txt')
+    results = []
+    try:
+        with open(creds_path, 'w') as f:
+            f.write('<KEY>\ncheckkey\n<SECRET>\nchecksecret\n')
+        for scenario in scenarios:
+            print(f"[*] Crashing and resuming scenario '{scenario}'...")
+            results.append(check_scenario(scenario, server_url, creds_path, bbox, args.crash_after, expected_posts))
+    finally:
+        server.kill()
+        shutil.rmtree(workspace_path, ignore_errors=True)
+    if not all(results):
+        sys.exit(1)
+    print("[+] All resumed harvests are complete.")
@@ -0,0 +1,322 @@
+'''
+Local stand-in for the Flickr API (flickr.photos.search) and the static image hosts.
+
+The posts are drawn from a synthetic spatio-temporal distribution (fixed seed, so every run serves the same posts).
+photos.search behaves like the real endpoint in the parts FlickrFrame depends on:
+    - bbox, min/max_upload_date (inclusive), tags / text (a word of the post), page, per_page and extras
+    - results sorted by upload date (newest first), 'total' and 'pages' report all matches
+    - only the first 4'000 results can be paged through, later pages repeat the last reachable page
+    - pages beyond 'pages' repeat the last page
+The image urls of the posts point to the image host of the server (/images/<id>_<size>.jpg), which serves
+deterministic bytes and supports range requests. Optional latency and injected errors (HTTP 500) / throttling
+(HTTP 429) and missing images (HTTP 404) make the server useful to test retries. GET /stats returns the counters of the server as json.
+
+usage: python benchmarks/mock_flickr_server.py [--port 8080] [--posts 100000] [--distribution hotspots]
+Point flickrapi to the server with: flickrapi.FlickrAPI.REST_URL = 'http://127.0.0.1:8080/services/rest/'
+'''
+import sys
+import json
+import math
+import zlib
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Flickr does not return more than 4'000 results per query
+RESULT_CAP = 4000
+# area and upload timespan of the synthetic posts
+BBOX = (8.0, 46.5, 9.0, 47.5)
+START_DATE = 950659200
+END_DATE = 1600000000
+WORDS = ['redkite', 'bird', 'lake', 'alps', 'sunset', 'zurich', 'forest', 'hiking', 'snow', 'city',
+         'bridge', 'church', 'river', 'cow', 'train', 'mountain', 'flower', 'night', 'street', 'market']
+LICENSES = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10']
+IMAGE_SIZES = {'s': (240, 180), 'm': (500, 375), 'l': (1024, 768), 'o': (2048, 1536)}
+
+
+class SyntheticPosts:
+    '''
+    Synthetic posts as column arrays, sorted by upload date (newest first)
+
+    distribution:
+        uniform: posts spread evenly over the bbox
+        hotspots: 70 % of the posts in a few dense gaussian hotspots (cities, sights), the rest spread evenly
+    The upload dates grow exponentially towards the end of the timespan like the real uploads.
+    '''
+    def __init__(self, posts=100000, distribution='hotspots', seed=0):
+        rng = np.random.default_rng(seed)
+        min_x, min_y, max_x, max_y = BBOX
+        lng = rng.uniform(min_x, max_x, posts)
+        lat = rng.uniform(min_y, max_y, posts)
+        if distribution == 'hotspots':
+            hotspots = rng.uniform((min_x + 0.1, min_y + 0.1), (max_x - 0.1, max_y - 0.1), (5, 2))
+            in_hotspot = rng.random(posts) < 0.7
+            which = rng.integers(0, len(hotspots), posts)
+            spread = rng.uniform(0.002, 0.03, len(hotspots))[which]
+            lng = np.where(in_hotspot, hotspots[which, 0] + rng.normal(0, 1, posts) * spread, lng)
+            lat = np.where(in_hotspot, hotspots[which, 1] + rng.normal(0, 1, posts) * spread, lat)
+            lng = np.clip(lng, min_x, max_x)
+            lat = np.clip(lat, min_y, max_y)
+        elif distribution != 'uniform':
+            raise ValueError(f"Unknown distribution '{distribution}'. Choose 'uniform' or 'hotspots'.")
+        # exponential growth of the uploads over time
+        growth = 4.0
+        share = np.log1p(rng.random(posts) * (math.exp(growth) - 1)) / growth
+        dateupload = (START_DATE + share * (END_DATE - START_DATE)).astype(np.int64)
+        order = np.argsort(-dateupload, kind='stable')
+        self.lng = lng[order].round(6)
+        self.lat = lat[order].round(6)
+        self.dateupload = dateupload[order]
+        self.datetaken = self.dateupload - rng.integers(0, 30 * 24 * 3600, posts)
+        self.id = rng.permutation(np.arange(10 ** 9, 10 ** 9 + posts))
+        self.owner = rng.integers(0, max(1, posts // 20), posts)
+        self.word = rng.integers(0, len(WORDS), posts)
+        self.views = rng.integers(0, 5000, posts)
+        self.license = rng.integers(0, len(LICENSES), posts)
+
+    def __len__(self):
+        return len(self.id)
+
+    def matches(self, params):
+        '''
+        :return: indices of the posts matching the search parameters (sorted by upload date, newest first)
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        if params.get('bbox'):
+            min_x, min_y, max_x, max_y = [float(coordinate) for coordinate in params['bbox'].split(',')]
+            mask &= (self.lng >= min_x) & (self.lng <= max_x) & (self.lat >= min_y) & (self.lat <= max_y)
+        if params.get('min_upload_date'):
+            mask &= self.dateupload >= int(params['min_upload_date'])
+        if params.get('max_upload_date'):
+            mask &= self.dateupload <= int(params['max_upload_date'])
+        words = params.get('tags') or params.get('text')
+        if words:
+            wanted = [WORDS.index(word) for word in words.replace(',', ' ').split() if word in WORDS]
+            mask &= np.isin(self.word, wanted)
+        return np.flatnonzero(mask)
+
+    def post(self, index, extras, image_host):
+        photo_id = str(self.id[index])
+        post = {'id': photo_id, 'owner': f'{self.owner[index] + 10000000}@N0{self.owner[index] % 10}', 'secret': 'abcdef1234',
+                'server': '65535', 'farm': 66, 'title': f'{WORDS[self.word[index]]} {photo_id[-4:]}',
+                'ispublic': 1, 'isfriend': 0, 'isfamily': 0}
+        if not extras:
+            return post
+        word = WORDS[self.word[index]]
+        post.update({'description': {'_content': f'A photo of a {word};\nuploaded to the mock server'},
+                     'license': LICENSES[self.license[index]],
+                     'dateupload': str(self.dateupload[index]),
+                     'lastupdate': str(self.dateupload[index]),
+                     'datetaken': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(self.datetaken[index]))),
+                     'datetakengranularity': 0,
+                     'ownername': f'user {self.owner[index]}',
+                     'views': str(self.views[index]),
+                     'tags': f'{word} mock {word}{self.license[index]}',
+                     'machine_tags': '',
+                     'latitude': str(self.lat[index]),
+                     'longitude': str(self.lng[index]),
+                     'accuracy': '16',
+                     'context': 0,
+                     'place_id': f'place{self.word[index]}',
+                     'woeid': str(700000 + self.word[index]),
+                     'media': 'photo'})
+        for size, (width, height) in IMAGE_SIZES.items():
+            post[f'url_{size}'] = f'{image_host}/images/{photo_id}_{size}.jpg'
+            post[f'width_{size}'] = width
+            post[f'height_{size}'] = height
+        return post
+
+
+class MockFlickr:
+    '''
+    State of the server: the posts, the fault injection and the counters
+    '''
+    def __init__(self, posts, latency=0.0, image_latency=0.0, image_bytes=4096, error_rate=0.0, throttle_rate=0.0, missing_rate=0.0, seed=0):
+        self.posts = posts
+        self.latency = latency
+        self.image_latency = image_latency
+        self.image_bytes = image_bytes
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.missing_rate = missing_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.image_host = None
+        self.stats = {'posts': len(posts), 'search_calls': 0, 'probe_calls': 0, 'results_returned': 0,
+                      'errors_injected': 0, 'throttled': 0, 'images_served': 0, 'images_missing': 0, 'image_bytes_served': 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def fault(self):
+        '''
+        :return: injected HTTP status of a search call (or None)
+        '''
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            self.count('throttled')
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            self.count('errors_injected')
+            return 500
+        return None
+
+    def search(self, params):
+        per_page = min(500, max(1, int(params.get('per_page', 100))))
+        page = max(1, int(params.get('page', 1)))
+        extras = params.get('extras', '').strip()
+        self.count('search_calls' if extras else 'probe_calls')
+        matches = self.posts.matches(params)
+        total = len(matches)
+        pages = math.ceil(total / per_page)
+        # pages beyond the result cap or the last page repeat the last reachable page
+        reachable = max(1, min(pages, RESULT_CAP // per_page))
+        page_index = min(page, reachable) - 1
+        selected = matches[page_index * per_page:(page_index + 1) * per_page]
+        self.count('results_returned', len(selected))
+        return {'photos': {'page': page, 'pages': pages, 'perpage': per_page, 'total': total,
+                           'photo': [self.posts.post(index, extras, self.image_host) for index in selected]},
+                'stat': 'ok'}
+
+    def missing(self, name):
+        '''
+        :return: True for the (always same) share missing_rate of the images, which are answered with 404
+        '''
+        return zlib.crc32(name.rsplit('_', 1)[0].encode('utf-8')) % 10000 < self.missing_rate * 10000
+
+    def image(self, name):
+        '''
+        :return: deterministic bytes of an image (the size suffix scales the size)
+        '''
+        size = name.rsplit('_', 1)[-1].split('.')[0]
+        factor = {'s': 1, 'm': 2, 'l': 4, 'o': 8}.get(size, 1)
+        seed = name.encode('utf-8')
+        return (seed * (self.image_bytes * factor // len(seed) + 1))[:self.image_bytes * factor]
+
+
+class MockFlickrHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # set by serve
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def rest(self, params):
+        if params.get('method') != 'flickr.photos.search':
+            body = {'stat': 'fail', 'code': 112, 'message': f"Method \"{params.get('method')}\" not found"}
+            return self.send_body(200, json.dumps(body).encode('utf-8'))
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        status = self.mock.fault()
+        if status is not None:
+            return self.send_body(status, b'Too Many Requests' if status == 429 else b'Internal Server Error', 'text/plain')
+        body = json.dumps(self.mock.search(params))
+        if params.get('format') == 'json' and not params.get('nojsoncallback'):
+            body = f'jsonFlickrApi({body})'
+        self.send_body(200, body.encode('utf-8'))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/services/rest/':
+            return self.rest(dict(urllib.parse.parse_qsl(url.query)))
+        if url.path == '/stats':
+            with self.mock.lock:
+                return self.send_body(200, json.dumps(self.mock.stats).encode('utf-8'))
+        if url.path.startswith('/images/'):
+            return self.serve_image(url.path[len('/images/'):])
+        self.send_body(404, b'Not Found', 'text/plain')
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        # flickrapi posts the parameters as form data
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+        url = urllib.parse.urlsplit(self.path)
+        params.update(urllib.parse.parse_qsl(url.query))
+        if url.path == '/services/rest/':
+            return self.rest(params)
+        self.send_body(404, b'Not Found', 'text/plain')
+
+    def serve_image(self, name):
+        if not name.endswith('.jpg'):
+            return self.send_body(404, b'Not Found', 'text/plain')
+        if self.mock.missing(name):
+            self.mock.count('images_missing')
+            return self.send_body(404, b'Not Found', 'text/plain')
+        if self.mock.image_latency:
+            time.sleep(self.mock.image_latency)
+        data = self.mock.image(name)
+        offset = 0
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes=') and range_header[6:].split('-')[0].isdigit():
+            offset = min(int(range_header[6:].split('-')[0]), len(data))
+            status = 206
+            headers['Content-Range'] = f'bytes {offset}-{len(data) - 1}/{len(data)}'
+        body = data[offset:]
+        self.mock.count('images_served')
+        self.mock.count('image_bytes_served', len(body))
+        self.send_body(status, body, 'image/jpeg', headers)
+
+
+def serve(mock, host='127.0.0.1', port=0):
+    '''
+    Start the server on a background thread
+
+    :return: server (server.server_address holds the port, stop it with server.shutdown())
+    '''
+    handler = type('Handler', (MockFlickrHandler,), {'mock': mock})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    mock.image_host = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, help='0: any free port')
+    parser.add_argument('--posts', type=int, default=100000, help='amount of synthetic posts')
+    parser.add_argument('--distribution', default='hotspots', choices=['uniform', 'hotspots'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every search call')
+    parser.add_argument('--image-latency', type=float, default=0.0, help='seconds added to every image request')
+    parser.add_argument('--image-bytes', type=int, default=4096, help='size of a small image, the other sizes are multiples')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of search calls answered with HTTP 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of search calls answered with HTTP 429')
+    parser.add_argument('--missing-rate', type=float, default=0.0, help='share of images answered with HTTP 404')
+    args = parser.parse_args()
+
+    mock = MockFlickr(SyntheticPosts(args.posts, args.distribution, args.seed), latency=args.latency,
+                      image_latency=args.image_latency, image_bytes=args.image_bytes,
+                      error_rate=args.error_rate, throttle_rate=args.throttle_rate, missing_rate=args.missing_rate, seed=args.seed)
+    server = serve(mock, args.host, args.port)
+    # the first line is read by bench_harvest.py to find the port
+    print(f"[*] Mock Flickr API listening on http://{args.host}:{server.server_address[1]}/services/rest/", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
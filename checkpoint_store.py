@@ -0,0 +1,224 @@
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+class CheckpointStore:
+    '''
+    Durable checkpoints of a FlickrFrame run (SQLite file inside the project folder).
+
+    areas: status ('running' or 'done') and the resolved upload timespan of every area. A restarted run skips
+    the done areas and reuses the timespan of a running area, so the split windows are the same as before.
+    With streaming output the output file of the area is stored as well, so a restarted run continues it.
+    windows: every finished subquery (area, bbox, upload window). Windows which fit into one query are stored
+    with their result pages ('done'), windows which returned too many pages with their amount of pages ('split').
+    A restarted run takes both from the store instead of querying them again.
+    watermarks: upper upload date of the last finished delta harvest of every area and query signature.
+    The next delta harvest of the area only queries the posts uploaded since.
+    dead_letters: result pages given up by the retry policy (permanent error, tries or retry budget used up) with the
+    window of their query, so they can be fetched again later (FlickrFrame with refetch_dead_letters). They are kept by reset.
+    '''
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(checkpoint_path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS areas (
+                                       area_name TEXT PRIMARY KEY,
+                                       status TEXT,
+                                       min_upload_date INTEGER,
+                                       max_upload_date INTEGER,
+                                       updated REAL,
+                                       output_path TEXT)''')
+        try:
+            # checkpoint files created before the streaming output existed
+            self.connection.execute('ALTER TABLE areas ADD COLUMN output_path TEXT')
+        except sqlite3.OperationalError:
+            pass
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS windows (
+                                       area_name TEXT,
+                                       bbox TEXT,
+                                       min_upload_date INTEGER,
+                                       max_upload_date INTEGER,
+                                       status TEXT,
+                                       pages INTEGER,
+                                       result BLOB,
+                                       updated REAL,
+                                       PRIMARY KEY (area_name, bbox, min_upload_date, max_upload_date))''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS watermarks (
+                                       area_name TEXT,
+                                       signature TEXT,
+                                       max_upload_date INTEGER,
+                                       updated REAL,
+                                       PRIMARY KEY (area_name, signature))''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS dead_letters (
+                                       area_name TEXT,
+                                       bbox TEXT,
+                                       min_upload_date INTEGER,
+                                       max_upload_date INTEGER,
+                                       page INTEGER,
+                                       error_class TEXT,
+                                       error TEXT,
+                                       updated REAL,
+                                       PRIMARY KEY (area_name, bbox, min_upload_date, max_upload_date, page))''')
+        self.connection.commit()
+
+    @staticmethod
+    def bbox_key(bbox):
+        return '' if bbox is None else bbox[0]
+
+    def area_done(self, area_name):
+        with self.lock:
+            row = self.connection.execute('SELECT status FROM areas WHERE area_name = ?', (area_name,)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def start_area(self, area_name, min_upload_date, max_upload_date):
+        '''
+        Register an area as running. If the area was started by an earlier run, its timespan is kept.
+
+        :return: upload timespan of the area (min_upload_date, max_upload_date)
+        '''
+        with self.lock:
+            row = self.connection.execute('SELECT min_upload_date, max_upload_date FROM areas WHERE area_name = ?',
+                                          (area_name,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE areas SET status = 'running', updated = ? WHERE area_name = ?", (time.time(), area_name))
+                self.connection.commit()
+                return row[0], row[1]
+            self.connection.execute("INSERT INTO areas VALUES (?, 'running', ?, ?, ?, NULL)", (area_name, min_upload_date, max_upload_date, time.time()))
+            self.connection.commit()
+        return min_upload_date, max_upload_date
+
+    def output_path(self, area_name):
+        '''
+        :return: output file the streaming output of the area was written to by an earlier run (or None)
+        '''
+        with self.lock:
+            row = self.connection.execute('SELECT output_path FROM areas WHERE area_name = ?', (area_name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_output_path(self, area_name, output_path):
+        with self.lock:
+            self.connection.execute('UPDATE areas SET output_path = ? WHERE area_name = ?', (output_path, area_name))
+            self.connection.commit()
+
+    def finish_area(self, area_name):
+        '''
+        Mark an area as done. The stored results of its windows are not needed anymore and are removed.
+        '''
+        with self.lock:
+            self.connection.execute("UPDATE areas SET status = 'done', updated = ? WHERE area_name = ?", (time.time(), area_name))
+            self.connection.execute('DELETE FROM windows WHERE area_name = ?', (area_name,))
+            self.connection.commit()
+
+    def running_areas(self):
+        '''
+        :return: names of the areas started but not finished
+        '''
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT area_name FROM areas WHERE status = 'running'")]
+
+    def remove_area(self, area_name):
+        '''
+        Remove an area and the stored results of its windows
+        '''
+        with self.lock:
+            self.connection.execute('DELETE FROM areas WHERE area_name = ?', (area_name,))
+            self.connection.execute('DELETE FROM windows WHERE area_name = ?', (area_name,))
+            self.connection.commit()
+
+    def restart_area(self, area_name):
+        '''
+        Remove a done area, so it can be started again with a new timespan (next delta harvest or repeated query)
+        '''
+        with self.lock:
+            self.connection.execute("DELETE FROM areas WHERE area_name = ? AND status = 'done'", (area_name,))
+            self.connection.commit()
+
+    def watermark(self, area_name, signature):
+        '''
+        :return: upper upload date of the last finished delta harvest of the area and query signature (or None)
+        '''
+        with self.lock:
+            row = self.connection.execute('SELECT max_upload_date FROM watermarks WHERE area_name = ? AND signature = ?',
+                                          (area_name, signature)).fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(self, area_name, signature, max_upload_date):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)', (area_name, signature, max_upload_date, time.time()))
+            self.connection.commit()
+
+    def window(self, area_name, bbox, min_upload_date, max_upload_date):
+        '''
+        :return: (status, pages, result_dict) of a finished window or None
+        '''
+        with self.lock:
+            row = self.connection.execute('''SELECT status, pages, result FROM windows
+                                             WHERE area_name = ? AND bbox = ? AND min_upload_date = ? AND max_upload_date = ?''',
+                                          (area_name, CheckpointStore.bbox_key(bbox), min_upload_date, max_upload_date)).fetchone()
+        if row is None:
+            return None
+        status, pages, result = row
+        result_dict = json.loads(zlib.decompress(result).decode('utf-8')) if result is not None else None
+        return status, pages, result_dict
+
+    def save_window(self, area_name, bbox, min_upload_date, max_upload_date, pages, result_dict):
+        '''
+        Store a window which fitted into one query together with its result pages
+        '''
+        result = zlib.compress(json.dumps(result_dict).encode('utf-8'))
+        self.write_window(area_name, bbox, min_upload_date, max_upload_date, 'done', pages, result)
+
+    def save_split(self, area_name, bbox, min_upload_date, max_upload_date, pages):
+        '''
+        Store a window which returned too many pages and was split further
+        '''
+        self.write_window(area_name, bbox, min_upload_date, max_upload_date, 'split', pages, None)
+
+    def write_window(self, area_name, bbox, min_upload_date, max_upload_date, status, pages, result):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (area_name, CheckpointStore.bbox_key(bbox), min_upload_date, max_upload_date,
+                                     status, pages, result, time.time()))
+            self.connection.commit()
+
+    def add_dead_letter(self, area_name, bbox, min_upload_date, max_upload_date, page, error_class, error):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (area_name, CheckpointStore.bbox_key(bbox), min_upload_date, max_upload_date,
+                                     page, error_class, error, time.time()))
+            self.connection.commit()
+
+    def dead_letters(self):
+        '''
+        :return: list of (area_name, bbox, min_upload_date, max_upload_date, page, error_class, error)
+        '''
+        with self.lock:
+            rows = self.connection.execute('''SELECT area_name, bbox, min_upload_date, max_upload_date, page, error_class, error
+                                              FROM dead_letters ORDER BY area_name, updated''').fetchall()
+        return [(area_name, [bbox] if bbox else None, min_upload_date, max_upload_date, page, error_class, error)
+                for area_name, bbox, min_upload_date, max_upload_date, page, error_class, error in rows]
+
+    def remove_dead_letter(self, area_name, bbox, min_upload_date, max_upload_date, page):
+        with self.lock:
+            self.connection.execute('''DELETE FROM dead_letters WHERE area_name = ? AND bbox = ? AND min_upload_date = ?
+                                       AND max_upload_date = ? AND page = ?''',
+                                    (area_name, CheckpointStore.bbox_key(bbox), min_upload_date, max_upload_date, page))
+            self.connection.commit()
+
+    def reset_windows(self, area_name):
+        with self.lock:
+            self.connection.execute('DELETE FROM windows WHERE area_name = ?', (area_name,))
+            self.connection.commit()
+
+    def reset(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM areas')
+            self.connection.execute('DELETE FROM windows')
+            self.connection.execute('DELETE FROM watermarks')
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,183 @@
+import re
+import time
+import threading
+import flickrapi
+from rate_limiter import get_rate_limiter
+
+def status_code(error):
+    '''
+    :return: HTTP status of a failed request (requests, aiohttp or flickrapi error) or None
+    '''
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    if isinstance(getattr(error, 'status', None), int):
+        return error.status
+    # flickrapi: 'do_request: Status code 500 received'
+    match = re.search(r'Status code (\d{3}) received', str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_throttled(error):
+    '''
+    Check if an api error means that the api key is throttled (HTTP 429)
+    '''
+    return status_code(error) == 429
+
+
+class Credential:
+    '''
+    api key and secret of a registered Flickr app with its token bucket and quota use
+    '''
+    def __init__(self, api_key, api_secret, rate_limiter):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.rate_limiter = rate_limiter
+        # flickrapi client of the key, built once and reused by all queries
+        self.client = None
+        self.calls = 0
+        self.throttles = 0
+        # the key is out of rotation until then (time.monotonic)
+        self.throttled_until = 0.0
+        # threads currently waiting for a token of this key
+        self.waiting = 0
+
+    def name(self):
+        return '...' + self.api_key[-4:].decode('utf-8')
+
+
+class CredentialPool:
+    '''
+    Pool of all api keys of a credentials file. The file may contain several <KEY>/<SECRET> sections:
+        <KEY>
+        key of app 1
+        <SECRET>
+        secret of app 1
+        <KEY>
+        key of app 2
+        ...
+
+    Every key has its own token bucket (see rate_limiter.py) and one reusable flickrapi client.
+    acquire hands out the key with the most saved up calls, so the calls are spread over all keys.
+    A throttled key is taken out of rotation for cooldown seconds (with a single key at most max_cooldown, see throttled).
+
+    The pool provides calls_per_hour and remaining like a TokenBucket for the whole pool.
+    '''
+    def __init__(self, creds_path, calls_per_hour=3600, burst=None, cooldown=600):
+        self.creds_path = creds_path
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.credentials = [Credential(api_key, api_secret, get_rate_limiter(api_key, calls_per_hour=calls_per_hour, burst=burst))
+                            for api_key, api_secret in CredentialPool.read_credentials(creds_path)]
+        self.calls_per_hour = sum(credential.rate_limiter.calls_per_hour for credential in self.credentials)
+
+    def configure(self, calls_per_hour=3600, burst=None):
+        '''
+        Apply changed limits to the token buckets of all keys (see get_rate_limiter)
+        '''
+        for credential in self.credentials:
+            credential.rate_limiter = get_rate_limiter(credential.api_key, calls_per_hour=calls_per_hour, burst=burst)
+        self.calls_per_hour = sum(credential.rate_limiter.calls_per_hour for credential in self.credentials)
+
+    @staticmethod
+    def read_credentials(path):
+        '''
+        :return: list of (api_key, api_secret) of all <KEY>/<SECRET> sections
+        '''
+        keys = []
+        secrets = []
+        key_found = False
+        secret_found = False
+        with open(path, 'r') as f:
+            for line in f:
+                if key_found:
+                    keys.append(line.strip().encode('utf-8'))
+                    key_found = False
+
+                if secret_found:
+                    secrets.append(line.strip().encode('utf-8'))
+                    secret_found = False
+
+                if re.match(r'<KEY>', line):
+                    key_found = True
+                    continue
+                elif re.match(r'<SECRET>', line):
+                    secret_found = True
+        if not keys or len(keys) != len(secrets):
+            raise ValueError(f"{path} has to contain a <KEY> and a <SECRET> section for every api key")
+        return list(zip(keys, secrets))
+
+    def client(self, credential):
+        with self.lock:
+            if credential.client is None:
+                credential.client = flickrapi.FlickrAPI(credential.api_key, credential.api_secret, format='json')
+            return credential.client
+
+    def remaining(self):
+        '''
+        :return: amount of calls that can be made right now without waiting (keys in rotation)
+        '''
+        now = time.monotonic()
+        return sum(credential.rate_limiter.remaining() for credential in self.credentials if credential.throttled_until <= now)
+
+    def acquire(self):
+        '''
+        Block until a call is allowed with one of the keys and take a token of it.
+
+        :return: Credential to use for the call
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                available = [credential for credential in self.credentials if credential.throttled_until <= now]
+                if available:
+                    credential = max(available, key=lambda c: c.rate_limiter.remaining() - c.waiting)
+                    credential.waiting += 1
+                else:
+                    to_wait = min(credential.throttled_until for credential in self.credentials) - now
+            if available:
+                credential.rate_limiter.acquire()
+                with self.lock:
+                    credential.waiting -= 1
+                    credential.calls += 1
+                return credential
+            print(f"\n[!] All api keys are throttled. Sleeping {round(to_wait)}s...")
+            time.sleep(to_wait)
+
+    def throttled(self, credential, max_cooldown=None):
+        '''
+        Take a throttled key out of rotation for cooldown seconds
+
+        :param max_cooldown: cooldown if the pool only has this key (the caller backs off itself, e.g. by the retry policy)
+        '''
+        cooldown = self.cooldown
+        if max_cooldown is not None and len(self.credentials) == 1:
+            cooldown = min(cooldown, max_cooldown)
+        with self.lock:
+            credential.throttles += 1
+            credential.throttled_until = time.monotonic() + cooldown
+        print(f"\n[!] api key {credential.name()} is throttled. Taking it out of rotation for {round(cooldown)}s.")
+
+    def usage(self):
+        '''
+        :return: api calls and throttles per key
+        '''
+        return ', '.join(f"{credential.name()}: {credential.calls} calls ({credential.throttles}x throttled)" for credential in self.credentials)
+
+
+# process wide registry with one pool per credentials file
+_credential_pools = {}
+_credential_pools_lock = threading.Lock()
+
+def get_credential_pool(creds_path, calls_per_hour=3600, burst=None):
+    '''
+    Return the pool of the credentials file shared by all FlickrQuerier objects (and threads) of this process.
+    Changed calls_per_hour or burst of a later request are applied to the keys of the existing pool.
+    '''
+    with _credential_pools_lock:
+        if creds_path not in _credential_pools:
+            _credential_pools[creds_path] = CredentialPool(creds_path, calls_per_hour=calls_per_hour, burst=burst)
+            return _credential_pools[creds_path]
+        pool = _credential_pools[creds_path]
+    pool.configure(calls_per_hour=calls_per_hour, burst=burst)
+    return pool
@@ -0,0 +1,139 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+class DownloadManifest:
+    '''
+    On-disk manifest of the downloaded images of a project (SQLite file inside the image folder).
+
+    For every photo id the size key (url_m, url_l, ...), url, byte length, md5 checksum and status ('done' or 'failed')
+    are stored. Before downloading, get_images asks the manifest which images are still missing:
+        - images marked as done whose file exists with the recorded byte length are skipped without a network call
+        - files with a different byte length (or checksum if verify_checksums) or another size key are fetched again
+        - image files of runs before the manifest existed are adopted unless they are empty or truncated
+          (originals may be PNG or GIF files saved as .jpg)
+    Partially downloaded images ('.part' files) are resumed by the downloaders with an HTTP Range request.
+    '''
+    def __init__(self, manifest_path, verify_checksums=False, commit_every=200):
+        self.manifest_path = manifest_path
+        self.verify_checksums = verify_checksums
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        # amount of tasks skipped by pending_tasks because they were already downloaded
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS images (
+                                       photo_id TEXT PRIMARY KEY,
+                                       size_key TEXT,
+                                       url TEXT,
+                                       byte_length INTEGER,
+                                       checksum TEXT,
+                                       status TEXT,
+                                       updated REAL)''')
+        self.connection.commit()
+
+    @staticmethod
+    def file_checksum(file_path, chunk_size=1024 * 1024):
+        checksum = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    @staticmethod
+    def is_complete_image(file_path):
+        '''
+        Cheap completeness check for files without manifest record. The format is taken from the magic bytes and
+        JPEG (end of image marker FFD9), PNG (IEND chunk) and GIF (trailer 3B) files have to end with their end marker.
+        Files of other formats are only required to be non-empty.
+        '''
+        try:
+            size = os.path.getsize(file_path)
+            if size == 0:
+                return False
+            with open(file_path, 'rb') as f:
+                start = f.read(8)
+                f.seek(-min(size, 12), os.SEEK_END)
+                end = f.read(12)
+        except OSError:
+            return False
+        if start.startswith(b'\xff\xd8'):
+            return end.endswith(b'\xff\xd9')
+        if start == b'\x89PNG\r\n\x1a\n':
+            return end.endswith(b'IEND\xaeB`\x82')
+        if start[:6] in (b'GIF87a', b'GIF89a'):
+            return end.endswith(b'\x3b')
+        return True
+
+    def record(self, photo_id):
+        with self.lock:
+            return self.connection.execute('SELECT size_key, url, byte_length, checksum, status FROM images WHERE photo_id = ?',
+                                           (photo_id,)).fetchone()
+
+    def write(self, photo_id, size_key, url, byte_length, checksum, status):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (photo_id, size_key, url, byte_length, checksum, status, time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def mark_done(self, photo_id, size_key, url, byte_length, checksum):
+        self.write(photo_id, size_key, url, byte_length, checksum, 'done')
+
+    def mark_failed(self, photo_id, size_key, url):
+        self.write(photo_id, size_key, url, None, None, 'failed')
+
+    def is_done(self, photo_id, size_key, file_path):
+        '''
+        Check if the image of photo_id was completely downloaded in the requested size.
+        Files which do not match their record are deleted so they are fetched again.
+        '''
+        record = self.record(photo_id)
+        file_exists = os.path.exists(file_path)
+        if record is None:
+            # image of a run before the manifest existed
+            if file_exists and DownloadManifest.is_complete_image(file_path):
+                self.mark_done(photo_id, size_key, None, os.path.getsize(file_path), DownloadManifest.file_checksum(file_path))
+                return True
+        else:
+            recorded_size_key, url, byte_length, checksum, status = record
+            if status == 'done' and recorded_size_key == size_key and file_exists and os.path.getsize(file_path) == byte_length:
+                if not self.verify_checksums or DownloadManifest.file_checksum(file_path) == checksum:
+                    return True
+            if recorded_size_key != size_key and os.path.exists(file_path + '.part'):
+                # a partial download of another size can not be resumed
+                os.remove(file_path + '.part')
+        if file_exists:
+            os.remove(file_path)
+        return False
+
+    def pending_tasks(self, tasks, image_path):
+        '''
+        Filter the tasks lazily, the amount of skipped tasks is counted in self.skipped
+
+        :param tasks: list or iterable of (img_id, img_url, size_key) tuples
+        :return: generator of the tasks which still have to be downloaded
+        '''
+        for task in tasks:
+            img_id, img_url, size_key = task
+            if self.is_done(img_id, size_key, os.path.join(image_path, f"{img_id}.jpg")):
+                self.skipped += 1
+                continue
+            yield task
+
+    def failed_tasks(self):
+        '''
+        :return: (img_id, img_url, size_key) tasks of the images whose download was given up (dead letters)
+        '''
+        with self.lock:
+            return self.connection.execute("SELECT photo_id, url, size_key FROM images WHERE status = 'failed'").fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
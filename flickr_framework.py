@@ -1,10 +1,25 @@
 import os
+import re
 import sys
+import copy
 import json
+import math
+import hashlib
 import datetime
+import concurrent.futures
 from time import time
 from query_flickr_api_improved import FlickrQuerier
+from search_cache import get_search_cache
+from checkpoint_store import CheckpointStore
+from area_filter import AreaFilter
+from bbox_cover import BoxCover, envelope, outward
+from credential_pool import get_credential_pool
+from metadata_writer import MetadataStream, ParquetMetadataWriter
+from harvest_metrics import configure_metrics, get_metrics
+from retry_policy import configure_retry_policy
+from download_manifest import DownloadManifest
 
+# areas to skip, finished areas are also skipped through the checkpoint store of the project
 already_processed = [] #'DE-HW', 'CH-FM', 'CH-SB', 'GR-KA', 'SP-MO', 'SP-SC', 'RO-SA', 'PT-MN', 'FR-CL', 'UK-WB', 'SE-LI', 'SP-LT'
 
 class FlickrFrame:
@@ -17,21 +32,37 @@ class FlickrFrame:
 
     During the process it is checked if a query exceeds the maximum of 4'000 results returned.
     If that is the case, the same bounding box is queried iteratively with smaller timespans to capture all possible
-    georeferenced flickr posts from a given region.
+    georeferenced flickr posts from a given region. With split_strategy 'space' or 'hybrid' the bounding box is
+    split into quadrants instead, which needs fewer queries for large regions with a few dense hotspots.
 
     The output is presented in a CSV file with semicolon seperation. All the data is UTF-8 encoded and processed to
     allow for easy further processing.
     The name of the output file is given , geojson the name field is used in the output file name
 
-    Workspace will be established in the same directory as this file.
+    Workspace will be established in the same directory as this file (or in workspace_path).
 
     API AUTHENTICATION:
     During the FlickrQuerier class invokation a (txt) file has to be provided which contains <KEY> and <SECRET> sections
     where the users personal authenticatoin details are contained.
     '''
+    # start of flickr (16.02.2000) used as lower limit if no min_upload_date is supplied
+    flickr_start_date = 950659200
+    # a window fits into one query if it returns less than 15 pages (4'000 results / 250 per page)
+    max_window_pages = 14
+
     def __init__(self, project_name, api_credentials_path, min_upload_date=None, max_upload_date=None, bbox=None, text_search=None, tags=None,
-                            tag_mode=None, has_geo=True, textual_results_to_return=1000, geojson_file=None, accuracy=16, toget_images=True, image_size='medium', allowed_licenses=None):
+                            tag_mode=None, has_geo=True, textual_results_to_return=1000, geojson_file=None, accuracy=16, toget_images=True, image_size='medium', allowed_licenses=None,
+                            split_strategy='time', min_bbox_size=0.001, calls_per_hour=3600, burst=None, page_workers=4,
+                            download_workers=10, max_download_workers=None, download_engine='threads',
+                            cache_path=None, cache_ttl=7 * 24 * 3600, cache_max_bytes=2 * 1024 ** 3, cache_only=False,
+                            resume=True, streaming=False, output_format='csv', plan_queries=False, dry_run=False,
+                            area_workers=1, delta=False, filter_polygons=False, cover_boxes=1, cover_fill=0.6,
+                            metrics_path=None, metrics_format='jsonl', search_retry_budget=1000, image_retry_budget=10000,
+                            refetch_dead_letters=False, workspace_path=None):
         self.project_name = project_name
+        # the project folder is created in workspace_path (default: the folder of this script)
+        self.workspace_path = workspace_path if workspace_path is not None else os.path.dirname(os.path.realpath(__file__))
+        self.project_path = os.path.join(self.workspace_path, project_name)
         self.api_credentials_path = api_credentials_path
         self.min_upload_date = min_upload_date
         self.max_upload_date = max_upload_date
@@ -49,6 +80,66 @@ class FlickrFrame:
         self.toget_images = toget_images
         self.image_size = image_size
         self.allowed_licenses = allowed_licenses
+        # how queries with too many results are split: 'time', 'space' (quadtree of the bbox) or 'hybrid'
+        self.split_strategy = split_strategy
+        # minimum width/height (degrees) of a bbox that is split further into quadrants
+        self.min_bbox_size = min_bbox_size
+        # rate limit per api key shared by all queries of this process and the maximal burst of saved up calls
+        # (the credentials file may contain several <KEY>/<SECRET> sections, the calls are spread over all keys)
+        self.calls_per_hour = calls_per_hour
+        self.burst = burst
+        # amount of threads fetching the result pages of a query concurrently
+        self.page_workers = page_workers
+        # amount of image download workers, increased up to max_download_workers while the throughput grows
+        self.download_workers = download_workers
+        self.max_download_workers = max_download_workers
+        # 'threads' (default) or 'asyncio' (requires aiohttp)
+        self.download_engine = download_engine
+        # optional on-disk cache of photos.search responses (cache_only: offline mode without api calls)
+        self.search_cache = None
+        # cache misses of an offline run are returned as empty pages, so its windows and areas are not checkpointed
+        self.cache_only = cache_only and cache_path is not None
+        if cache_path is not None:
+            self.search_cache = get_search_cache(cache_path, ttl=cache_ttl, max_bytes=cache_max_bytes, cache_only=cache_only)
+        # continue interrupted runs from the checkpoints in the project folder (False: start from scratch)
+        self.resume = resume
+        # write every result page to the output right away instead of collecting all subqueries in memory
+        self.streaming = streaming
+        # 'csv' (semicolon separated), 'parquet' (typed columns, requires pyarrow) or 'sqlite' (one database per project)
+        self.output_format = output_format
+        # partition overflowing areas with cheap count probes first and only then fetch the result pages
+        # dry_run: only print the plan with the estimated api calls and time
+        self.dry_run = dry_run
+        self.plan_queries = plan_queries or dry_run
+        self.planned_calls = 0
+        # GeoJSON areas processed concurrently, all share the rate limit of the api key.
+        # The images of an area are downloaded in the background while the next area is queried.
+        self.area_workers = area_workers
+        self.download_executor = None
+        self.download_future = None
+        self.metadata_stream = None
+        # delta harvest: only query the posts uploaded since the last finished harvest of an area (watermark in the
+        # checkpoint store per area and query signature) and merge them into the output file of the earlier harvests
+        self.delta = delta
+        self.delta_signature = None
+        # remove the posts outside the polygons of the GeoJSON areas from every result page (requires shapely),
+        # the bbox queries return all posts of the envelope
+        self.filter_polygons = filter_polygons
+        self.area_filter = None
+        # GeoJSON features are covered by up to cover_boxes bounding boxes (1: the envelope), boxes that are filled
+        # by at least cover_fill of the polygons are not split further (see BoxCover, requires shapely)
+        self.cover_boxes = cover_boxes
+        self.cover_fill = cover_fill
+        # optional metrics of the run (api call latencies, rate limit waits, retries, posts per page, deduplication,
+        # downloads, queue depths) written to metrics_path as 'jsonl' (traced events and snapshots) or 'prometheus' text
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        # failed api calls and image downloads are retried with exponential backoff (permanent errors are not retried)
+        # up to the retry budgets of the run. Result pages and images given up are kept as dead letters (checkpoint
+        # store, download manifest) and fetched again before the harvest with refetch_dead_letters.
+        self.search_retry_budget = search_retry_budget
+        self.image_retry_budget = image_retry_budget
+        self.refetch_dead_letters = refetch_dead_letters
         '''
         Check if the user supplied:
             1. single bbox or 
@@ -68,112 +159,464 @@ class FlickrFrame:
         elif self.text_search is not None and self.tags is not None:
             print("Both textual search are supplied. Either tag or free text has to be chosen. Not both. \nAborting...")
             sys.exit(1)
+        elif self.split_strategy not in ('time', 'space', 'hybrid'):
+            print(f"Unknown split_strategy '{self.split_strategy}'. Choose 'time', 'space' or 'hybrid'. \nAborting...")
+            sys.exit(1)
+        elif self.download_engine not in ('threads', 'asyncio'):
+            print(f"Unknown download_engine '{self.download_engine}'. Choose 'threads' or 'asyncio'. \nAborting...")
+            sys.exit(1)
+        elif self.output_format not in ('csv', 'parquet', 'sqlite'):
+            print(f"Unknown output_format '{self.output_format}'. Choose 'csv', 'parquet' or 'sqlite'. \nAborting...")
+            sys.exit(1)
+        elif self.output_format == 'parquet' and not ParquetMetadataWriter.available():
+            print("output_format 'parquet' requires pyarrow. Install it or choose 'csv'. \nAborting...")
+            sys.exit(1)
+        elif self.filter_polygons and self.geojson_file is None:
+            print("filter_polygons requires a geojson_file with the polygons of the areas. \nAborting...")
+            sys.exit(1)
+        elif self.cover_boxes > 1 and not BoxCover.available():
+            print("cover_boxes > 1 requires shapely (>= 2.0). Install it or set cover_boxes=1. \nAborting...")
+            sys.exit(1)
+        elif self.filter_polygons and not AreaFilter.available():
+            print("filter_polygons requires shapely (>= 2.0). Install it or set filter_polygons=False. \nAborting...")
+            sys.exit(1)
+        elif self.metrics_format not in ('jsonl', 'prometheus'):
+            print(f"Unknown metrics_format '{self.metrics_format}'. Choose 'jsonl' or 'prometheus'. \nAborting...")
+            sys.exit(1)
+        if self.metrics_path is not None:
+            configure_metrics(self.metrics_path, self.metrics_format)
+        configure_retry_policy('search', budget=self.search_retry_budget)
+        configure_retry_policy('images', budget=self.image_retry_budget)
         self.body()
 
-    def high_data_volume_handler(self, pages, textual_results_to_return, perform_textual_search):
+    def high_data_volume_handler(self, bbox, pages, textual_results_to_return, perform_textual_search, lower_limit_timespan, upper_limit_timespan, plan=None,
+                                 cover=None):
         '''
         Query one bounding box multiple times to retrieve all possible results.
-        This is done by adapting the queried timespan according to the amount of result pages.
-        At the end the CSV files of all subqueries are merged.
+        Depending on the split_strategy the query is split recursively either by upload timespan ('time'),
+        by quadrants of the bounding box ('space') or by both ('hybrid'). Only the subqueries which still return
+        too many pages are split further, subqueries that already fit are kept.
+        With a query plan (see plan_area) the planned windows are queried instead,
+        with a cover (see geojson_to_bbox) the bounding boxes of the cover.
+        At the end the results of all subqueries are merged into one CSV file.
 
-        :param bbox:
-        :param pages:
+        :param bbox: bounding box of the area (None for textual searches)
+        :param pages: amount of pages returned by the initial query of the whole timespan
+        :param textual_results_to_return: limit of posts for textual searches
+        :param perform_textual_search: if the textual search limit applies
+        :param lower_limit_timespan: min_upload_date of the area
+        :param upper_limit_timespan: max_upload_date of the area
+        :param plan: optional list of (bbox, min_upload_date, max_upload_date, pages) windows
+        :param cover: optional list of bounding boxes covering the area
         :return:
         '''
-        tries = 0
-        while True:
-            tries += 1
-            upper_limit_timespan = None
-            lower_limit_timespan = None
-            #define current timespan (if none for max defined as the unixtimestamp of right now and min as the start of flickr)
-            if self.max_upload_date is None:
-                upper_limit_timespan = time()
-            else:
-                upper_limit_timespan = self.max_upload_date
+        # statistics of the splitting process of this run
+        self.split_stats = {'windows_probed': 0,
+                            'windows_resumed': 0,
+                            'windows_split': 0,
+                            'bboxes_split': 0,
+                            'api_calls': 0,
+                            'cache_hits': 0,
+                            'calls_saved': 0}
+        '''
+        aggregate the result dicts of the subquery to form one final result dict that is written to the output file
+        as a complete set of the bbox
+        '''
+        self.all_unique_ids = set()
+        self.final_result_dict_list = []
+        self.textual_limit_reached = False
+        if plan is not None:
+            self.query_plan(plan, textual_results_to_return, perform_textual_search)
+        elif cover is not None:
+            self.query_cover(cover, lower_limit_timespan, upper_limit_timespan, textual_results_to_return, perform_textual_search)
+        elif self.split_strategy != 'time' and bbox is not None:
+            self.split_bbox(bbox, lower_limit_timespan, upper_limit_timespan, pages, textual_results_to_return, perform_textual_search)
+        else:
+            self.split_timespan(bbox, lower_limit_timespan, upper_limit_timespan, pages, textual_results_to_return, perform_textual_search)
+        '''
+        If the execution reached this point, all the gathered unique ids of all subqueries will 
+        be used to produce one CSV file.
+        '''
+        print("#-" * 30)
+        print("[+] Successfully acquired all unique ids of subquery")
+        print(f"[*] Windows probed: {self.split_stats['windows_probed']}, windows resumed: {self.split_stats['windows_resumed']}, "
+              f"windows split: {self.split_stats['windows_split']}, bboxes split: {self.split_stats['bboxes_split']}, "
+              f"api calls: {self.split_stats['api_calls']}, cache hits: {self.split_stats['cache_hits']}, "
+              f"calls saved: {self.split_stats['calls_saved']}")
+        if self.metadata_stream is not None:
+            # the pages were already written by the stream, the images are downloaded at the end of the area
+            print(f"[*] Streamed a total of {self.metadata_stream.posts_written()} posts to the csv file.")
+            return None
+        print(f"[*] Querying a total of {len(self.all_unique_ids)} ids and writing to csv file..")
+        # the results may come from checkpoints only, therefore a FlickrQuerier without search writes the output
+        self.flickrquerier_obj = self.new_flickrquerier(bbox, lower_limit_timespan, upper_limit_timespan, subquery_status=True, search=False)
+        self.flickrquerier_obj.write_info(self.final_result_dict_list)
+        print("--" * 30)
+        print(f"[+] Acquiring metadata - done.")
+        print("--" * 30)
+        if self.toget_images:
+            print(f"[*] Downloading images..")
+            self.download_future = self.flickrquerier_obj.get_images(self.final_result_dict_list, image_size=self.image_size)
+            self.print_download_status()
+        print("--" * 30)
+        print("[+] FlickrQuerier Class - done")
 
-            if self.min_upload_date is None:
-                lower_limit_timespan = 950659200 #Equals date: 16.02.2000
-            else:
-                lower_limit_timespan = self.min_upload_date
+    def print_download_status(self):
+        if self.download_future is not None:
+            print(f"[*] Images of area {self.area_name} are downloaded in the background.")
+            return None
+        print("\n")
+        print("--" * 30)
+        print(f"[+] Download images - done.")
+        print("--" * 30)
 
-            timespan = upper_limit_timespan - lower_limit_timespan
-            #split timespan according to pages
-            timespan_subquery = int(round(timespan / (pages * tries), 0))
-            '''
-            aggregate the result dicts of the subquery to form one final result dict that is written to the output file
-            as a complete set of the bbox
-            '''
-            all_unique_ids = set()
-            final_result_dict_list = []
-            # count the total amount of results returned to apply the textual query return limit set by the user
-            total_returned_results = 0
-            for counter in range((pages * tries)):
-                new_lower_limit = lower_limit_timespan
-                new_upper_limit = lower_limit_timespan + timespan_subquery
-                print("--" * 30)
-                print(f"[+] {counter+1} of {(pages * tries)+1}: Processing timespan {new_lower_limit} - {new_upper_limit}")
-
-                self.flickrquerier_obj = FlickrQuerier(self.project_name,
-                                           self.area_name,
-                                           bbox=self.bbox,
-                                           text_search=self.text_search,
-                                           tags=self.tags,
-                                           tag_mode=self.tag_mode,
-                                           has_geo=self.has_geo,
-                                           textual_results_to_return=self.textual_results_to_return,
-                                           perform_textual_search=self.perform_textual_search,
-                                           min_upload_date=new_lower_limit,
-                                           max_upload_date=new_upper_limit,
-                                           accuracy=self.accuracy,
-                                           toget_images=self.toget_images,
-                                           image_size=self.image_size,
-                                           api_creds_file=self.api_credentials_path,
-                                           allowed_licenses=self.allowed_licenses,
-                                           subquery_status=True)
-
-                if not self.flickrquerier_obj.toomany_pages[1] and self.flickrquerier_obj.unique_ids is not None:
-                    all_unique_ids = all_unique_ids.union(self.flickrquerier_obj.unique_ids)
-                    '''
-                    instead of id's we collect the result dict
-                    '''
-                    final_result_dict_list.append(self.flickrquerier_obj.result_dict)
-                    if perform_textual_search:
-                        if len(all_unique_ids) > textual_results_to_return:
-                            print(f'[*] textual search: {textual_results_to_return} posts fetched. Finishing search.')
-                            break
-                else:
-                    print("--" * 30)
-                    print('[!] CAUTION: At least one subquery still returned too many results.')
-                    print('[*] Further adjusting timespan...')
-                    break
-                #assign new timespan boundaries for the next iteration
-                lower_limit_timespan = upper_limit_timespan = new_upper_limit
+    def new_flickrquerier(self, bbox, min_upload_date, max_upload_date, subquery_status, search=True):
+        '''
+        Create a FlickrQuerier with the settings of this FlickrFrame for the given bounding box and upload timespan.
+        A FlickrQuerier without search is only used to write the output and download the images of collected results.
+        The result pages given up by the FlickrQuerier are added to the dead letters of the checkpoint store.
+        '''
+        flickrquerier_obj = FlickrQuerier(self.project_name,
+                                          self.area_name,
+                                          bbox=bbox,
+                                          text_search=self.text_search,
+                                          tags=self.tags,
+                                          tag_mode=self.tag_mode,
+                                          has_geo=self.has_geo,
+                                          textual_results_to_return=self.textual_results_to_return,
+                                          perform_textual_search=self.perform_textual_search,
+                                          min_upload_date=min_upload_date,
+                                          max_upload_date=max_upload_date,
+                                          accuracy=self.accuracy,
+                                          toget_images=self.toget_images,
+                                          image_size=self.image_size,
+                                          api_creds_file=self.api_credentials_path,
+                                          allowed_licenses=self.allowed_licenses,
+                                          calls_per_hour=self.calls_per_hour,
+                                          burst=self.burst,
+                                          page_workers=self.page_workers,
+                                          download_workers=self.download_workers,
+                                          max_download_workers=self.max_download_workers,
+                                          download_engine=self.download_engine,
+                                          search_cache=self.search_cache,
+                                          metadata_stream=self.metadata_stream,
+                                          output_format=self.output_format,
+                                          download_executor=self.download_executor,
+                                          subquery_status=subquery_status,
+                                          search=search,
+                                          delta_signature=self.delta_signature,
+                                          area_filter=self.area_filter,
+                                          workspace_path=self.workspace_path)
+        self.save_dead_letters(flickrquerier_obj, bbox, min_upload_date, max_upload_date)
+        return flickrquerier_obj
+
+    def save_dead_letters(self, flickrquerier_obj, bbox, min_upload_date, max_upload_date):
+        for page, error_class, error in flickrquerier_obj.dead_letters:
+            self.checkpoint.add_dead_letter(self.area_name, bbox, min_upload_date, max_upload_date, page, error_class, error)
+        flickrquerier_obj.dead_letters = []
+
+    def query_subquery(self, bbox, min_upload_date, max_upload_date):
+        '''
+        Run a FlickrQuerier as subquery for the given bounding box and upload timespan
+        and add its api calls to the split statistics.
+        Windows finished by an earlier run are taken from the checkpoint store instead,
+        new windows are added to it (except for offline runs, see cache_only).
+
+        :return: toomany_pages tuple, result_dict (None if too many pages) and the api calls used
+        '''
+        window = self.checkpoint.window(self.area_name, bbox, min_upload_date, max_upload_date)
+        if window is not None:
+            status, pages, result_dict = window
+            print("[*] Window already processed by an earlier run. Taking results from checkpoint...")
+            self.split_stats['windows_resumed'] += 1
+            return (pages, status == 'split'), result_dict, 0
+
+        self.flickrquerier_obj = self.new_flickrquerier(bbox, min_upload_date, max_upload_date, subquery_status=True)
+        self.split_stats['windows_probed'] += 1
+        self.split_stats['api_calls'] += self.flickrquerier_obj.api_calls
+        self.split_stats['cache_hits'] += self.flickrquerier_obj.cache_hits
+        toomany_pages = self.flickrquerier_obj.toomany_pages
+        if toomany_pages[1]:
+            if not self.cache_only:
+                self.checkpoint.save_split(self.area_name, bbox, min_upload_date, max_upload_date, toomany_pages[0])
+            return toomany_pages, None, self.flickrquerier_obj.api_calls
+        if not self.cache_only:
+            if self.metadata_stream is not None:
+                # the streamed pages of the window have to be on disk before the window is skipped by a resumed run
+                self.metadata_stream.sync()
+            self.checkpoint.save_window(self.area_name, bbox, min_upload_date, max_upload_date, toomany_pages[0], self.flickrquerier_obj.result_dict)
+        return toomany_pages, self.flickrquerier_obj.result_dict, self.flickrquerier_obj.api_calls
+
+    def collect_subquery(self, result_dict, textual_results_to_return, perform_textual_search):
+        '''
+        Add the results of a fitting subquery to the final result dict list.
+        Duplicates across subqueries are removed later on by write_info and get_images based on the post id.
+        In streaming mode the pages were already written by the metadata stream and nothing is kept.
+        '''
+        if result_dict is None:
+            return None
+        if self.metadata_stream is None:
+            for page in result_dict:
+                self.all_unique_ids.update(post['id'] for post in result_dict[page]['photos']['photo'])
             '''
-            If the execution reached this point, all the gathered unique ids of all subqueries will 
-            be used to produce one CSV file.
+            instead of id's we collect the result dict
             '''
-            print("#-" * 30)
-            print("[+] Successfully acquired all unique ids of subquery")
-            print(f"[*] Querying a total of {len(all_unique_ids)} ids and writing to csv file..")
-            self.flickrquerier_obj.write_info(final_result_dict_list)
+            self.final_result_dict_list.append(result_dict)
+            posts_collected = len(self.all_unique_ids)
+        else:
+            posts_collected = self.metadata_stream.posts_written()
+        if perform_textual_search:
+            if posts_collected > textual_results_to_return:
+                print(f'[*] textual search: {textual_results_to_return} posts fetched. Finishing search.')
+                self.textual_limit_reached = True
+
+    def split_timespan(self, bbox, lower_limit, upper_limit, pages, textual_results_to_return, perform_textual_search):
+        '''
+        Split a window that returned too many pages into sub windows. The amount of sub windows is estimated
+        from the returned pages (at least a bisection). Sub windows which still return too many pages are split
+        again recursively while the results of the fitting ones are kept.
+
+        calls_saved counts the api calls of fitting windows which would have been discarded and queried again
+        by restarting the whole timespan with smaller slices.
+
+        :param bbox:
+        :param lower_limit: min_upload_date of the overflowing window
+        :param upper_limit: max_upload_date of the overflowing window
+        :param pages: amount of pages the overflowing window returned
+        :return:
+        '''
+        if upper_limit - lower_limit < 2:
+            print(f"[!] CAUTION: timespan {lower_limit} - {upper_limit} can not be split further. Results may be incomplete.")
+            return None
+        self.split_stats['windows_split'] += 1
+        windows = FlickrFrame.timespan_parts(lower_limit, upper_limit, pages)
+        parts = len(windows)
+        kept_calls = 0
+        for part, (new_lower_limit, new_upper_limit) in enumerate(windows):
+            if self.textual_limit_reached:
+                break
             print("--" * 30)
-            print(f"[+] Acquiring metadata - done.")
+            print(f"[+] {part+1} of {parts}: Processing timespan {new_lower_limit} - {new_upper_limit}")
+            toomany_pages, result_dict, api_calls = self.query_subquery(bbox, new_lower_limit, new_upper_limit)
+
+            if toomany_pages[1]:
+                print('[!] CAUTION: Subquery still returned too many results.')
+                print('[*] Further splitting timespan...')
+                self.split_stats['calls_saved'] += kept_calls
+                kept_calls = 0
+                self.split_timespan(bbox, new_lower_limit, new_upper_limit, toomany_pages[0],
+                                    textual_results_to_return, perform_textual_search)
+            else:
+                kept_calls += api_calls
+                self.collect_subquery(result_dict, textual_results_to_return, perform_textual_search)
+
+    def split_bbox(self, bbox, lower_limit, upper_limit, pages, textual_results_to_return, perform_textual_search):
+        '''
+        Split a bounding box that returned too many pages into its four quadrants (quadtree).
+        Only the quadrants that still return too many pages are processed further:
+            - 'space': quadrants are split again until they are smaller than min_bbox_size
+            - 'hybrid': additionally quadrants whose pages did not decrease (a dense hotspot) are split by time
+        Quadrants which can not be split spatially anymore are split by timespan.
+
+        :param bbox: overflowing bounding box
+        :param lower_limit: min_upload_date of the query
+        :param upper_limit: max_upload_date of the query
+        :param pages: amount of pages the overflowing bounding box returned
+        :return:
+        '''
+        if not self.splittable_bbox(bbox):
+            print(f"[*] Bounding box {bbox[0]} reached the minimum size. Splitting by timespan...")
+            self.split_timespan(bbox, lower_limit, upper_limit, pages, textual_results_to_return, perform_textual_search)
+            return None
+        self.split_stats['bboxes_split'] += 1
+        kept_calls = 0
+        for index, quadrant_bbox in enumerate(FlickrFrame.quadrants(bbox), 1):
+            if self.textual_limit_reached:
+                break
             print("--" * 30)
-            if self.toget_images:
-                print(f"[*] Downloading images..")
-                self.flickrquerier_obj.get_images(final_result_dict_list)
-                print("\n")
-                print("--" * 30)
-                print(f"[+] Download images - done.")
-                print("--" * 30)
+            print(f"[+] Quadrant {index} of 4: Processing bounding box {quadrant_bbox[0]}")
+            toomany_pages, result_dict, api_calls = self.query_subquery(quadrant_bbox, lower_limit, upper_limit)
+
+            if toomany_pages[1]:
+                print('[!] CAUTION: Quadrant still returned too many results.')
+                self.split_stats['calls_saved'] += kept_calls
+                kept_calls = 0
+                quadrant_pages = toomany_pages[0]
+                if self.split_strategy == 'hybrid' and quadrant_pages >= pages:
+                    print('[*] Results are concentrated in this quadrant. Splitting by timespan...')
+                    self.split_timespan(quadrant_bbox, lower_limit, upper_limit, quadrant_pages,
+                                        textual_results_to_return, perform_textual_search)
+                else:
+                    print('[*] Further splitting bounding box...')
+                    self.split_bbox(quadrant_bbox, lower_limit, upper_limit, quadrant_pages,
+                                    textual_results_to_return, perform_textual_search)
+            else:
+                kept_calls += api_calls
+                self.collect_subquery(result_dict, textual_results_to_return, perform_textual_search)
+
+    def query_plan(self, plan, textual_results_to_return, perform_textual_search):
+        '''
+        Query the windows of a query plan. A window which returns more results than probed
+        (e.g. new uploads in the meantime) is split further by timespan.
+        '''
+        for index, (bbox, lower_limit, upper_limit, pages) in enumerate(plan, 1):
+            if self.textual_limit_reached:
+                break
             print("--" * 30)
-            print("[+] FlickrQuerier Class - done")
-            break
+            print(f"[+] Window {index} of {len(plan)}: Processing {bbox[0] if bbox is not None else 'textual search'} {lower_limit} - {upper_limit}")
+            toomany_pages, result_dict, api_calls = self.query_subquery(bbox, lower_limit, upper_limit)
+            if toomany_pages[1]:
+                print('[!] CAUTION: Window returned more results than planned. Further splitting timespan...')
+                self.split_timespan(bbox, lower_limit, upper_limit, toomany_pages[0], textual_results_to_return, perform_textual_search)
+            else:
+                self.collect_subquery(result_dict, textual_results_to_return, perform_textual_search)
+
+    def query_cover(self, cover, lower_limit, upper_limit, textual_results_to_return, perform_textual_search):
+        '''
+        Query the bounding boxes covering an area. A box which returns too many pages is split
+        by the split_strategy like a single bounding box.
+        '''
+        for index, bbox in enumerate(cover, 1):
+            if self.textual_limit_reached:
+                break
+            print("--" * 30)
+            print(f"[+] Box {index} of {len(cover)}: Processing bounding box {bbox[0]}")
+            toomany_pages, result_dict, api_calls = self.query_subquery(bbox, lower_limit, upper_limit)
+            if not toomany_pages[1]:
+                self.collect_subquery(result_dict, textual_results_to_return, perform_textual_search)
+            elif self.split_strategy != 'time':
+                self.split_bbox(bbox, lower_limit, upper_limit, toomany_pages[0], textual_results_to_return, perform_textual_search)
+            else:
+                self.split_timespan(bbox, lower_limit, upper_limit, toomany_pages[0], textual_results_to_return, perform_textual_search)
+
+    def probe_window(self, bbox, min_upload_date, max_upload_date):
+        '''
+        :return: amount of result pages of a window read by a count probe
+        '''
+        querier = self.new_flickrquerier(bbox, min_upload_date, max_upload_date, subquery_status=True, search=False)
+        pages = querier.probe_pages()
+        self.rate_limiter = querier.rate_limiter
+        self.plan_stats['probes'] += 1
+        self.plan_stats['api_calls'] += querier.api_calls
+        return pages
+
+    def plan_area(self, bbox, lower_limit, upper_limit, cover=None):
+        '''
+        Build the query plan of an area with count probes. The windows are partitioned the same way as by
+        split_timespan and split_bbox, but every window is only probed (one result, no extras) instead of
+        fetching its first full result page. Only the windows which fit into one query are part of the plan.
+
+        With a cover every bounding box of the cover is planned.
+
+        :return: list of (bbox, min_upload_date, max_upload_date, pages) windows
+        '''
+        self.plan_stats = {'probes': 0, 'api_calls': 0}
+        plan = []
+        for bbox in (cover if cover is not None else [bbox]):
+            pages = self.probe_window(bbox, lower_limit, upper_limit)
+            if pages <= FlickrFrame.max_window_pages:
+                plan.append((bbox, lower_limit, upper_limit, pages))
+            elif self.split_strategy != 'time' and bbox is not None:
+                self.plan_bbox(bbox, lower_limit, upper_limit, pages, plan)
+            else:
+                self.plan_timespan(bbox, lower_limit, upper_limit, pages, plan)
+        return plan
+
+    def plan_timespan(self, bbox, lower_limit, upper_limit, pages, plan):
+        if upper_limit - lower_limit < 2:
+            print(f"[!] CAUTION: timespan {lower_limit} - {upper_limit} can not be split further. Results may be incomplete.")
+            plan.append((bbox, lower_limit, upper_limit, pages))
+            return None
+        for new_lower_limit, new_upper_limit in FlickrFrame.timespan_parts(lower_limit, upper_limit, pages):
+            window_pages = self.probe_window(bbox, new_lower_limit, new_upper_limit)
+            if window_pages > FlickrFrame.max_window_pages:
+                self.plan_timespan(bbox, new_lower_limit, new_upper_limit, window_pages, plan)
+            else:
+                plan.append((bbox, new_lower_limit, new_upper_limit, window_pages))
+
+    def plan_bbox(self, bbox, lower_limit, upper_limit, pages, plan):
+        if not self.splittable_bbox(bbox):
+            self.plan_timespan(bbox, lower_limit, upper_limit, pages, plan)
+            return None
+        for quadrant_bbox in FlickrFrame.quadrants(bbox):
+            quadrant_pages = self.probe_window(quadrant_bbox, lower_limit, upper_limit)
+            if quadrant_pages <= FlickrFrame.max_window_pages:
+                plan.append((quadrant_bbox, lower_limit, upper_limit, quadrant_pages))
+            elif self.split_strategy == 'hybrid' and quadrant_pages >= pages:
+                # results are concentrated in this quadrant
+                self.plan_timespan(quadrant_bbox, lower_limit, upper_limit, quadrant_pages, plan)
+            else:
+                self.plan_bbox(quadrant_bbox, lower_limit, upper_limit, quadrant_pages, plan)
+
+    def print_plan(self, plan):
+        '''
+        Print the windows of a query plan, the estimated api calls to fetch them and the time under the rate limit
+        '''
+        calls = sum(max(1, pages) for bbox, lower_limit, upper_limit, pages in plan)
+        self.planned_calls += calls
+        # saved up tokens are spent at once, the remaining calls are paced by the rate limit
+        rate = self.rate_limiter.calls_per_hour / 3600
+        seconds = max(0, calls - self.rate_limiter.remaining()) / rate
+        print("##" * 30)
+        print(f"[*] Query plan of area {self.area_name}: {len(plan)} windows, planned with {self.plan_stats['probes']} probes "
+              f"({self.plan_stats['api_calls']} api calls)")
+        for bbox, lower_limit, upper_limit, pages in plan:
+            print(f"    {bbox[0] if bbox is not None else 'textual search'} | {lower_limit} - {upper_limit} | {pages} pages")
+        print(f"[*] Estimated api calls: {calls}, estimated time under the rate limit: {round(seconds / 60, 1)} min")
+        print("##" * 30)
+
+    @staticmethod
+    def timespan_parts(lower_limit, upper_limit, pages):
+        '''
+        Sub windows of an overflowing window. The amount is estimated from the returned pages (at least a bisection).
+
+        :return: list of (min_upload_date, max_upload_date)
+        '''
+        parts = max(2, math.ceil(pages / FlickrFrame.max_window_pages))
+        parts = min(parts, upper_limit - lower_limit)
+        step = (upper_limit - lower_limit) / parts
+        return [(lower_limit + int(round(step * part)), lower_limit + int(round(step * (part + 1)))) for part in range(parts)]
+
+    @staticmethod
+    def quadrants(bbox):
+        '''
+        :return: the four quadrants of a bounding box as bbox lists
+        '''
+        min_x, min_y, max_x, max_y = FlickrFrame.parse_bbox(bbox)
+        mid_x = (min_x + max_x) / 2
+        mid_y = (min_y + max_y) / 2
+        return [FlickrFrame.format_bbox(min_x, min_y, mid_x, mid_y),
+                FlickrFrame.format_bbox(mid_x, min_y, max_x, mid_y),
+                FlickrFrame.format_bbox(min_x, mid_y, mid_x, max_y),
+                FlickrFrame.format_bbox(mid_x, mid_y, max_x, max_y)]
+
+    def splittable_bbox(self, bbox):
+        min_x, min_y, max_x, max_y = FlickrFrame.parse_bbox(bbox)
+        return (max_x - min_x) >= self.min_bbox_size and (max_y - min_y) >= self.min_bbox_size
+
+    @staticmethod
+    def parse_bbox(bbox):
+        '''
+        Convert a flickr bbox (list containing 1 comma separated string) into its float coordinates
+
+        :param bbox: e.g. ['9.413564,47.282421,9.415497,47.285627']
+        :return: min_x, min_y, max_x, max_y
+        '''
+        return [float(coordinate) for coordinate in bbox[0].split(',')]
+
+    @staticmethod
+    def format_bbox(min_x, min_y, max_x, max_y):
+        '''
+        Convert coordinates of the lower left and upper right corner into the flickr bbox format
+
+        :return: e.g. ['9.413564,47.282421,9.415497,47.285627']
+        '''
+        return [f"{min_x:.6f},{min_y:.6f},{max_x:.6f},{max_y:.6f}"]
 
     def geojson_to_bbox(self, file_):
         '''
-        Create flickr query bounding boxes
-        from the first [0] and third [2] element in a geojson file
+        Create flickr query bounding boxes from the (Multi)Polygons of a geojson file: the envelope of every feature
+        and with cover_boxes > 1 a cover of up to cover_boxes tight bounding boxes (None if the envelope is kept)
 
         flickr bbox format: e.g. ['9.413564,47.282421,9.415497,47.285627']
         (list with containing 1 string with comma separated coordinates of the lower left and opper right corner)
@@ -186,14 +629,20 @@ class FlickrFrame:
 
         for feature in data['features']:
             bbox_data = {'bbox': None,
-                         'name': None}
+                         'name': None,
+                         'geometry': feature['geometry'],
+                         'cover': None}
 
-            coordinates = feature['geometry']['coordinates'][0]
             name = feature['properties']['Name']
-            # need element 0 nad 2
-            lowerleft = coordinates[0]
-            upperright = coordinates[2]
-            bbox = [f"{lowerleft[0]},{lowerleft[1]},{upperright[0]},{upperright[1]}"]
+            bbox = FlickrFrame.format_bbox(*outward(envelope(feature['geometry'])))
+            if self.cover_boxes > 1:
+                cover = [FlickrFrame.format_bbox(*bounds) for bounds in
+                         BoxCover(feature['geometry'], max_boxes=self.cover_boxes, min_fill=self.cover_fill).boxes()]
+                print(f"[*] Area {name}: covered by {len(cover)} bounding boxes")
+                if len(cover) == 1:
+                    bbox = cover[0]
+                else:
+                    bbox_data['cover'] = cover
             bbox_data['bbox'] = bbox
             bbox_data['name'] = name
             bbox_list.append(bbox_data)
@@ -202,55 +651,302 @@ class FlickrFrame:
     ############################################################################################
     ############################################################################################
 
+    def area_timespan(self):
+        '''
+        define timespan (if none for max defined as the unixtimestamp of right now and min as the start of flickr)
+
+        :return: min_upload_date, max_upload_date
+        '''
+        if self.max_upload_date is None:
+            upper_limit_timespan = int(time())
+        else:
+            upper_limit_timespan = self.max_upload_date
+
+        if self.min_upload_date is None:
+            lower_limit_timespan = FlickrFrame.flickr_start_date
+        else:
+            lower_limit_timespan = self.min_upload_date
+        return lower_limit_timespan, upper_limit_timespan
+
+    def query_signature(self, bbox, upload_dates=False):
+        '''
+        :param upload_dates: include min_upload_date and max_upload_date as supplied (None: open end)
+        :return: short hash of the query parameters except the upload dates, watermarks and delta outputs are kept per signature
+        '''
+        query = [bbox, self.text_search, self.tags, self.tag_mode, self.has_geo, self.accuracy, self.allowed_licenses]
+        if upload_dates:
+            query += [self.min_upload_date, self.max_upload_date]
+        return hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+
+    def delta_timespan(self):
+        '''
+        :return: upload timespan of a delta harvest of the current area: from the watermark of the last finished
+        harvest (or min_upload_date if there is none) until max_upload_date
+        '''
+        lower_limit_timespan, upper_limit_timespan = self.area_timespan()
+        watermark = self.checkpoint.watermark(self.area_name, self.delta_signature)
+        if watermark is not None:
+            print(f"[*] Delta harvest of area {self.area_name}: posts uploaded since {datetime.datetime.fromtimestamp(watermark)}")
+            lower_limit_timespan = max(lower_limit_timespan, watermark)
+        return lower_limit_timespan, upper_limit_timespan
+
+    def process_area(self, bbox, cover=None):
+        '''
+        Query one area (bbox or textual search, optionally covered by several bounding boxes). If the area was interrupted in an earlier run,
+        its timespan and all finished windows are taken from the checkpoint store.
+        With plan_queries the area is partitioned by count probes first, with dry_run only the plan is printed.
+        With delta only the posts uploaded since the last finished harvest of the area are queried.
+        '''
+        if self.delta:
+            self.delta_signature = self.query_signature(bbox)
+            timespan = self.delta_timespan()
+        else:
+            timespan = self.area_timespan()
+        if self.dry_run:
+            self.print_plan(self.plan_area(bbox, *timespan, cover=cover))
+            return None
+        self.download_future = None
+        if self.delta:
+            if timespan[0] >= timespan[1]:
+                print(f"[*] Area {self.area_name} is up to date.")
+                return None
+            # an area finished by an earlier harvest starts over with the delta timespan, an interrupted one keeps its timespan
+            self.checkpoint.restart_area(self.area_name)
+        lower_limit_timespan, upper_limit_timespan = self.checkpoint.start_area(self.area_name, *timespan)
+        self.metadata_stream = None
+        if self.streaming:
+            self.open_stream(bbox, lower_limit_timespan, upper_limit_timespan)
+        window = self.checkpoint.window(self.area_name, bbox, lower_limit_timespan, upper_limit_timespan)
+        if window is not None and window[0] == 'split':
+            print(f"[*] Resuming area {self.area_name} from checkpoints...")
+            self.high_data_volume_handler(bbox, window[1], self.textual_results_to_return, self.perform_textual_search,
+                                          lower_limit_timespan, upper_limit_timespan)
+        elif self.plan_queries:
+            plan = self.plan_area(bbox, lower_limit_timespan, upper_limit_timespan, cover=cover)
+            self.print_plan(plan)
+            if len(plan) == 1 and plan[0][1:3] == (lower_limit_timespan, upper_limit_timespan) and plan[0][0] == bbox:
+                # the whole area fits into one query
+                self.query_area(bbox, lower_limit_timespan, upper_limit_timespan)
+            else:
+                # no split checkpoint of the area: a resumed run plans again and takes the finished windows from the checkpoints
+                self.high_data_volume_handler(bbox, None, self.textual_results_to_return, self.perform_textual_search,
+                                              lower_limit_timespan, upper_limit_timespan, plan=plan)
+        elif cover is not None:
+            self.high_data_volume_handler(bbox, None, self.textual_results_to_return, self.perform_textual_search,
+                                          lower_limit_timespan, upper_limit_timespan, cover=cover)
+        else:
+            self.query_area(bbox, lower_limit_timespan, upper_limit_timespan)
+        if self.metadata_stream is not None:
+            self.close_stream()
+        if self.area_filter is not None:
+            print(f"[*] Polygon filter of area {self.area_name}: removed {self.area_filter.posts_removed} "
+                  f"of {self.area_filter.posts_tested} posts outside the area.")
+        self.finish_area(upper_limit_timespan)
+
+    def finish_area(self, upper_limit_timespan):
+        '''
+        Mark the current area as done in the checkpoint store (and move its watermark for delta harvests).
+        If its images are downloaded in the background, the area is marked once the download succeeded,
+        so an interrupted download is repeated by the next run. The metrics are exported after every area.
+        Offline runs (cache_only) do not mark the area, the next online run queries the cache misses.
+        '''
+        if self.cache_only:
+            get_metrics().export()
+            return None
+        area_name = self.area_name
+        signature = self.delta_signature
+        if self.download_future is None:
+            self.checkpoint.finish_area(area_name)
+            if signature is not None:
+                self.checkpoint.set_watermark(area_name, signature, upper_limit_timespan)
+            get_metrics().export()
+            return None
+
+        def finish(future):
+            if future.exception() is not None:
+                print(f"\n[-] Image download of area {area_name} failed: {future.exception()}")
+            else:
+                print(f"\n[+] Download images of area {area_name} - done.")
+                self.checkpoint.finish_area(area_name)
+                if signature is not None:
+                    self.checkpoint.set_watermark(area_name, signature, upper_limit_timespan)
+            get_metrics().export()
+        self.download_future.add_done_callback(finish)
+
+    def process_areas(self, areas):
+        '''
+        Process the GeoJSON areas with a pool of area_workers threads. Every area is processed by a copy of
+        this FlickrFrame, the checkpoint store, search cache and the rate limit of the api key are shared.
+        Image downloads run one area after another on a separate download thread, so the metadata of the
+        next areas is queried while the images of the previous ones are downloaded.
+        '''
+        if self.toget_images and not self.dry_run:
+            self.download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.area_workers) as executor:
+                futures = [executor.submit(self.process_area_copy, bbox_data) for bbox_data in areas]
+                for future in concurrent.futures.as_completed(futures):
+                    frame = future.result()
+                    self.planned_calls += frame.planned_calls
+                    if hasattr(frame, 'rate_limiter'):
+                        self.rate_limiter = frame.rate_limiter
+        finally:
+            if self.download_executor is not None:
+                print("[*] Waiting for the image downloads to finish...")
+                self.download_executor.shutdown(wait=True)
+                self.download_executor = None
+
+    def process_area_copy(self, bbox_data):
+        '''
+        :return: the copy of this FlickrFrame which processed the area
+        '''
+        frame = copy.copy(self)
+        frame.area_name = bbox_data['name']
+        frame.planned_calls = 0
+        if self.filter_polygons:
+            frame.area_filter = AreaFilter(bbox_data['geometry'])
+        '''
+        only break out of this loop if less then 15 pages are returned either from the initial
+        FlickrQuerier or the following sub-queries of the big_box_handler function.
+        '''
+        print("**" * 30)
+        print(f"[*] Processing new area: {frame.area_name}")
+        print("**" * 30)
+        frame.process_area(bbox_data['bbox'], cover=bbox_data['cover'])
+        return frame
+
+    def query_area(self, bbox, lower_limit_timespan, upper_limit_timespan):
+        '''
+        Query the whole timespan of an area and split it if it returns too many pages
+        '''
+        self.flickrquerier_obj = self.new_flickrquerier(bbox, lower_limit_timespan, upper_limit_timespan, subquery_status=False)
+        # set if the whole area fitted into one query and its images are downloaded in the background
+        self.download_future = self.flickrquerier_obj.download_future
+        '''
+        Check if flickr_obj.toomany_pages is True 
+        which means sub-queries with smaller timespan need to be initiated
+        '''
+        if self.flickrquerier_obj.toomany_pages[1]:
+            if not self.cache_only:
+                self.checkpoint.save_split(self.area_name, bbox, lower_limit_timespan, upper_limit_timespan, self.flickrquerier_obj.toomany_pages[0])
+            self.high_data_volume_handler(bbox, self.flickrquerier_obj.toomany_pages[0], self.textual_results_to_return, self.perform_textual_search,
+                                          lower_limit_timespan, upper_limit_timespan)
+
+    def open_stream(self, bbox, min_upload_date, max_upload_date):
+        '''
+        Open the metadata stream of the current area. An output file started by an interrupted run is continued.
+        '''
+        # a FlickrQuerier without search provides the output paths, the image urls and the downloads
+        self.output_querier = self.new_flickrquerier(bbox, min_upload_date, max_upload_date, subquery_status=True, search=False)
+        output_path = self.checkpoint.output_path(self.area_name)
+        append = output_path is not None
+        if not append:
+            output_path = self.output_querier.output_path()
+            self.checkpoint.set_output_path(self.area_name, output_path)
+            # a delta harvest merges into the output file of the earlier harvests
+            append = self.delta_signature is not None and os.path.exists(output_path)
+        else:
+            print(f"[*] Continuing output file of an earlier run: {output_path}")
+        task_path = None
+        if self.toget_images:
+            task_path = os.path.join(self.project_path, f'image_tasks_{self.area_name}.tsv')
+        image_size_key = FlickrQuerier.image_size_dict[self.image_size]
+        self.metadata_stream = MetadataStream(output_path, task_path=task_path,
+                                              image_url=lambda post: self.output_querier.image_url(post, image_size_key),
+                                              append=append, output_format=self.output_format)
+        if self.metadata_stream.incomplete:
+            # the windows written to the lost output file have to be queried again
+            self.checkpoint.reset_windows(self.area_name)
+
+    def close_stream(self):
+        '''
+        Close the metadata stream of the current area and download the images of its task file
+        '''
+        self.metadata_stream.close()
+        print(f"\nCreated output file: {self.metadata_stream.output_path}")
+        print("--" * 30)
+        print(f"[+] Acquiring metadata - done.")
+        print("--" * 30)
+        if self.toget_images:
+            print(f"[*] Downloading images..")
+            task_path = self.metadata_stream.task_path
+            self.download_future = self.output_querier.download_tasks(self.metadata_stream.read_tasks(), self.metadata_stream.tasks_total(),
+                                                                      after=lambda: os.remove(task_path))
+            self.print_download_status()
+        self.metadata_stream = None
+
+    def fetch_dead_letters(self):
+        '''
+        Fetch the dead letters of earlier runs again. The result pages given up are queried again and written to a
+        separate output file per area (metadata_AREA_dead_letters_...), the images whose download was given up are
+        downloaded again. Dead letters which fail again are kept.
+        '''
+        dead_letters = self.checkpoint.dead_letters()
+        print("--" * 30)
+        print(f"[*] Fetching {len(dead_letters)} dead letter result pages again...")
+        for area_name, bbox, min_upload_date, max_upload_date, page, error_class, error in dead_letters:
+            print(f"[*] Area {area_name}, page {page} of the window {bbox} {min_upload_date}-{max_upload_date} (given up: {error_class} {error})")
+            self.area_name = area_name
+            refetch_querier = self.new_flickrquerier(bbox, min_upload_date, max_upload_date, subquery_status=True, search=False)
+            result_dict = refetch_querier.refetch_page(page)
+            if result_dict is not None:
+                self.checkpoint.remove_dead_letter(area_name, bbox, min_upload_date, max_upload_date, page)
+            self.save_dead_letters(refetch_querier, bbox, min_upload_date, max_upload_date)
+            if result_dict is None:
+                continue
+            refetch_querier.area_name = f'{area_name}_dead_letters'
+            refetch_querier.write_info([result_dict])
+            if self.toget_images:
+                refetch_querier.get_images([result_dict], image_size=self.image_size)
+        manifest_path = os.path.join(self.project_path, f'images_{self.project_name}', 'manifest.sqlite')
+        if os.path.exists(manifest_path):
+            manifest = DownloadManifest(manifest_path)
+            tasks = manifest.failed_tasks()
+            manifest.close()
+            if tasks:
+                print(f"[*] Downloading {len(tasks)} images given up by earlier runs again...")
+                self.area_name = self.project_name
+                self.new_flickrquerier(self.bbox, None, None, subquery_status=True, search=False).run_download_tasks(tasks, len(tasks))
+        print("--" * 30)
+
+    def remove_timestamped_areas(self):
+        '''
+        Remove the interrupted areas of earlier versions, which named single bbox and textual queries by their start
+        time (project_name_MM_DD_HH_MM_SS) and could therefore never be resumed
+        '''
+        pattern = re.escape(self.project_name) + r'_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}'
+        for area_name in self.checkpoint.running_areas():
+            if re.fullmatch(pattern, area_name):
+                print(f"[*] Removing checkpoints of the interrupted area {area_name} of an earlier version...")
+                self.checkpoint.remove_area(area_name)
+
     def body(self):
         #check if project directory exists
-        if not os.path.isdir(os.path.join(os.path.dirname(os.path.realpath(__file__)), self.project_name)):
+        if not os.path.isdir(self.project_path):
             print('[*] Creating project folder...')
-            os.mkdir(os.path.join(os.path.dirname(os.path.realpath(__file__)), self.project_name))
+            os.mkdir(self.project_path)
+        # checkpoints of finished areas and windows to resume interrupted runs
+        self.checkpoint = CheckpointStore(os.path.join(self.project_path, 'checkpoints.sqlite'))
+        if not self.resume:
+            self.checkpoint.reset()
+        if self.refetch_dead_letters and not self.dry_run:
+            self.fetch_dead_letters()
         #check of geojson has to be parsed
         if self.geojson_file is not None:
             print("[*] Parsing GeoJson file. Extracting contained bounding boxes...")
+            areas = []
             for bbox_data in self.geojson_to_bbox(self.geojson_file):
-                self.area_name = bbox_data['name']
-                if self.area_name not in already_processed:
-                    '''
-                    only break out of this loop if less then 15 pages are returned either from the initial
-                    FlickrQuerier or the following sub-queries of the big_box_handler function.
-                    '''
-                    print("**" * 30)
-                    print(f"[*] Processing new area: {self.area_name}")
-                    print("**" * 30)
-                    self.flickrquerier_obj = FlickrQuerier(self.project_name,
-                                               self.area_name,
-                                               bbox=bbox_data['bbox'],
-                                               text_search=self.text_search,
-                                               tags=self.tags,
-                                               tag_mode=self.tag_mode,
-                                               has_geo=self.has_geo,
-                                               textual_results_to_return=self.textual_results_to_return,
-                                               perform_textual_search=self.perform_textual_search,
-                                               min_upload_date=self.min_upload_date,
-                                               max_upload_date=self.max_upload_date,
-                                               accuracy=self.accuracy,
-                                               toget_images=self.toget_images,
-                                               image_size=self.image_size,
-                                               api_creds_file=self.api_credentials_path,
-                                               allowed_licenses=self.allowed_licenses,
-                                               subquery_status=False)
-                    '''
-                    Check if flickr_obj.toomany_pages is True 
-                    which means sub-queries with smaller timespan need to be initiated
-                    '''
-                    if self.flickrquerier_obj.toomany_pages[1]:
-                        self.high_data_volume_handler(bbox_data['bbox'], self.flickrquerier_obj.toomany_pages[0])
-
+                # with delta harvests done areas are queried again for the posts uploaded since
+                if bbox_data['name'] not in already_processed and (self.delta or not self.checkpoint.area_done(bbox_data['name'])):
+                    areas.append(bbox_data)
                 else:
                     print("##" * 30)
-                    print(f"[!] Already processed area: {self.area_name}")
+                    print(f"[!] Already processed area: {bbox_data['name']}")
                     print("##" * 30)
+            self.process_areas(areas)
 
         #else query the single bounding box
-        elif self.bbox is not None or self.text_search is not None:
+        elif self.bbox is not None or self.text_search is not None or self.tags is not None:
             if self.bbox is not None:
                 print("[*] Parsing single bounding box...")
             if self.text_search is not None:
@@ -258,32 +954,28 @@ class FlickrFrame:
             if self.tags is not None:
                 print("[*] Performing textual search by tags..")
 
-            self.area_name = '{}_{:%m_%d_%H_%M_%S}'.format(self.project_name, datetime.datetime.now())
-
-            self.flickrquerier_obj = FlickrQuerier(self.project_name,
-                                       self.area_name,
-                                       bbox=self.bbox,
-                                       text_search=self.text_search,
-                                       tags=self.tags,
-                                       tag_mode=self.tag_mode,
-                                       has_geo=self.has_geo,
-                                       textual_results_to_return=self.textual_results_to_return,
-                                       perform_textual_search=self.perform_textual_search,
-                                       min_upload_date=self.min_upload_date,
-                                       max_upload_date=self.max_upload_date,
-                                       accuracy=self.accuracy,
-                                       toget_images=self.toget_images,
-                                       image_size=self.image_size,
-                                       api_creds_file=self.api_credentials_path,
-                                       allowed_licenses=self.allowed_licenses,
-                                       subquery_status=False)
-
-            '''
-            Check if flickr_obj.toomany_pages is True 
-            which means sub-queries with smaller timespan need to be initiated
-            '''
-            if self.flickrquerier_obj.toomany_pages[1]:
-                self.high_data_volume_handler(self.flickrquerier_obj.toomany_pages[0], self.textual_results_to_return, self.perform_textual_search)
+            if self.delta:
+                # the watermark and output file of the query have to be found again by the next harvest
+                self.area_name = self.project_name
+            else:
+                # named by the query, so a restarted run continues an interrupted area while a finished one starts over
+                self.area_name = f'{self.project_name}_{self.query_signature(self.bbox, upload_dates=True)}'
+                self.remove_timestamped_areas()
+                if not self.dry_run:
+                    self.checkpoint.restart_area(self.area_name)
+            self.process_area(self.bbox)
+        if self.dry_run and self.planned_calls:
+            seconds = max(0, self.planned_calls - self.rate_limiter.remaining()) / (self.rate_limiter.calls_per_hour / 3600)
+            print(f"[*] Dry run - done. Estimated api calls of all areas: {self.planned_calls}, "
+                  f"estimated time under the rate limit: {round(seconds / 60, 1)} min")
+        credential_pool = get_credential_pool(self.api_credentials_path, calls_per_hour=self.calls_per_hour, burst=self.burst)
+        if len(credential_pool.credentials) > 1:
+            print(f"[*] api key usage: {credential_pool.usage()}")
+        if self.metrics_path is not None:
+            print(f"[*] metrics: {get_metrics().summary()}")
+            print(f"[*] Metrics written to {self.metrics_path}")
+            configure_metrics()
+        self.checkpoint.close()
 
 ##########################################################################################
 if __name__ == '__main__':
@@ -319,4 +1011,5 @@ if __name__ == '__main__':
                             min_upload_date=None, #None
                             max_upload_date=None, #None,
                             toget_images=True,
-                            image_size='medium') # 'small', 'medium', 'large', 'original'
\ No newline at end of file
+                            image_size='medium', # 'small', 'medium', 'large', 'original'
+                            split_strategy='time') # 'time', 'space', 'hybrid'
\ No newline at end of file
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+class NullMetrics:
+    '''
+    Metrics sink used while no metrics output is configured. Every method does nothing, so the instrumented code
+    only pays for a method call. Code that has to compute a value first (e.g. a queue size) checks enabled.
+    '''
+    enabled = False
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return contextlib.nullcontext()
+
+    def trace(self, event, **fields):
+        pass
+
+    def export(self):
+        pass
+
+    def summary(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class HarvestMetrics:
+    '''
+    Process wide metrics of a harvest: counters, observations (count, sum and max, e.g. latencies in seconds) and
+    gauges (last and max value, e.g. queue depths), each with optional labels. All threads record into one instance.
+
+    export_format:
+        jsonl: every traced event (e.g. an api call with its latency) is appended to the output file as one json line
+            as it happens, export appends a snapshot of all metrics
+        prometheus: export rewrites the output file with all metrics in the Prometheus text format
+            (e.g. for the textfile collector of the node exporter), events are not traced
+    '''
+    def __init__(self, path, export_format='jsonl'):
+        self.path = path
+        self.export_format = export_format
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (name, labels): value / [count, sum, max] / [last, max]
+        self.counters = {}
+        self.observations = {}
+        self.gauges = {}
+        self.trace_file = None
+        if export_format == 'jsonl':
+            # opened once for the whole run, events are written through the buffer of the file
+            self.trace_file = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        key = HarvestMetrics.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = HarvestMetrics.key(name, labels)
+        with self.lock:
+            observation = self.observations.get(key)
+            if observation is None:
+                self.observations[key] = [1, value, value]
+            else:
+                observation[0] += 1
+                observation[1] += value
+                observation[2] = max(observation[2], value)
+
+    def gauge(self, name, value, **labels):
+        key = HarvestMetrics.key(name, labels)
+        with self.lock:
+            gauge = self.gauges.get(key)
+            if gauge is None:
+                self.gauges[key] = [value, value]
+            else:
+                gauge[0] = value
+                gauge[1] = max(gauge[1], value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''
+        Observe the seconds spent in the with block
+        '''
+        start = time.perf_counter()
+        try:
+            yield None
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def trace(self, event, **fields):
+        if self.trace_file is None:
+            return None
+        line = json.dumps({'ts': round(time.time(), 6), 'thread': threading.current_thread().name, 'event': event, **fields}, default=str)
+        with self.lock:
+            self.trace_file.write(line + '\n')
+
+    def total(self, name):
+        '''
+        :return: sum of a counter (or of the sums of an observation) over all its labels
+        '''
+        with self.lock:
+            total = sum(value for (key_name, labels), value in self.counters.items() if key_name == name)
+            total += sum(observation[1] for (key_name, labels), observation in self.observations.items() if key_name == name)
+        return total
+
+    def derived(self):
+        '''
+        :return: metrics computed from the recorded ones
+        '''
+        seen = self.total('posts_seen_total')
+        return {'dedup_hit_rate': self.total('posts_duplicate_total') / seen if seen else 0.0,
+                'run_seconds': time.time() - self.started}
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()]
+            observations = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'max': maximum}
+                            for (name, labels), (count, total, maximum) in self.observations.items()]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': last, 'max': maximum}
+                      for (name, labels), (last, maximum) in self.gauges.items()]
+        return {'counters': counters, 'observations': observations, 'gauges': gauges, 'derived': self.derived()}
+
+    @staticmethod
+    def prometheus_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        # metric family: (type, samples), the samples of a family have to follow its TYPE line
+        families = {}
+
+        def add(name, kind, labels, value):
+            families.setdefault(name, (kind, []))[1].append(f'flickrframe_{name}{HarvestMetrics.prometheus_labels(labels)} {value}')
+        for counter in snapshot['counters']:
+            add(counter['name'], 'counter', counter['labels'], counter['value'])
+        for observation in snapshot['observations']:
+            add(f"{observation['name']}_count", 'counter', observation['labels'], observation['count'])
+            add(f"{observation['name']}_sum", 'counter', observation['labels'], observation['sum'])
+            add(f"{observation['name']}_max", 'gauge', observation['labels'], observation['max'])
+        for gauge in snapshot['gauges']:
+            add(gauge['name'], 'gauge', gauge['labels'], gauge['value'])
+            add(f"{gauge['name']}_max", 'gauge', gauge['labels'], gauge['max'])
+        for name, value in snapshot['derived'].items():
+            add(name, 'gauge', {}, value)
+        lines = []
+        for name in sorted(families):
+            kind, samples = families[name]
+            lines.append(f'# TYPE flickrframe_{name} {kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        '''
+        Write the current state of all metrics to the output file
+        '''
+        if self.export_format == 'prometheus':
+            # written to a temporary file first, so a collector never reads a half written file
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(self.prometheus_text())
+            os.replace(self.path + '.tmp', self.path)
+            return None
+        line = json.dumps({'ts': round(time.time(), 6), 'event': 'snapshot', **self.snapshot()}, default=str)
+        with self.lock:
+            self.trace_file.write(line + '\n')
+            self.trace_file.flush()
+
+    def summary(self):
+        '''
+        :return: where the time of the run went: waiting for the rate limit, api calls, retry sleeps,
+                 writing the output and downloading images (seconds summed over all threads)
+        '''
+        return {'api_calls': int(self.total('api_calls_total')),
+                'rate_limit_wait_s': round(self.total('rate_limit_wait_seconds'), 1),
+                'api_call_s': round(self.total('api_call_seconds'), 1),
+                'retry_sleep_s': round(self.total('retry_sleep_seconds'), 1),
+                'write_s': round(self.total('write_seconds'), 1),
+                'download_s': round(self.total('image_download_seconds'), 1),
+                'bytes_downloaded': int(self.total('image_bytes_total')),
+                'dedup_hit_rate': round(self.derived()['dedup_hit_rate'], 3)}
+
+    def close(self):
+        self.export()
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+# metrics of the process, NullMetrics until configure_metrics is called
+_metrics = NullMetrics()
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    '''
+    Return the metrics shared by all FlickrQuerier objects, writers and downloaders (and threads) of this process.
+    '''
+    return _metrics
+
+def configure_metrics(path=None, export_format='jsonl'):
+    '''
+    (Re)create the metrics of the process. Without path the metrics are turned off.
+    '''
+    global _metrics
+    with _metrics_lock:
+        _metrics.close()
+        _metrics = HarvestMetrics(path, export_format) if path is not None else NullMetrics()
+        return _metrics
@@ -0,0 +1,366 @@
+import os
+import re
+import time
+import hashlib
+import queue
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from harvest_metrics import get_metrics
+from retry_policy import get_retry_policy
+# aiohttp is only needed for the optional asyncio download engine
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+def resume_part(part_path, offset, status_code, content_range=None):
+    '''
+    Decide how to continue a partial download after the response status is known.
+    Only a 206 (partial content) response whose Content-Range starts at the offset is appended to the existing
+    '.part' file, otherwise the server sent the whole resource and the file is written from the start.
+
+    :return: file mode, md5 checksum object (already fed with the existing part) and the offset,
+             None for a 206 response of another range (the part has to be removed and the image downloaded again)
+    '''
+    checksum = hashlib.md5()
+    if offset and status_code == 206:
+        match = re.match(r'bytes (\d+)-', content_range or '')
+        if match is None or int(match.group(1)) != offset:
+            return None
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                checksum.update(chunk)
+        return 'ab', checksum, offset
+    return 'wb', checksum, 0
+
+
+class PooledDownloader:
+    '''
+    Download backend for FlickrQuerier.get_images.
+
+    All downloads share one requests session with a pool of keep-alive connections per host
+    (the flickr static hosts e.g. live.staticflickr.com), so the TCP/TLS handshake is only done once per connection
+    instead of once per image. The response bodies are streamed to disk in chunks and are never held in memory.
+    '''
+    def __init__(self, pool_size=10, chunk_size=64 * 1024, timeout=30, verify_ssl=False):
+        '''
+        :param pool_size: connections kept alive per host, should match the amount of download workers
+        :param chunk_size: bytes written to disk at once
+        :param timeout: connect and read timeout in seconds
+        :param verify_ssl: the previous urllib path did not verify certificates, kept as default
+        '''
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify_ssl
+        if not verify_ssl:
+            requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def download(self, url, file_path):
+        '''
+        Stream the resource at url into file_path. The body is written into a temporary '.part' file
+        first which is renamed once complete, so an interrupted download never leaves a truncated image.
+        An existing '.part' file of an earlier run is resumed with an HTTP Range request if the server supports it.
+
+        :return: bytes transferred, file size and md5 checksum of the file
+        '''
+        part_path = file_path + '.part'
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        bytes_written = 0
+        with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as response:
+            if response.status_code == 416:
+                # range not satisfiable, the partial file does not match the resource anymore
+                os.remove(part_path)
+                return self.download(url, file_path)
+            response.raise_for_status()
+            resumed = resume_part(part_path, offset, response.status_code, response.headers.get('Content-Range'))
+            if resumed is None:
+                print(f"\n[!] Range response does not continue {os.path.basename(part_path)}. Downloading it again...")
+                os.remove(part_path)
+                return self.download(url, file_path)
+            mode, checksum, offset = resumed
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    bytes_written += len(chunk)
+        os.replace(part_path, file_path)
+        return bytes_written, offset + bytes_written, checksum.hexdigest()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DownloadQueue:
+    '''
+    Shared work queue for image downloads.
+
+    All (img_id, img_url, size_key) tasks are put into one queue and idle workers pull the next task from it, so a worker
+    that is stuck with large originals or retries does not hold back the others. The run finishes when the queue
+    is empty and the last download is done. The queue is bounded and filled from the tasks iterable by a producer
+    thread, so the tasks can be streamed (e.g. from a task file) without holding them in memory.
+
+    The amount of workers starts at workers and is increased step by step up to max_workers as long as the
+    measured throughput (bytes/s) still grows by at least min_gain.
+    Failed downloads are retried by the retry policy of the images (see retry_policy): permanent errors (e.g. 404)
+    are not retried, throttled and transient errors with exponential backoff within the retry budget of the run.
+    '''
+    def __init__(self, downloader, workers=10, max_workers=None, adjust_interval=10, min_gain=0.1, retry_policy=None, manifest=None):
+        self.downloader = downloader
+        # optional DownloadManifest which records every finished or failed download
+        self.manifest = manifest
+        self.workers = workers
+        self.max_workers = max_workers if max_workers is not None else workers
+        self.adjust_interval = adjust_interval
+        self.min_gain = min_gain
+        self.retry_policy = retry_policy if retry_policy is not None else get_retry_policy('images')
+        self.tasks = queue.Queue(maxsize=self.max_workers * 50)
+        self.producer_done = threading.Event()
+        # exception raised by the tasks iterable, passed on to the caller of run
+        self.producer_error = None
+        self.lock = threading.Lock()
+        self.images_downloaded = 0
+        self.bytes_downloaded = 0
+        self.failed = []
+        self.threads = []
+        self.metrics = get_metrics()
+
+    def worker(self, image_path, tasks_total):
+        while True:
+            try:
+                img_id, img_url, size_key = self.tasks.get(timeout=0.5)
+            except queue.Empty:
+                if self.producer_done.is_set() and self.tasks.empty():
+                    return None
+                continue
+            if self.metrics.enabled:
+                self.metrics.gauge('download_queue_depth', self.tasks.qsize())
+            tries = 0
+            while True:
+                try:
+                    tries += 1
+                    start = time.perf_counter()
+                    bytes_written, file_size, checksum = self.downloader.download(img_url, os.path.join(image_path, f"{img_id}.jpg"))
+                    self.metrics.observe('image_download_seconds', time.perf_counter() - start, engine='threads')
+                    self.metrics.count('image_bytes_total', bytes_written)
+                    self.metrics.count('images_total', outcome='done')
+                    if self.manifest is not None:
+                        self.manifest.mark_done(img_id, size_key, img_url, file_size, checksum)
+                    with self.lock:
+                        self.images_downloaded += 1
+                        self.bytes_downloaded += bytes_written
+                        print(f"\r[+] {len(self.threads)} WORKERS: retrieved {self.images_downloaded} of {tasks_total} images", end='')
+                    break
+                except Exception as e:
+                    error_class, delay = self.retry_policy.decide(e, tries)
+                    print(f"\n[-] Image error ({error_class}, try {tries}): {e}")
+                    if delay is not None:
+                        print(f"[*] Sleeping {round(delay, 1)}s...")
+                        time.sleep(delay)
+                        continue
+                    else:
+                        self.metrics.count('images_total', outcome='failed')
+                        if self.manifest is not None:
+                            self.manifest.mark_failed(img_id, size_key, img_url)
+                        with self.lock:
+                            self.failed.append((img_id, img_url, size_key))
+                        break
+
+    def add_workers(self, amount, image_path, tasks_total):
+        for _ in range(amount):
+            thread = threading.Thread(target=self.worker, args=(image_path, tasks_total), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def produce(self, tasks):
+        try:
+            for task in tasks:
+                self.tasks.put(task)
+        except Exception as e:
+            self.producer_error = e
+        finally:
+            # the workers finish the queued tasks and stop, also if the tasks could not be read completely
+            self.producer_done.set()
+
+    def run(self, tasks, image_path, tasks_total=None):
+        '''
+        Download all tasks into image_path
+
+        :param tasks: list or iterable of (img_id, img_url, size_key) tuples
+        :param tasks_total: amount of tasks (for the progress output) if tasks is not a list
+        :return: amount of images downloaded
+        :raise: the exception of the tasks iterable if it failed
+        '''
+        if tasks_total is None:
+            tasks_total = len(tasks)
+        producer = threading.Thread(target=self.produce, args=(tasks,), daemon=True)
+        producer.start()
+        self.add_workers(self.workers, image_path, tasks_total)
+        scaling = self.max_workers > self.workers
+        last_bytes = 0
+        last_rate = None
+        last_measure = time.time()
+        while True:
+            alive_threads = [thread for thread in self.threads if thread.is_alive()]
+            if not alive_threads:
+                break
+            alive_threads[0].join(timeout=self.adjust_interval)
+            elapsed = time.time() - last_measure
+            if not scaling or self.tasks.empty() or elapsed < self.adjust_interval:
+                continue
+            # hill climbing: add workers as long as the throughput increases noticeably
+            with self.lock:
+                rate = (self.bytes_downloaded - last_bytes) / elapsed
+                last_bytes = self.bytes_downloaded
+            last_measure = time.time()
+            if last_rate is None or rate > last_rate * (1 + self.min_gain):
+                step = min(max(1, self.workers // 2), self.max_workers - len(self.threads))
+                if step > 0:
+                    print(f"\n[*] Throughput {round(rate / 1024 / 1024, 2)} MB/s. Adding {step} download workers...")
+                    self.add_workers(step, image_path, tasks_total)
+                else:
+                    scaling = False
+                last_rate = rate
+            else:
+                scaling = False
+        if self.producer_error is not None:
+            raise self.producer_error
+        return self.images_downloaded
+
+
+class AsyncDownloader:
+    '''
+    Optional asyncio download engine for very large image harvests (requires aiohttp).
+
+    Instead of a fixed amount of threads, up to max_connections downloads are in flight at once,
+    limited to per_host_limit connections per flickr static host. Bodies are streamed to disk in chunks
+    the same way as by the PooledDownloader. The tasks are read and the manifest is written in threads,
+    so their blocking file and sqlite calls do not stall the open connections of the event loop.
+    '''
+    def __init__(self, max_connections=1000, per_host_limit=100, chunk_size=64 * 1024, timeout=60, verify_ssl=False, retry_policy=None, manifest=None):
+        # optional DownloadManifest which records every finished or failed download
+        self.manifest = manifest
+        self.max_connections = max_connections
+        self.per_host_limit = per_host_limit
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.verify_ssl = verify_ssl
+        self.retry_policy = retry_policy if retry_policy is not None else get_retry_policy('images')
+        self.images_downloaded = 0
+        self.bytes_downloaded = 0
+        self.failed = []
+        self.metrics = get_metrics()
+
+    @staticmethod
+    def available():
+        return aiohttp is not None
+
+    async def download(self, session, img_url, file_path):
+        part_path = file_path + '.part'
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        bytes_written = 0
+        async with session.get(img_url, headers=headers) as response:
+            if response.status == 416:
+                # range not satisfiable, the partial file does not match the resource anymore
+                os.remove(part_path)
+                return await self.download(session, img_url, file_path)
+            response.raise_for_status()
+            resumed = resume_part(part_path, offset, response.status, response.headers.get('Content-Range'))
+            if resumed is None:
+                print(f"\n[!] Range response does not continue {os.path.basename(part_path)}. Downloading it again...")
+                os.remove(part_path)
+                return await self.download(session, img_url, file_path)
+            mode, checksum, offset = resumed
+            with open(part_path, mode) as f:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    bytes_written += len(chunk)
+        os.replace(part_path, file_path)
+        return bytes_written, offset + bytes_written, checksum.hexdigest()
+
+    async def download_task(self, session, task, image_path, tasks_total):
+        img_id, img_url, size_key = task
+        tries = 0
+        while True:
+            try:
+                tries += 1
+                start = time.perf_counter()
+                bytes_written, file_size, checksum = await self.download(session, img_url, os.path.join(image_path, f"{img_id}.jpg"))
+                self.metrics.observe('image_download_seconds', time.perf_counter() - start, engine='asyncio')
+                self.metrics.count('image_bytes_total', bytes_written)
+                self.metrics.count('images_total', outcome='done')
+                if self.manifest is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, self.manifest.mark_done, img_id, size_key, img_url, file_size, checksum)
+                self.images_downloaded += 1
+                self.bytes_downloaded += bytes_written
+                print(f"\r[+] ASYNC: retrieved {self.images_downloaded} of {tasks_total} images", end='')
+                return None
+            except Exception as e:
+                error_class, delay = self.retry_policy.decide(e, tries)
+                print(f"\n[-] Image error ({error_class}, try {tries}): {e}")
+                if delay is not None:
+                    print(f"[*] Sleeping {round(delay, 1)}s...")
+                    await asyncio.sleep(delay)
+                    continue
+                self.metrics.count('images_total', outcome='failed')
+                if self.manifest is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, self.manifest.mark_failed, img_id, size_key, img_url)
+                self.failed.append(task)
+                return None
+
+    @staticmethod
+    def produce(tasks, task_queue, loop, workers):
+        '''
+        Feed the tasks into the queue of the workers (runs in a thread, reading the tasks may block: manifest queries,
+        file checks, task file). A None per worker marks the end of the tasks.
+        '''
+        try:
+            for task in tasks:
+                asyncio.run_coroutine_threadsafe(task_queue.put(task), loop).result()
+        finally:
+            for _ in range(workers):
+                asyncio.run_coroutine_threadsafe(task_queue.put(None), loop).result()
+
+    async def worker(self, session, task_queue, image_path, tasks_total):
+        # all workers pull from the same queue, so only max_connections coroutines exist at once
+        while True:
+            task = await task_queue.get()
+            if task is None:
+                return None
+            await self.download_task(session, task, image_path, tasks_total)
+
+    async def download_all(self, tasks, image_path, tasks_total):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host_limit, ssl=None if self.verify_ssl else False)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        workers = min(self.max_connections, tasks_total)
+        task_queue = asyncio.Queue(maxsize=max(1, workers) * 2)
+        producer = asyncio.to_thread(AsyncDownloader.produce, tasks, task_queue, asyncio.get_running_loop(), workers)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(producer, *[self.worker(session, task_queue, image_path, tasks_total) for _ in range(workers)])
+
+    def run(self, tasks, image_path, tasks_total=None):
+        '''
+        Download all tasks into image_path
+
+        :param tasks: list or iterable of (img_id, img_url, size_key) tuples
+        :param tasks_total: amount of tasks (for the progress output) if tasks is not a list
+        :return: amount of images downloaded
+        '''
+        if tasks_total is None:
+            tasks_total = len(tasks)
+        asyncio.run(self.download_all(tasks, image_path, tasks_total))
+        return self.images_downloaded
@@ -0,0 +1,549 @@
+import os
+import csv
+import time
+import sqlite3
+import datetime
+import threading
+from harvest_metrics import get_metrics
+# pyarrow is only needed for the optional parquet output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# characters removed from free text fields besides non ascii: control characters, '~' and DEL.
+# NUL is kept as it separates the values of a batch (see clean_column)
+control_characters = {i: None for i in list(range(1, 32)) + [126, 127]}
+
+'''
+Output fields of a post in column order: (column, key in the photos.search response, kind, default).
+kind defines the cleaning of the value:
+    raw: taken as it is
+    plain: csv separator removed
+    text: csv separator and non ascii characters removed (title, description)
+    tags: space separated tags joined by the tag connector
+Missing values and values which are not strings are replaced by the default.
+'''
+FIELDS = [('user_nsid', 'owner', 'raw', ''),
+          ('title', 'title', 'text', ''),
+          ('description', 'description', 'text', ''),
+          ('date_uploaded', 'dateupload', 'plain', ''),
+          ('date_taken', 'datetaken', 'plain', ''),
+          ('views', 'views', 'plain', ''),
+          ('user_tags', 'tags', 'tags', ''),
+          ('machine_tags', 'machine_tags', 'tags', ''),
+          ('license', 'license', 'plain', ''),
+          # location information
+          ('lat', 'latitude', 'plain', 99999),
+          ('lng', 'longitude', 'plain', 99999),
+          ('woeid', 'woeid', 'plain', 99999),
+          ('place_id', 'place_id', 'plain', 99999),
+          ('accuracy', 'accuracy', 'plain', ''),
+          # image urls in different sizes
+          ('image_url_small', 'url_s', 'plain', ''),
+          ('image_url_medium', 'url_m', 'plain', ''),
+          ('image_url_large', 'url_l', 'plain', ''),
+          ('image_url_original', 'url_o', 'plain', '')]
+
+HEADER = ['photo_id'] + [column for column, key, kind, default in FIELDS]
+
+
+def truncate_partial_line(path):
+    '''
+    Remove an incomplete last line (no line break) left by an interrupted run from a line based output file
+    '''
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        # search the last line break backwards chunk by chunk
+        while end > 0:
+            start = max(0, end - 64 * 1024)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+
+
+def field_values(posts, key):
+    if key == 'description':
+        # the description is nested: {'_content': ...}
+        return [post['description'].get('_content') if isinstance(post.get('description'), dict) else None for post in posts]
+    return [post.get(key) for post in posts]
+
+
+def clean_string(s, kind, csv_separator=';', tag_connector='+'):
+    s = s.replace(csv_separator, '')
+    if kind == 'tags':
+        return s.replace(tag_connector, '').replace(' ', tag_connector)
+    if kind == 'text':
+        return s.encode('ascii', 'ignore').decode('ascii').translate(control_characters)
+    return s
+
+
+def clean_column(values, kind, default, csv_separator=';', tag_connector='+'):
+    '''
+    Clean the values of one field of a batch of posts. The string values are joined and cleaned with
+    one pass of each string operation instead of one per post.
+
+    :param values: list of raw values of the field
+    :return: list of cleaned values
+    '''
+    if kind == 'raw':
+        return [value if value is not None else default for value in values]
+    is_string = [isinstance(value, str) for value in values]
+    joined = '\x00'.join([value if string else '' for value, string in zip(values, is_string)])
+    cleaned = clean_string(joined, kind, csv_separator, tag_connector).split('\x00')
+    if len(cleaned) != len(values):
+        # a value contains NUL itself, clean every value on its own
+        cleaned = [clean_string(value, kind, csv_separator, tag_connector).replace('\x00', '') if string else ''
+                   for value, string in zip(values, is_string)]
+    return [value if string else default for value, string in zip(cleaned, is_string)]
+
+
+def serialise_posts(posts, csv_separator=';', tag_connector='+'):
+    '''
+    Turn a batch of posts into output rows (photo_id followed by the FIELDS columns).
+    Every field is cleaned for the whole batch at once.
+
+    :return: list of rows
+    '''
+    columns = [[post['id'] for post in posts]]
+    for column, key, kind, default in FIELDS:
+        columns.append(clean_column(field_values(posts, key), kind, default, csv_separator, tag_connector))
+    return list(zip(*columns))
+
+
+def normalise_post(post, csv_separator=';', tag_connector='+'):
+    '''
+    Extract the output fields of a post of a photos.search response
+
+    :return: dict with the field name as key (photo_id excluded)
+    '''
+    row = serialise_posts([post], csv_separator, tag_connector)[0]
+    return dict(zip(HEADER[1:], row[1:]))
+
+
+def to_int(value):
+    try:
+        return int(value) if isinstance(value, str) else None
+    except ValueError:
+        return None
+
+
+def to_float(value):
+    try:
+        return float(value) if isinstance(value, str) else None
+    except ValueError:
+        return None
+
+
+def to_datetime(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S') if isinstance(value, str) else None
+    except ValueError:
+        # e.g. '0000-00-00 00:00:00' of posts without date taken
+        return None
+
+
+'''
+Typed output fields of the parquet and sqlite output: (column, key in the photos.search response, type).
+Missing values become nulls instead of '' and the 99999 sentinels of the CSV, tags are lists.
+'''
+TYPED_FIELDS = [('user_nsid', 'owner', 'dictionary'),
+                ('title', 'title', 'string'),
+                ('description', 'description', 'string'),
+                ('date_uploaded', 'dateupload', 'timestamp'),
+                ('date_taken', 'datetaken', 'datetime'),
+                ('views', 'views', 'int'),
+                ('user_tags', 'tags', 'tags'),
+                ('machine_tags', 'machine_tags', 'tags'),
+                ('license', 'license', 'dictionary'),
+                # location information
+                ('lat', 'latitude', 'float'),
+                ('lng', 'longitude', 'float'),
+                ('woeid', 'woeid', 'int'),
+                ('place_id', 'place_id', 'string'),
+                ('accuracy', 'accuracy', 'int'),
+                # image urls in different sizes
+                ('image_url_small', 'url_s', 'string'),
+                ('image_url_medium', 'url_m', 'string'),
+                ('image_url_large', 'url_l', 'string'),
+                ('image_url_original', 'url_o', 'string')]
+
+
+def parquet_schema():
+    types = {'dictionary': pa.dictionary(pa.int32(), pa.string()),
+             'string': pa.string(),
+             'timestamp': pa.timestamp('s'),
+             'datetime': pa.timestamp('s'),
+             'int': pa.int64(),
+             'float': pa.float64(),
+             'tags': pa.list_(pa.string())}
+    return pa.schema([('photo_id', pa.int64())] + [(column, types[kind]) for column, key, kind in TYPED_FIELDS])
+
+
+def parquet_column(values, kind):
+    '''
+    :param values: list of raw values of a field
+    :return: pyarrow array of the field
+    '''
+    if kind == 'tags':
+        return pa.array([value.split() if isinstance(value, str) else [] for value in values], pa.list_(pa.string()))
+    if kind in ('int', 'timestamp'):
+        return pa.array([to_int(value) for value in values], pa.int64()).cast(pa.timestamp('s') if kind == 'timestamp' else pa.int64())
+    if kind == 'float':
+        return pa.array([to_float(value) for value in values], pa.float64())
+    if kind == 'datetime':
+        return pa.array([to_datetime(value) for value in values], pa.timestamp('s'))
+    strings = pa.array([value if isinstance(value, str) else None for value in values], pa.string())
+    if kind == 'dictionary':
+        return strings.dictionary_encode()
+    return strings
+
+
+def parquet_table(posts, schema):
+    columns = [pa.array([to_int(post['id']) for post in posts], pa.int64())]
+    for column, key, kind in TYPED_FIELDS:
+        columns.append(parquet_column(field_values(posts, key), kind))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class MetadataWriter:
+    '''
+    Base of the metadata output sinks.
+
+    Posts can be written page by page as soon as they arrive (streaming) or all at once with write_results.
+    Duplicates are removed based on the post id, the set of written ids is the only state kept in memory.
+    The sinks implement write_rows for the new posts of a page, sync and close.
+    '''
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.processed_ids_set = set()
+        self.index = 0
+
+    def write_posts(self, posts):
+        '''
+        Append the posts which were not written yet
+
+        :param posts: list of posts of a photos.search result page
+        :return: list of the newly written posts
+        '''
+        new_posts = []
+        for post in posts:
+            post_id = post['id']
+            # check if this post_id was already added to the output
+            if post_id in self.processed_ids_set:
+                continue
+            self.processed_ids_set.add(post_id)
+            new_posts.append(post)
+        if new_posts:
+            self.write_rows(new_posts)
+        self.index += len(posts)
+        metrics = get_metrics()
+        metrics.count('posts_seen_total', len(posts))
+        metrics.count('posts_duplicate_total', len(posts) - len(new_posts))
+        print(f"\rLine {self.index} processed", end='')
+        return new_posts
+
+    def write_rows(self, posts):
+        raise NotImplementedError
+
+    def write_results(self, results_list):
+        '''
+        :param results_list: list of result_dicts (page_N: photos.search response)
+        '''
+        for results in results_list:
+            for page in results:
+                self.write_posts(results[page]['photos']['photo'])
+
+    def posts_written(self):
+        return len(self.processed_ids_set)
+
+    def sync(self):
+        '''
+        Make the written posts durable (called before a streamed window is checkpointed as done)
+        '''
+        pass
+
+    def close(self):
+        pass
+
+
+class CSVMetadataWriter(MetadataWriter):
+    '''
+    Writes the posts of photos.search result pages into the semicolon separated metadata CSV file.
+
+    With append=True an existing output file (e.g. of an interrupted run) is continued and its ids are loaded
+    to keep the deduplication intact. A row cut off by the interruption is removed first.
+    '''
+    def __init__(self, csv_output_path, append=False, csv_separator=';', tag_connector='+'):
+        super().__init__(csv_output_path)
+        self.csv_output_path = csv_output_path
+        self.csv_separator = csv_separator  #';' #~&~#
+        self.tag_connector = tag_connector
+        self.header_written = False
+        if append and os.path.exists(csv_output_path):
+            truncate_partial_line(csv_output_path)
+            self.processed_ids_set = self.read_written_ids()
+            self.header_written = os.path.getsize(csv_output_path) > 0
+        self.f = open(csv_output_path, 'a' if append else 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f, delimiter=csv_separator, lineterminator='\n')
+
+    def read_written_ids(self):
+        with open(self.csv_output_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f, delimiter=self.csv_separator)
+            next(reader, None)
+            return {row[0] for row in reader if row}
+
+    def write_rows(self, posts):
+        if not self.header_written:
+            self.writer.writerow(HEADER)
+            self.header_written = True
+        self.writer.writerows(serialise_posts(posts, self.csv_separator, self.tag_connector))
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetMetadataWriter(MetadataWriter):
+    '''
+    Writes the posts into a parquet file with typed columns (requires pyarrow).
+
+    Compared to the CSV, lat/lng, dates and counts are numeric (missing values are null), tags and machine tags
+    are lists and owner and licence are dictionary encoded. The new posts of the pages are buffered and written
+    as a row group every row_group_size rows, so the memory stays bounded while streaming.
+
+    The file is written to '<output_path>.part' and renamed once closed, a parquet file without its footer can not
+    be read. The output of an interrupted run can therefore only be continued if it was closed: with append=True
+    a complete output file is copied row group by row group into the new file. If the output file is missing or a
+    '.part' file of an interrupted writer is left (e.g. a crashed delta harvest appending to the closed file of the
+    earlier harvest), the posts written since are lost and incomplete is set, so the caller can query the area again.
+    Syncing the posts of a window is therefore not needed (and would only write small row groups).
+    '''
+    def __init__(self, output_path, append=False, row_group_size=10000):
+        super().__init__(output_path)
+        self.row_group_size = row_group_size
+        self.part_path = output_path + '.part'
+        self.schema = parquet_schema()
+        self.writer = None
+        self.buffer = []
+        self.buffered_rows = 0
+        self.incomplete = append and (not os.path.exists(output_path) or os.path.exists(self.part_path))
+        if not append:
+            return None
+        if not os.path.exists(output_path):
+            print(f"[!] Output file {output_path} of an interrupted run is incomplete. Starting a new file...")
+            return None
+        if self.incomplete:
+            print(f"[!] Output file {self.part_path} of an interrupted run is incomplete. Continuing {output_path}...")
+        self.copy_existing()
+
+    def copy_existing(self):
+        existing = pq.ParquetFile(self.output_path)
+        self.writer = pq.ParquetWriter(self.part_path, self.schema)
+        for row_group in range(existing.num_row_groups):
+            table = existing.read_row_group(row_group).cast(self.schema)
+            self.processed_ids_set.update(str(photo_id) for photo_id in table.column('photo_id').to_pylist())
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    @staticmethod
+    def available():
+        return pa is not None
+
+    def write_rows(self, posts):
+        self.buffer.append(parquet_table(posts, self.schema))
+        self.buffered_rows += len(posts)
+        if self.buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return None
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.part_path, self.schema)
+        self.writer.write_table(pa.concat_tables(self.buffer), row_group_size=self.row_group_size)
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is None:
+            # no posts at all, the file only contains the schema
+            self.writer = pq.ParquetWriter(self.part_path, self.schema)
+        self.writer.close()
+        os.replace(self.part_path, self.output_path)
+
+
+# sql types of the typed fields
+SQLITE_TYPES = {'dictionary': 'TEXT',
+                'string': 'TEXT',
+                'timestamp': 'INTEGER',
+                'datetime': 'TEXT',
+                'int': 'INTEGER',
+                'float': 'REAL',
+                'tags': 'TEXT'}
+
+
+def sqlite_column(values, kind):
+    '''
+    :param values: list of raw values of a field
+    :return: list of values for the sqlite output
+    '''
+    if kind == 'tags':
+        # space separated as in the photos.search response
+        return [' '.join(value.split()) if isinstance(value, str) else '' for value in values]
+    if kind in ('int', 'timestamp'):
+        return [to_int(value) for value in values]
+    if kind == 'float':
+        return [to_float(value) for value in values]
+    if kind == 'datetime':
+        # 'YYYY-MM-DD HH:MM:SS' text sorts chronologically, invalid dates become null
+        return [value if to_datetime(value) is not None else None for value in values]
+    return [value if isinstance(value, str) else None for value in values]
+
+
+class SQLiteMetadataWriter(MetadataWriter):
+    '''
+    Writes the posts into a SQLite database shared by all areas and runs of a project.
+
+    Posts are upserted by photo id, so a post returned by several areas or runs is stored once (with the values
+    of the latest query). The coordinates are kept in an R*Tree index (posts_rtree) and date_taken/date_uploaded
+    are indexed, so spatial and temporal range queries do not need a full scan, e.g.:
+        SELECT posts.* FROM posts JOIN posts_rtree ON posts.photo_id = posts_rtree.id
+        WHERE min_lng >= 8.3 AND max_lng <= 8.7 AND min_lat >= 47.0 AND max_lat <= 47.2
+        AND date_taken BETWEEN '2015-01-01' AND '2016-01-01'
+    Every page is committed at once, so an interrupted run loses no written page.
+    '''
+    def __init__(self, output_path, append=False):
+        super().__init__(output_path)
+        self.connection = sqlite3.connect(output_path, timeout=60)
+        columns = ', '.join(f'{column} {SQLITE_TYPES[kind]}' for column, key, kind in TYPED_FIELDS)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS posts (photo_id INTEGER PRIMARY KEY, {columns}, updated REAL)')
+        self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS posts_rtree USING rtree(id, min_lng, max_lng, min_lat, max_lat)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS posts_date_taken ON posts (date_taken)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS posts_date_uploaded ON posts (date_uploaded)')
+        self.connection.commit()
+        placeholders = ', '.join('?' * (len(TYPED_FIELDS) + 2))
+        updates = ', '.join(f'{column} = excluded.{column}' for column, key, kind in TYPED_FIELDS)
+        self.upsert = (f'INSERT INTO posts VALUES ({placeholders}) '
+                       f'ON CONFLICT (photo_id) DO UPDATE SET {updates}, updated = excluded.updated')
+        # position of the coordinates in the rows (after photo_id)
+        columns = [column for column, key, kind in TYPED_FIELDS]
+        self.lat = 1 + columns.index('lat')
+        self.lng = 1 + columns.index('lng')
+
+    def write_rows(self, posts):
+        columns = [[to_int(post['id']) for post in posts]]
+        for column, key, kind in TYPED_FIELDS:
+            columns.append(sqlite_column(field_values(posts, key), kind))
+        now = time.time()
+        rows = [row + (now,) for row in zip(*columns) if row[0] is not None]
+        lat, lng = self.lat, self.lng
+        located = [(row[0], row[lng], row[lng], row[lat], row[lat]) for row in rows if row[lat] is not None and row[lng] is not None]
+        unlocated = [(row[0],) for row in rows if row[lat] is None or row[lng] is None]
+        with self.connection:
+            self.connection.executemany(self.upsert, rows)
+            self.connection.executemany('INSERT OR REPLACE INTO posts_rtree VALUES (?, ?, ?, ?, ?)', located)
+            self.connection.executemany('DELETE FROM posts_rtree WHERE id = ?', unlocated)
+
+    def close(self):
+        self.connection.close()
+
+
+# extension and writer of the output formats
+OUTPUT_FORMATS = {'csv': ('.csv', CSVMetadataWriter),
+                  'parquet': ('.parquet', ParquetMetadataWriter),
+                  'sqlite': ('.sqlite', SQLiteMetadataWriter)}
+
+
+def open_metadata_writer(output_path, output_format='csv', append=False):
+    return OUTPUT_FORMATS[output_format][1](output_path, append=append)
+
+
+class MetadataStream:
+    '''
+    Streaming output of one area for runs with bounded memory.
+
+    Every result page of a fitting query is written to the metadata output as soon as it arrives instead of collecting
+    all pages of all subqueries first. The image download tasks (img_id, img_url, size_key) of the newly written posts
+    are appended to a task file, from which the images are downloaded at the end of the area.
+    The written post ids (deduplication) are the only state kept in memory.
+    sync has to be called before a window is checkpointed as done, otherwise its posts may still be in a file buffer.
+    '''
+    def __init__(self, output_path, task_path=None, image_url=None, append=False, output_format='csv'):
+        '''
+        :param output_path: metadata output file of the area
+        :param task_path: file for the image download tasks (None if no images are downloaded)
+        :param image_url: function returning (url key, url) of the image of a post
+        :param append: continue the files of an interrupted run
+        :param output_format: 'csv', 'parquet' or 'sqlite'
+        '''
+        self.output_path = output_path
+        self.task_path = task_path
+        self.image_url = image_url
+        self.writer = open_metadata_writer(output_path, output_format, append=append)
+        # the output of the interrupted run could not be continued, the area has to be queried again
+        self.incomplete = getattr(self.writer, 'incomplete', False)
+        self.task_file = None
+        if task_path is not None:
+            append_tasks = append and not self.incomplete and os.path.exists(task_path)
+            if append_tasks:
+                truncate_partial_line(task_path)
+            self.task_file = open(task_path, 'a' if append_tasks else 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def write_page(self, page_result):
+        '''
+        :param page_result: photos.search response of one page
+        :return: amount of new posts written
+        '''
+        with self.lock, get_metrics().timer('write_seconds', sink='stream'):
+            new_posts = self.writer.write_posts(page_result['photos']['photo'])
+            if self.task_file is not None:
+                for post in new_posts:
+                    url_key, img_url = self.image_url(post)
+                    if img_url is not None:
+                        self.task_file.write(f"{post['id']}\t{img_url}\t{url_key}\n")
+        return len(new_posts)
+
+    def sync(self):
+        '''
+        Flush the written posts and image download tasks to disk
+        '''
+        with self.lock:
+            self.writer.sync()
+            if self.task_file is not None:
+                self.task_file.flush()
+                os.fsync(self.task_file.fileno())
+
+    def posts_written(self):
+        return self.writer.posts_written()
+
+    def tasks_total(self):
+        with open(self.task_path, 'r', encoding='utf-8') as f:
+            return sum(1 for line in f)
+
+    def read_tasks(self):
+        '''
+        :return: generator of the (img_id, img_url, size_key) tasks in the task file
+        '''
+        with open(self.task_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                img_id, img_url, size_key = line.rstrip('\n').split('\t')
+                yield img_id, img_url, size_key
+
+    def close(self):
+        self.writer.close()
+        if self.task_file is not None:
+            self.task_file.close()
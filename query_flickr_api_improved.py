@@ -1,14 +1,18 @@
 import os
-import re
-import ssl
+import math
 import time
 import json
-import urllib
 import datetime
 import requests
-import flickrapi
+import threading
 import concurrent.futures
 from functools import wraps
+from credential_pool import get_credential_pool, is_throttled
+from image_downloader import PooledDownloader, DownloadQueue, AsyncDownloader
+from download_manifest import DownloadManifest
+from metadata_writer import OUTPUT_FORMATS, open_metadata_writer
+from harvest_metrics import get_metrics
+from retry_policy import get_retry_policy, FlickrAPIError, RetryError, PERMANENT
 
 class FlickrQuerier:
     '''
@@ -18,29 +22,49 @@ class FlickrQuerier:
     Therefore, queries have to be constructed in a way that less than 4'000 are returned.
     '''
     path_LOG = "LOG_FLICKR_API.txt"
+    # dict that matches image_size to dictionary key as it is in the Flickr API response
+    image_size_dict = {'small': 'url_s',
+                       'medium': 'url_m',
+                       'large': 'url_l',
+                       'original': 'url_o'}
+    # extra fields to retrieve with photos.search endpoint. Can replace the much more request intensive photos.getInfo!
+    # must be a comma seperated list - but still a string; not a python list!
+    extras = "description, license, date_upload, date_taken, owner_name, icon_server, original_format, last_update, " \
+             "geo, tags, machine_tags, o_dims, views, media, path_alias, url_sq, url_t, url_s, url_q, url_m, url_n, " \
+             "url_z, url_c, url_l, url_o"
     # path_CSV = "C:/Users/mhartman/PycharmProjects/MotiveDetection/wildkirchli_metadata.csv"
 
     class Decorators:
+        # the log file is opened once per process (line buffered) and shared by all decorated functions and threads
+        log_file = None
+        log_lock = threading.Lock()
+
         # decorator to wrap around functions to log if they are being called
         @classmethod
         def logit(self, func):
             #preserve the passed functions (func) identity - so I doesn't point to the 'wrapper_func'
             @wraps(func)
             def wrapper_func(*args, **kwargs):
-                with open(FlickrQuerier.path_LOG, 'at') as log_f:
-                    #print("Logging...")
-                    log_f.write('-'*20)
-                    log_f.write(f'{datetime.datetime.now()} : function {func.__name__} called \n')
+                get_metrics().count('function_calls_total', function=func.__name__)
+                with self.log_lock:
+                    if self.log_file is None:
+                        self.log_file = open(FlickrQuerier.path_LOG, 'at', buffering=1)
+                    self.log_file.write('-'*20)
+                    self.log_file.write(f'{datetime.datetime.now()} : function {func.__name__} called \n')
                 return func(*args, **kwargs)
             return wrapper_func
 
     def __init__(self, project_name, area_name, bbox=None, text_search=None, tags=None, tag_mode=None, has_geo=True, textual_results_to_return=1000, perform_textual_search=False, min_upload_date=None, max_upload_date=None, accuracy=16,
                  toget_images=True, image_size='medium', api_creds_file="C:/Users/mhartman/PycharmProjects/FlickrFrame/FLICKR_API_KEY.txt",
-                 subquery_status=False, allowed_licenses='all', rate_limit_sleep=2):
+                 subquery_status=False, allowed_licenses='all', calls_per_hour=3600, burst=None, page_workers=4, page_retries=5,
+                 download_workers=10, max_download_workers=None, download_engine='threads',
+                 verify_checksums=False, search_cache=None, metadata_stream=None, output_format='csv', download_executor=None, search=True,
+                 delta_signature=None, area_filter=None, workspace_path=None):
 
         self.project_name = project_name
-        self.project_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), project_name)
-        self.dir_path = os.path.dirname(os.path.realpath(__file__))
+        # folder of the project folders (default: the folder of this script)
+        self.dir_path = workspace_path if workspace_path is not None else os.path.dirname(os.path.realpath(__file__))
+        self.project_path = os.path.join(self.dir_path, project_name)
         self.bbox = bbox
         self.text_search = text_search
         self.tags = tags
@@ -56,17 +80,69 @@ class FlickrQuerier:
         self.accuracy = accuracy
         self.toget_images = toget_images
         self.image_size = image_size
+        # 'csv' (semicolon separated), 'parquet' (typed columns, requires pyarrow) or 'sqlite' (one database per project)
+        self.output_format = output_format
+        # delta harvests (FlickrFrame with delta=True): the results are merged into the one output file of the area
+        # and query signature instead of a new dated file per run
+        self.delta_signature = delta_signature
+        # optional AreaFilter (FlickrFrame with filter_polygons=True): the posts outside the polygons of the GeoJSON
+        # area are removed from every result page before they are written or downloaded
+        self.area_filter = area_filter
+        # amount of image download workers, increased up to max_download_workers while the throughput grows
+        self.download_workers = download_workers
+        self.max_download_workers = max_download_workers
+        # 'threads' (default) or 'asyncio' (requires aiohttp)
+        self.download_engine = download_engine
+        # optional executor (FlickrFrame with GeoJSON areas): the downloads run in the background and
+        # download_future is set, so the next area can be queried in the meantime
+        self.download_executor = download_executor
+        self.download_future = None
+        # re-hash already downloaded images against the checksum in the download manifest before skipping them
+        self.verify_checksums = verify_checksums
         self.api_creds_file = api_creds_file
         self.subquery_status = subquery_status
         # if allowed_licenses is 'all' then ALL images irrespective of the license shall be returned!
         # could most likely be changed to None to retrieve all licenses but not entirely sure
         self.allowed_licenses = allowed_licenses
-        # sleep after each api query to not hit the rate limit of 3600 queries per hour source: https://www.flickr.com/services/developer/api/
-        self.rate_limit_sleep = rate_limit_sleep
-        #in case of Connection error time to pause process in seconds
-        self.to_sleep = 60
-        self.api_key, self.api_secret = self.load_creds(self.api_creds_file)
-        self.result_dict, self.unique_ids, self.flickr, self.toomany_pages = self.flickr_search()
+        # rate limit of 3600 queries per hour per api key source: https://www.flickr.com/services/developer/api/
+        # burst: amount of saved up calls that can be spent at once (default: the whole remaining hourly budget)
+        self.calls_per_hour = calls_per_hour
+        self.burst = burst
+        # failed api calls are classified and retried with exponential backoff within the retry budget of the run
+        # (see retry_policy). The first page and probes are retried until the budget is used up.
+        self.retry_policy = get_retry_policy('search')
+        # amount of threads fetching the result pages 2..N concurrently and tries per page before giving up
+        self.page_workers = page_workers
+        self.page_retries = page_retries
+        # result pages which could not be fetched after page_retries tries
+        self.failed_pages = []
+        # (page, error class, error) of the pages given up, recorded by FlickrFrame in the checkpoint store (dead letters)
+        self.dead_letters = []
+        # amount of photos.search calls issued by this instance (used for the split statistics of FlickrFrame)
+        self.api_calls = 0
+        self.api_calls_lock = threading.Lock()
+        # optional SearchCache shared by all queries of the process and the amount of pages served from it
+        self.search_cache = search_cache
+        self.cache_hits = 0
+        # optional MetadataStream: fitting result pages are written right away instead of being kept in result_dict
+        self.metadata_stream = metadata_stream
+        self.streamed_ids = set()
+        # metrics of the process (see harvest_metrics, no-ops unless FlickrFrame is run with metrics_path)
+        self.metrics = get_metrics()
+        # pool of all api keys of the credentials file shared by all FlickrQuerier objects of this process
+        self.credential_pool = self.load_creds(self.api_creds_file)
+        self.api_key, self.api_secret = self.credential_pool.credentials[0].api_key, self.credential_pool.credentials[0].api_secret
+        # the pool paces the calls with a token bucket per api key and reports the budget of all keys
+        self.rate_limiter = self.credential_pool
+        if not search:
+            # only used to write the output and download the images of results collected elsewhere (e.g. checkpoints)
+            self.result_dict, self.unique_ids, self.flickr, self.toomany_pages = None, None, None, (0, False)
+            return None
+        with self.metrics.timer('search_seconds'):
+            self.result_dict, self.unique_ids, self.flickr, self.toomany_pages = self.flickr_search()
+        if self.metadata_stream is not None:
+            # the pages were written by the stream, the area is finished by FlickrFrame
+            return None
         # check if textual search return limit set by user is reached
         if self.perform_textual_search:
             if self.unique_ids is not None:
@@ -121,74 +197,166 @@ class FlickrQuerier:
 
     @Decorators.logit
     def load_creds(self, path):
-        key_found = False
-        secret_found = False
-        with open(self.api_creds_file, 'r') as f: #FlickrQuerier.path_CREDENTIALS
-            for line in f:
-                if key_found:
-                    api_key = line.strip().encode('utf-8')
-                    key_found = False
-
-                if secret_found:
-                    api_secret = line.strip().encode('utf-8')
-                    secret_found = False
-
-                if re.match(r'<KEY>', line):
-                    key_found = True
-                    continue
-                elif re.match(r'<SECRET>', line):
-                    secret_found = True
-        return api_key, api_secret
+        '''
+        :return: CredentialPool with all <KEY>/<SECRET> sections of the credentials file
+        '''
+        return get_credential_pool(path, calls_per_hour=self.calls_per_hour, burst=self.burst)
 
-    def flickr_search(self):
-        # extra fields to retrieve with photos.search endpoint. Can replace the much more request intensive photos.getInfo!
-        # must be a comma seperated list - but still a string; not a python list!
-        extras = "description, license, date_upload, date_taken, owner_name, icon_server, original_format, last_update, " \
-                 "geo, tags, machine_tags, o_dims, views, media, path_alias, url_sq, url_t, url_s, url_q, url_m, url_n, " \
-                 "url_z, url_c, url_l, url_o"
-        flickr = flickrapi.FlickrAPI(self.api_key, self.api_secret, format='json')
-        # check if bbox or text based search shall be performed
-        # if self.bbox is not None and self.text_search is None:
+    def search_params(self):
+        '''
+        Parameters of the photos.search query shared by all pages of this FlickrQuerier
+        '''
+        params = {'bbox': self.bbox,
+                  'text': self.text_search,
+                  'tags': self.tags,
+                  'tag_mode': self.tag_mode,
+                  'has_geo': self.has_geo,
+                  'min_upload_date': self.min_upload_date,
+                  'max_upload_date': self.max_upload_date,
+                  'accuracy': self.accuracy}
+        # if allowed_licenses is 'all' the license parameter is omitted
+        if self.allowed_licenses != 'all':
+            params['license'] = self.allowed_licenses
+        return params
+
+    def search_page(self, page, extras, per_page=250):
+        '''
+        Query a single result page with the next api key of the credential pool.
+        A throttled key is taken out of rotation and the page is queried again with another key. With a single key
+        the error is raised instead and the retry policy backs off.
+        If a search cache is set, cached responses are returned without an api call.
+
+        :return: parsed json response of the page
+        '''
+        params = self.search_params()
+        params.update({'page': page, 'per_page': per_page, 'extras': extras})
+        if self.search_cache is not None:
+            cached_result = self.search_cache.get(params)
+            if cached_result is not None:
+                with self.api_calls_lock:
+                    self.cache_hits += 1
+                self.metrics.count('search_cache_hits_total')
+                return cached_result
+            if self.search_cache.cache_only:
+                print(f"\n[!] cache-only: no cached response for page {page}. Treating it as empty.")
+                return {'photos': {'page': page, 'pages': 0, 'perpage': per_page, 'total': 0, 'photo': []}, 'stat': 'ok'}
+        kind = 'page' if extras else 'probe'
         while True:
+            wait_start = time.perf_counter()
+            credential = self.credential_pool.acquire()
+            call_start = time.perf_counter()
+            # time spent waiting for the rate limit (or for throttled keys) vs. time spent in the api call
+            self.metrics.observe('rate_limit_wait_seconds', call_start - wait_start)
             try:
-                if self.allowed_licenses != 'all':
-                    photos = flickr.photos.search(bbox=self.bbox,
-                                                  text=self.text_search,
-                                                  tags=self.tags,
-                                                  tag_mode=self.tag_mode,
-                                                  has_geo=self.has_geo,
-                                                  min_upload_date=self.min_upload_date,
-                                                  max_upload_date=self.max_upload_date,
-                                                  accuracy=self.accuracy,
-                                                  license=self.allowed_licenses,
-                                                  per_page=250,
-                                                  extras=extras) #is_, accuracy=12, commons=True, page=1, min_taken_date='YYYY-MM-DD HH:MM:SS'
-                    break
-                else:
-                    photos = flickr.photos.search(bbox=self.bbox,
-                                                  text=self.text_search,
-                                                  tags=self.tags,
-                                                  tag_mode=self.tag_mode,
-                                                  has_geo=self.has_geo,
-                                                  min_upload_date=self.min_upload_date,
-                                                  max_upload_date=self.max_upload_date,
-                                                  accuracy=self.accuracy,
-                                                  per_page=250,
-                                                  extras=extras)# is_, accuracy=12, commons=True, page=1, min_taken_date='YYYY-MM-DD HH:MM:SS'
-                    break
-
+                result_bytes = self.credential_pool.client(credential).photos.search(**params) #is_, accuracy=12, commons=True, min_taken_date='YYYY-MM-DD HH:MM:SS'
+                break
             except Exception as e:
-                print("*" * 30)
-                print("*" * 30)
-                print(f"[-] Search error: {e}")
-                print(f"[*] Sleeping {self.to_sleep}s...")
-                print("*" * 30)
-                print("*" * 30)
-                time.sleep(self.to_sleep)
+                self.metrics.observe('api_call_seconds', time.perf_counter() - call_start, kind=kind, outcome='error')
+                if not is_throttled(e):
+                    self.metrics.count('api_errors_total', kind=kind)
+                    raise
+                self.metrics.count('api_throttled_total', kind=kind)
+                # a single key is back in rotation once the retry policy has backed off (at least half its throttle_delay)
+                self.credential_pool.throttled(credential, max_cooldown=self.retry_policy.throttle_delay / 2)
+                if len(self.credential_pool.credentials) == 1:
+                    raise
+        seconds = time.perf_counter() - call_start
+        with self.api_calls_lock:
+            self.api_calls += 1
+        result = json.loads(result_bytes.decode('utf-8'))
+        self.metrics.count('api_calls_total', kind=kind)
+        self.metrics.count('api_bytes_total', len(result_bytes), kind=kind)
+        self.metrics.observe('api_call_seconds', seconds, kind=kind, outcome='ok')
+        self.metrics.trace('api_call', kind=kind, area=self.area_name, page=page, seconds=round(seconds, 4), bytes=len(result_bytes),
+                           wait_seconds=round(call_start - wait_start, 4), posts=len(result.get('photos', {}).get('photo', [])))
+        if result.get('stat') != 'ok':
+            raise FlickrAPIError(result.get('code'), result.get('message'))
+        if self.search_cache is not None:
+            self.search_cache.put(params, result)
+        return result
+
+    def fetch_page(self, page, extras):
+        '''
+        Query a result page (2..N) and retry it up to page_retries times on errors.
+        A page given up is added to the dead letters.
+
+        :return: page number and parsed json response (None if the page was given up)
+        '''
+        try:
+            return page, self.retry_policy.run(self.search_page, page, extras, description=f'Search (page {page})', max_tries=self.page_retries)
+        except RetryError as e:
+            self.metrics.count('pages_failed_total')
+            self.dead_letter(page, e)
+            return page, None
 
-        time.sleep(self.rate_limit_sleep)  # according to the rate limit of 3600 queries per hour source: https://www.flickr.com/services/developer/api/
+    def dead_letter(self, page, retry_error):
+        with self.api_calls_lock:
+            self.dead_letters.append((page, retry_error.error_class, str(retry_error.error)))
 
-        result = json.loads(photos.decode('utf-8'))
+    def refetch_page(self, page):
+        '''
+        Query a result page given up by an earlier run (dead letter) again. For a first page all pages of the query
+        are fetched, if the query fits into one query.
+
+        :return: result_dict (page_N: photos.search response) or None if the page was given up again
+        '''
+        page, result = self.fetch_page(page, FlickrQuerier.extras)
+        if result is None:
+            return None
+        result_dict = {f'page_{page}': self.filter_page(result)}
+        pages = result['photos']['pages']
+        if page == 1 and pages >= 15:
+            print(f"[!] The query of the dead letter returns {pages} pages now. Harvest the area {self.area_name} again to split it.")
+        elif page == 1:
+            for other_page in range(2, pages + 1):
+                other_page, other_result = self.fetch_page(other_page, FlickrQuerier.extras)
+                if other_result is not None:
+                    result_dict[f'page_{other_page}'] = self.filter_page(other_result)
+        return result_dict
+
+    def probe_pages(self):
+        '''
+        Minimal query (one result per page, no extras) to read the total amount of results of the query
+        without transferring the full result page.
+
+        :return: amount of result pages with 250 results per page
+        '''
+        # a probe given up stops the run (RetryError), it can be resumed from the checkpoints
+        result = self.retry_policy.run(self.search_page, 1, '', per_page=1, description='Probe', max_tries=None)
+        return math.ceil(int(result['photos']['total']) / 250)
+
+    def filter_page(self, page_result):
+        '''
+        :return: result page without the posts outside the area (unchanged without area filter)
+        '''
+        if self.area_filter is None:
+            return page_result
+        return self.area_filter.filter_page(page_result)
+
+    def stream_page(self, page_result):
+        '''
+        Write a result page of a fitting query to the metadata stream, only its post ids are kept
+        '''
+        self.metadata_stream.write_page(page_result)
+        self.streamed_ids.update(post['id'] for post in page_result['photos']['photo'])
+
+    def flickr_search(self):
+        extras = FlickrQuerier.extras
+        # the calls are spread over the clients of all api keys by the pool (see search_page),
+        # self.flickr stays the flickrapi client of the first key (like self.api_key) for callers
+        flickr = self.credential_pool.client(self.credential_pool.credentials[0])
+        # check if bbox or text based search shall be performed
+        # if self.bbox is not None and self.text_search is None:
+        try:
+            result = self.retry_policy.run(self.search_page, 1, extras, description='Search', max_tries=None)
+        except RetryError as e:
+            # errors of the api key or the request format (flickr codes >= 95) concern every query: stop the run.
+            # An exhausted retry budget stops the run as well, it can be resumed from the checkpoints.
+            if e.error_class != PERMANENT or (isinstance(e.error, FlickrAPIError) and int(e.error.code or 0) >= 95):
+                raise
+            print(f"[-] Giving up the query: {e}")
+            self.dead_letter(1, e)
+            return {}, set(), flickr, (0, False)
         '''
         Handling for multipage results stored in result_dict
         '''
@@ -198,6 +366,10 @@ class FlickrQuerier:
         if pages < 15:
             print("[*] Less than 4'000 results for this bounding box. Continuing normally...")
             toomany_pages = (pages, False)
+            result_dict['page_1'] = self.filter_page(result)
+            self.metrics.observe('posts_per_page', len(result_dict['page_1']['photos']['photo']))
+            if self.metadata_stream is not None:
+                self.stream_page(result_dict.pop('page_1'))
         if pages != 1 and pages != 0:
             '''
             Checking if (4'000 % 250 = 16; for caution purposes 15) pages are returned, 
@@ -211,46 +383,34 @@ class FlickrQuerier:
                 return result_dict, unique_ids, flickr, toomany_pages
 
             print(f"Search returned {pages} result pages")
-            for page in range(2, pages+1):
-                print(f"Querying page {page}...")
-                try:
-                    if self.allowed_licenses != 'all':
-                        result_bytes = flickr.photos.search(bbox=self.bbox,
-                                                            text=self.text_search,
-                                                            tags=self.tags,
-                                                            tag_mode=self.tag_mode,
-                                                            has_geo=self.has_geo,
-                                                            min_upload_date=self.min_upload_date,
-                                                            max_upload_date=self.max_upload_date,
-                                                            accuracy=self.accuracy,
-                                                            page=page,
-                                                            license=self.allowed_licenses,
-                                                            per_page=250,
-                                                            extras=extras)
-                        result_dict[f'page_{page}'] = json.loads(result_bytes.decode('utf-8'))
+            '''
+            pages 2..N do not depend on each other and are fetched by a bounded thread pool.
+            Every call still passes the shared rate limiter.
+            '''
+            fetched_pages = {}
+            pages_done = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+                futures = [executor.submit(self.fetch_page, page, extras) for page in range(2, pages+1)]
+                for future in concurrent.futures.as_completed(futures):
+                    page, page_result = future.result()
+                    if page_result is None:
+                        self.failed_pages.append(page)
+                        continue
+                    page_result = self.filter_page(page_result)
+                    self.metrics.observe('posts_per_page', len(page_result['photos']['photo']))
+                    if self.metadata_stream is not None:
+                        self.stream_page(page_result)
                     else:
-                        result_bytes = flickr.photos.search(bbox=self.bbox,
-                                                            text=self.text_search,
-                                                            tags=self.tags,
-                                                            tag_mode=self.tag_mode,
-                                                            has_geo=self.has_geo,
-                                                            min_upload_date=self.min_upload_date,
-                                                            max_upload_date=self.max_upload_date,
-                                                            accuracy=self.accuracy,
-                                                            page=page,
-                                                            per_page=250,
-                                                            extras=extras)
-                        result_dict[f'page_{page}'] = json.loads(result_bytes.decode('utf-8'))
-                    time.sleep(self.rate_limit_sleep)  # according to the rate limit of 3600 queries per hour source: https://www.flickr.com/services/developer/api/
-
-                except Exception as e:
-                    print("*" * 30)
-                    print("*" * 30)
-                    print(f"[-] Search error: {e}")
-                    print(f"[*] Sleeping {self.to_sleep}s...")
-                    print("*" * 30)
-                    print("*" * 30)
-                    time.sleep(self.to_sleep)
+                        fetched_pages[page] = page_result
+                    pages_done += 1
+                    # result pages of the query not fetched yet (queued or in flight)
+                    self.metrics.gauge('pages_pending', pages - 1 - len(self.failed_pages) - pages_done)
+                    print(f"\r[*] Queried {pages_done} of {pages - 1} additional pages", end='')
+            print()
+            for page in sorted(fetched_pages):
+                result_dict[f'page_{page}'] = fetched_pages[page]
+            if self.failed_pages:
+                print(f"[-] Failed to query pages {self.failed_pages} after {self.page_retries} tries each.")
         print("[*] All pages handled.")
         # get ids of returned flickr images
         ids = []
@@ -260,275 +420,134 @@ class FlickrQuerier:
                     ids.append(element['id'])
             except Exception as e:
                 print(f'[-] Error in result_dict: {e}')
-        unique_ids = set(ids)
+        unique_ids = set(ids) | self.streamed_ids
 
         print(f"[*] Results found: {len(unique_ids)}")
 
         return result_dict, unique_ids, flickr, toomany_pages
 
-    def get_images(self, results_list, image_size='medium', WORKERS=10):
-        def download_urls(data_chunk):
-            '''
-            download images in parallel
-            :return:
-            '''
-            worker_id = data_chunk[0]
-            image_path = data_chunk[1]
-            url_chunk = data_chunk[2]
-            url_len = len(url_chunk)
-
-            images_dowloaded = 0
-            for index, img_tuple in enumerate(url_chunk, 0):
-                tries = 0
-                img_id = img_tuple[0]
-                img_url = img_tuple[1]
-                while True:
-                    try:
-                        tries += 1
-                        resource = urllib.request.urlopen(img_url, context=ssl._create_unverified_context())
-                        with open(image_path + '/' + f"{img_id}.jpg", 'wb') as image:
-                            image.write(resource.read())
-                        images_dowloaded += 1
-                        print(f"\r[+] WORKER {worker_id}: retrieved {images_dowloaded} of {url_len} images", end='')
-                        break
-                    except Exception as e:
-                        print(f"\n[-] Image error: {e}")
-                        if tries <= 5:
-                            print(f"[*] Sleeping {5}s...")
-                            time.sleep(5)
-                            continue
-                        else:
-                            break
+    def image_url(self, post, image_size_key):
+        '''
+        Return the url of the requested image size of a post.
+        If the size is not available fall back to the next available size.
 
-        self.image_path = os.path.join(self.project_path, f'images_{self.project_name}')
-        if not os.path.exists(self.image_path):
-            os.makedirs(self.image_path)
-            print(f"[*] Creating image folder 'images_{self.project_name}' in sub-directory '/{self.project_name}/' - done.")
-        else:
-            print(f"[*] Image folder 'images_{self.project_name}' exists already in the sub-directory '/{self.project_name}/'.")
+        :return: (url key, url) or (None, None) if the post contains no image url at all
+        '''
+        if image_size_key in post:
+            return image_size_key, post[image_size_key]
+        list_of_alternative_image_urls = ['url_l', 'url_o', 'url_s', 'url_q', 'url_sq', 'url_t']
+        for url_key in list_of_alternative_image_urls:
+            if url_key in post:
+                return url_key, post[url_key]
+        print(f'\n[!] Error while fetching size specific img url: no image url for post {post.get("id")}')
+        return None, None
 
-        # dict that matches image_size to dictionary key as it is in the Flickr API response
-        image_size_dict = {'small': 'url_s',
-                           'medium': 'url_m',
-                           'large': 'url_l',
-                           'original': 'url_o'}
-        image_size_key = image_size_dict[image_size]
-        # add a empty data chunk for each worker
-        data_chunk_list = [[] for worker in list(range(WORKERS))]
+    def get_images(self, results_list, image_size='medium', WORKERS=None, max_workers=None, engine=None):
+        '''
+        Download the images of all posts in results_list into the image folder of the project.
+
+        :return: future of the download if it runs on the download executor, else None
+        '''
+        image_size_key = FlickrQuerier.image_size_dict[image_size]
 
         processed_ids_set = set()
-        worker_index = 0
+        tasks = []
         for results in results_list:
-            for index_1, page in enumerate(results):
+            for page in results:
                 for post in results[page]['photos']['photo']:
                     img_id = post['id']
                     if img_id in processed_ids_set:
                         continue
-                    else:
-                        processed_ids_set.add(img_id)
-                        try:
-                            img_url = post[image_size_key]
-                        except:
-                            list_of_alternative_image_urls = ['url_l', 'url_o', 'url_s', 'url_q', 'url_sq', 'url_t']
-                            for url_key in list_of_alternative_image_urls:
-                                try:
-                                    img_url = post[url_key]
-                                    break
-                                except:
-                                    continue
-                                print(f'[!] Error while fetching size specific img url: {e}')
-
-                        data_tuple = (img_id, img_url)
-                        if worker_index >= WORKERS:
-                            worker_index = 0
-                        data_chunk_list[worker_index].append(data_tuple)
-                        worker_index += 1
-        # add worker_id and image_path to each data chunk
-        data_packages = []
-        for worker_id, data_chunk in enumerate(data_chunk_list, 1):
-            data_package = [worker_id, self.image_path, data_chunk]
-            data_packages.append(data_package)
-        # spawn workers with data_package
+                    processed_ids_set.add(img_id)
+                    url_key, img_url = self.image_url(post, image_size_key)
+                    if img_url is not None:
+                        tasks.append((img_id, img_url, url_key))
+        self.metrics.count('images_queued_total', len(tasks))
+        return self.download_tasks(tasks, len(tasks), WORKERS=WORKERS, max_workers=max_workers, engine=engine)
+
+    def download_tasks(self, tasks, tasks_total, WORKERS=None, max_workers=None, engine=None, after=None):
+        '''
+        Download the tasks right away or, if a download executor is set, submit them to it.
+
+        :param after: optional function called once the downloads are done (e.g. to remove a task file)
+        :return: future of the download if it runs on the download executor, else None
+        '''
+        if self.download_executor is not None:
+            self.download_future = self.download_executor.submit(self.run_download_tasks, tasks, tasks_total, WORKERS, max_workers, engine, after)
+            return self.download_future
+        self.run_download_tasks(tasks, tasks_total, WORKERS, max_workers, engine, after)
+        return None
+
+    def run_download_tasks(self, tasks, tasks_total, WORKERS=None, max_workers=None, engine=None, after=None):
+        '''
+        Download (img_id, img_url, size_key) tasks into the image folder of the project.
+        The downloads are pulled from a shared queue by WORKERS threads. If max_workers is larger than WORKERS,
+        workers are added while the measured throughput still increases.
+        With engine 'asyncio' (requires aiohttp) the downloads run on an event loop with thousands of
+        concurrent connections instead.
+        Images recorded as complete in the download manifest of the image folder are skipped,
+        partial downloads are resumed.
+
+        :param tasks: list or iterable of tasks (e.g. read from the task file of a MetadataStream)
+        :param tasks_total: amount of tasks
+        '''
+        if WORKERS is None:
+            WORKERS = self.download_workers
+        if max_workers is None:
+            max_workers = self.max_download_workers
+        self.image_path = os.path.join(self.project_path, f'images_{self.project_name}')
+        if not os.path.exists(self.image_path):
+            os.makedirs(self.image_path)
+            print(f"[*] Creating image folder 'images_{self.project_name}' in sub-directory '/{self.project_name}/' - done.")
+        else:
+            print(f"[*] Image folder 'images_{self.project_name}' exists already in the sub-directory '/{self.project_name}/'.")
+
+        # skip images which were completely downloaded by an earlier run
+        manifest = DownloadManifest(os.path.join(self.image_path, 'manifest.sqlite'), verify_checksums=self.verify_checksums)
+        tasks = manifest.pending_tasks(tasks, self.image_path)
         start = time.time()
-        # download_urls(data_packages[0])
-        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
-            # map waits in itself for all workers to finish
-            executor.map(download_urls, data_packages)
+        if engine is None:
+            engine = self.download_engine
+        if engine == 'asyncio' and not AsyncDownloader.available():
+            print("[!] aiohttp is not installed. Falling back to the thread pool download engine...")
+            engine = 'threads'
+        if engine == 'asyncio':
+            # thousands of concurrent connections with a limit per flickr static host
+            download_engine = AsyncDownloader(manifest=manifest)
+            download_engine.run(tasks, self.image_path, tasks_total)
+        else:
+            # spawn workers pulling from the shared download queue
+            # keep-alive connections are pooled per host and shared by all workers
+            with PooledDownloader(pool_size=max(WORKERS, max_workers or 0)) as downloader:
+                download_engine = DownloadQueue(downloader, workers=WORKERS, max_workers=max_workers, manifest=manifest)
+                download_engine.run(tasks, self.image_path, tasks_total)
+        manifest.close()
         end = time.time()
+        self.metrics.count('images_skipped_total', manifest.skipped)
+        self.metrics.observe('download_run_seconds', end - start, engine=engine)
+        if manifest.skipped:
+            print(f"\n[*] {manifest.skipped} images were already downloaded and skipped.")
+        if download_engine.failed:
+            print(f'\n[-] {len(download_engine.failed)} images could not be downloaded.')
         print(f'\n[*] downloaded images in: {round((end - start) / 60, 2)} min')
+        if after is not None:
+            after()
 
-    def write_info(self, results_list):
-        csv_separator = ';'  #';' #~&~#
-        tag_connector = '+'
-
-        def remove_non_ascii(s):
-            return "".join(i for i in s if ord(i) < 126 and ord(i) > 31)
-
-        def create_header(data_dict):
-            header_string = f'photo_id{csv_separator}'
-            for tracker, element in enumerate(data_dict.keys(), 1):
-                if tracker < len(data_dict.keys()):
-                    header_string = header_string + str(element) + csv_separator
-                elif tracker == len(data_dict.keys()):
-                    header_string = header_string + str(element)
-            return header_string
-
-        def create_line(id, data_dict):
-            line = f'{id}{csv_separator}'
-            tracker = 1
-            for key, value in data_dict.items():
-                if tracker < len(data_dict.keys()):
-                    line = line + str(value) + csv_separator
-                elif tracker == len(data_dict.keys()):
-                    line = line + str(value)
-                tracker += 1
-            return line
-
-        self.csv_output_path = self.dir_path + '/{}/metadata_{}_{:%Y_%m_%d}.csv'.format(self.project_name, self.area_name, datetime.datetime.now())
+    def output_path(self):
+        if self.output_format == 'sqlite':
+            # one database per project, the posts of all areas and runs are upserted into it
+            return os.path.join(self.project_path, f'metadata_{self.project_name}.sqlite')
+        extension = OUTPUT_FORMATS[self.output_format][0]
+        if self.delta_signature is not None:
+            return os.path.join(self.project_path, f'metadata_{self.area_name}_{self.delta_signature}{extension}')
+        return self.dir_path + '/{}/metadata_{}_{:%Y_%m_%d}{}'.format(self.project_name, self.area_name, datetime.datetime.now(), extension)
 
-        processed_ids_set = set()
-        with open(self.csv_output_path, 'w', encoding='utf-8') as f:
-                index = 0
-                for results in results_list:
-                    for page in results:
-                        for post in results[page]['photos']['photo']:
-                            index += 1
-                            post_id = post['id']
-                            # check if this post_id was already added to the output CSV
-                            if post_id in processed_ids_set:
-                                continue
-                            else:
-                                processed_ids_set.add(post_id)
-                                '''
-                                define which info fields should be fetched.
-                                ERASE ALL STRINGS OF CSV SEPERATOR! 
-                                '''
-                                # extract tags into an string separated by '+'!
-                                try:
-                                    tag_string = tag_connector.join(post['tags'].replace(csv_separator, '').replace(tag_connector, '').split(' '))
-                                except Exception as e:
-                                    # print(f'\r[-] Tag parsing error: {e} ', end='')
-                                    tag_string = ''
-                                try:
-                                    machine_tag_string = tag_connector.join(post['machine_tags'].replace(csv_separator, '').replace(tag_connector, '').split(' '))
-                                except Exception as e:
-                                    # print(f'\r[-] Tag parsing error: {e} ', end='')
-                                    machine_tag_string = ''
-                                '''
-                                text clean up
-                                of title and description
-                                - remove linebreaks etc.
-                                '''
-                                try:
-                                    description = remove_non_ascii(post['description']['_content'].replace(csv_separator, ''))
-                                except Exception as e:
-                                    # print(f'\r[-] Description parsing error: {e} ', end='')
-                                    description = ''
-                                try:
-                                    title = remove_non_ascii(post['title'].replace(csv_separator, ''))
-                                except Exception as e:
-                                    # print(f'\r[-] Title parsing error: {e} ', end='')
-                                    title = ''
-                                try:
-                                    user_nsid = post['owner']
-                                except Exception as e:
-                                    # print(f'\r[-] User_nsid parsing error: {e} ', end='')
-                                    user_nsid = ''
-                                try:
-                                    date_uploaded = post['dateupload'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Date_uploaded parsing error: {e} ', end='')
-                                    date_uploaded = ''
-                                try:
-                                    date_taken = post['datetaken'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Date_taken parsing error: {e} ', end='')
-                                    date_taken = ''
-                                try:
-                                    views = post['views'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Views parsing error: {e} ', end='')
-                                    views = ''
-                                try:
-                                    license = post['license'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Views parsing error: {e} ', end='')
-                                    license = ''
-                                try:
-                                    img_url_s = post['url_s'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Page_URL parsing error: {e} ', end='')
-                                    img_url_s = ''
-                                try:
-                                    img_url_m = post['url_m'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Page_URL parsing error: {e} ', end='')
-                                    img_url_m = ''
-                                try:
-                                    img_url_l = post['url_l'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Page_URL parsing error: {e} ', end='')
-                                    img_url_l = ''
-                                try:
-                                    img_url_o = post['url_o'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Page_URL parsing error: {e} ', end='')
-                                    img_url_o = ''
-                                try:
-                                    lat = post['latitude'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Latitude parsing error: {e} ', end='')
-                                    lat = 99999
-                                try:
-                                    lng = post['longitude'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Longitude parsing error: {e} ', end='')
-                                    lng = 99999
-                                try:
-                                    woeid = post['woeid'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Longitude parsing error: {e} ', end='')
-                                    woeid = 99999
-                                try:
-                                    place_id = post['place_id'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Longitude parsing error: {e} ', end='')
-                                    place_id = 99999
-                                try:
-                                    accuracy = post['accuracy'].replace(csv_separator, '')
-                                except Exception as e:
-                                    # print(f'\r[-] Accuracy parsing error: {e} ', end='')
-                                    accuracy = ''
-                                data = {
-                                    'user_nsid': user_nsid,
-                                    'title': title,
-                                    'description': description,
-                                    'date_uploaded': date_uploaded,
-                                    'date_taken': date_taken,
-                                    'views': views,
-                                    'user_tags':  tag_string,
-                                    'machine_tags': machine_tag_string,
-                                    'license': license,
-                                    #location information
-                                    'lat': lat,
-                                    'lng': lng,
-                                    'woeid': woeid,
-                                    'place_id': place_id,
-                                    'accuracy': accuracy,
-                                    # image urls in different sizes
-                                    'image_url_small': img_url_s,
-                                    'image_url_medium': img_url_m,
-                                    'image_url_large': img_url_l,
-                                    'image_url_original': img_url_o
-                                    }
-
-                                if index == 1:
-                                    header = create_header(data)
-                                    f.write(f"{header}\n")
-                                if index % 50 == 0 and index != 0:
-                                    print(f"\rLine {index} processed", end='')
-
-                                line = create_line(post_id, data)
-                                f.write(f"{line}\n")
-
-        print(f"\nCreated output file: {self.csv_output_path}")
\ No newline at end of file
+    def write_info(self, results_list):
+        self.csv_output_path = self.output_path()
+        # delta harvests merge the new posts into the existing output (posts already in it are skipped or upserted)
+        merge = self.delta_signature is not None and os.path.exists(self.csv_output_path)
+        with self.metrics.timer('write_seconds', sink=self.output_format):
+            writer = open_metadata_writer(self.csv_output_path, self.output_format, append=merge)
+            writer.write_results(results_list)
+            writer.close()
+        print(f"\nCreated output file: {self.csv_output_path}")
@@ -0,0 +1,94 @@
+import time
+import threading
+from collections import deque
+
+class TokenBucket:
+    '''
+    Token bucket that paces the calls to the Flickr API of one API key.
+
+    Flickr allows 3600 queries per hour per key (source: https://www.flickr.com/services/developer/api/).
+    Tokens are refilled continuously with calls_per_hour / 3600 tokens per second and saved up to the burst
+    capacity while no calls are made (e.g. while writing the output or downloading images). Saved tokens can
+    be spent at once. Additionally the calls of the last hour are tracked, so a burst never exceeds the
+    remaining budget of the hour.
+
+    The bucket is thread safe, all threads of the process share one bucket per API key (see get_rate_limiter).
+    '''
+    window = 3600
+
+    def __init__(self, calls_per_hour=3600, burst=None):
+        self.calls_per_hour = calls_per_hour
+        # by default the whole hourly budget may be spent in one burst
+        self.burst = burst if burst is not None else calls_per_hour
+        self.rate = calls_per_hour / TokenBucket.window
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        # timestamps of the calls within the last hour
+        self.call_log = deque()
+        self.lock = threading.Lock()
+
+    def configure(self, calls_per_hour=3600, burst=None):
+        '''
+        Change the limits of the bucket. The calls of the last hour are kept, saved up tokens above the new burst are dropped.
+        '''
+        with self.lock:
+            self.refill(time.monotonic())
+            self.calls_per_hour = calls_per_hour
+            self.burst = burst if burst is not None else calls_per_hour
+            self.rate = calls_per_hour / TokenBucket.window
+            self.tokens = min(self.tokens, float(self.burst))
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        while self.call_log and now - self.call_log[0] >= TokenBucket.window:
+            self.call_log.popleft()
+
+    def remaining(self):
+        '''
+        :return: amount of calls that can be made right now without waiting
+        '''
+        with self.lock:
+            self.refill(time.monotonic())
+            return int(min(self.tokens, self.calls_per_hour - len(self.call_log)))
+
+    def acquire(self):
+        '''
+        Block until a call is allowed and take one token.
+
+        :return: time waited in seconds
+        '''
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if self.tokens >= 1 and len(self.call_log) < self.calls_per_hour:
+                    self.tokens -= 1
+                    self.call_log.append(now)
+                    return waited
+                # time until the next token is available or the oldest call leaves the hourly window
+                wait_token = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+                wait_window = self.call_log[0] + TokenBucket.window - now if len(self.call_log) >= self.calls_per_hour else 0
+                to_wait = max(wait_token, wait_window, 0.01)
+            time.sleep(to_wait)
+            waited += to_wait
+
+
+# process wide registry with one bucket per api key
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(api_key, calls_per_hour=3600, burst=None):
+    '''
+    Return the bucket of the api key shared by all FlickrQuerier objects (and threads) of this process.
+    The bucket is created on the first request for the api key, changed calls_per_hour or burst of a later request
+    are applied to the existing bucket (its calls of the last hour still count).
+    '''
+    with _rate_limiters_lock:
+        if api_key not in _rate_limiters:
+            _rate_limiters[api_key] = TokenBucket(calls_per_hour=calls_per_hour, burst=burst)
+        bucket = _rate_limiters[api_key]
+    if bucket.calls_per_hour != calls_per_hour or bucket.burst != (burst if burst is not None else calls_per_hour):
+        bucket.configure(calls_per_hour=calls_per_hour, burst=burst)
+    return bucket
@@ -0,0 +1,180 @@
+import time
+import random
+import threading
+import requests
+from credential_pool import status_code
+from harvest_metrics import get_metrics
+
+# error classes
+PERMANENT = 'permanent'
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+
+# flickr api error codes worth retrying: 105 service currently unavailable, 106 write operation failed
+transient_api_codes = {105, 106}
+
+
+class FlickrAPIError(Exception):
+    '''
+    Error response (stat 'fail') of the Flickr API, e.g. code 100 invalid api key or 105 service currently unavailable
+    '''
+    def __init__(self, code, message):
+        super().__init__(f'Error: {code}: {message}')
+        self.code = code
+
+
+class RetryError(Exception):
+    '''
+    Raised by RetryPolicy.run once a call is given up: permanent error, all tries used or retry budget exhausted
+    '''
+    def __init__(self, error, error_class, tries):
+        super().__init__(f'{error} ({error_class}, given up after {tries} tries)')
+        self.error = error
+        self.error_class = error_class
+        self.tries = tries
+
+
+def classify_error(error):
+    '''
+    Classify an error of an api call or image download:
+        permanent: retrying does not help (4xx, e.g. 404 of a deleted image, bad url, invalid api key)
+        throttled: the server asks to slow down (429)
+        transient: network errors, timeouts and 5xx responses
+    '''
+    if isinstance(error, FlickrAPIError):
+        return TRANSIENT if error.code in transient_api_codes else PERMANENT
+    status = status_code(error)
+    if status is not None:
+        if status == 429:
+            return THROTTLED
+        if status in (408, 425) or status >= 500:
+            return TRANSIENT
+        if 400 <= status < 500:
+            return PERMANENT
+    if isinstance(error, (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema,
+                          requests.exceptions.InvalidURL, requests.exceptions.URLRequired)) or type(error).__name__ == 'InvalidURL':
+        return PERMANENT
+    return TRANSIENT
+
+
+class RetryBudget:
+    '''
+    Retries left for the whole run, shared by all threads using the policy. Once it is used up, failing calls are
+    given up right away instead of retrying every one of them (e.g. while the network is down).
+    '''
+    def __init__(self, retries=None):
+        # None: unlimited
+        self.retries = retries
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''
+        :return: True if a retry is left (and take it)
+        '''
+        with self.lock:
+            if self.retries is not None and self.used >= self.retries:
+                return False
+            self.used += 1
+            return True
+
+
+class RetryPolicy:
+    '''
+    Shared retry policy of the api calls ('search') or the image downloads ('images') of a run, see get_retry_policy.
+
+    Errors are classified by classify_error. Permanent errors are not retried. Throttled and transient errors are
+    retried with capped exponential backoff and jitter (the delay of try n is between half and the full
+    min(max_delay, base_delay * 2 ** (n - 1))), throttling with its own, longer delays. Every retry takes one retry
+    of the budget of the run.
+
+        max_tries: tries per call (None: until the budget is used up)
+        budget: retries of the whole run (None: unlimited)
+    '''
+    def __init__(self, max_tries=5, base_delay=2.0, max_delay=300.0, throttle_delay=60.0, max_throttle_delay=900.0, budget=None, name='search'):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttle_delay = throttle_delay
+        self.max_throttle_delay = max_throttle_delay
+        self.budget = RetryBudget(budget)
+        self.name = name
+        self.random = random.Random()
+
+    def delay(self, tries, error_class):
+        '''
+        :return: seconds to sleep before the next try after tries failed tries
+        '''
+        base, cap = (self.throttle_delay, self.max_throttle_delay) if error_class == THROTTLED else (self.base_delay, self.max_delay)
+        delay = min(cap, base * 2 ** (tries - 1))
+        return delay / 2 + self.random.uniform(0, delay / 2)
+
+    def decide(self, error, tries, max_tries=-1):
+        '''
+        Decide if a call is tried again after it failed tries times
+
+        :param max_tries: overrides the max_tries of the policy (-1: keep)
+        :return: error class and the seconds to sleep before the next try (None: give up)
+        '''
+        error_class = classify_error(error)
+        metrics = get_metrics()
+        metrics.count('errors_total', policy=self.name, error_class=error_class)
+        if max_tries == -1:
+            max_tries = self.max_tries
+        if error_class == PERMANENT or (max_tries is not None and tries >= max_tries):
+            return error_class, None
+        if not self.budget.take():
+            metrics.count('retry_budget_exhausted_total', policy=self.name)
+            return error_class, None
+        delay = self.delay(tries, error_class)
+        metrics.count('retries_total', policy=self.name, error_class=error_class)
+        metrics.observe('retry_sleep_seconds', delay, stage=self.name)
+        return error_class, delay
+
+    def run(self, func, *args, description='Call', max_tries=-1, **kwargs):
+        '''
+        Call func until it succeeds or is given up
+
+        :return: return value of func
+        :raise RetryError: if the call is given up
+        '''
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error_class, delay = self.decide(e, tries, max_tries)
+                print(f"\n[-] {description} error ({error_class}, try {tries}): {e}")
+                if delay is None:
+                    raise RetryError(e, error_class, tries) from e
+                print(f"[*] Sleeping {round(delay, 1)}s...")
+                time.sleep(delay)
+
+
+# default settings of the policies: api calls are paced by the rate limit and throttled keys are rotated by the
+# credential pool, so only few long retries; image downloads retry sooner and more often (6 tries as before)
+default_settings = {'search': {'max_tries': 5, 'base_delay': 2.0, 'max_delay': 300.0, 'throttle_delay': 60.0, 'max_throttle_delay': 900.0, 'budget': 1000},
+                    'images': {'max_tries': 6, 'base_delay': 1.0, 'max_delay': 60.0, 'throttle_delay': 10.0, 'max_throttle_delay': 300.0, 'budget': 10000}}
+
+# retry policies of the process by name ('search': api calls, 'images': image downloads)
+_retry_policies = {}
+_retry_policies_lock = threading.Lock()
+
+def get_retry_policy(name):
+    '''
+    Return the policy shared by all FlickrQuerier objects and downloaders (and threads) of this process.
+    A policy with the default settings is created on the first request, use configure_retry_policy to change it.
+    '''
+    with _retry_policies_lock:
+        if name not in _retry_policies:
+            _retry_policies[name] = RetryPolicy(name=name, **default_settings.get(name, {}))
+        return _retry_policies[name]
+
+def configure_retry_policy(name, **settings):
+    '''
+    (Re)create the policy of name with the given settings (the others are taken from default_settings) and a new retry budget
+    '''
+    with _retry_policies_lock:
+        _retry_policies[name] = RetryPolicy(name=name, **{**default_settings.get(name, {}), **settings})
+        return _retry_policies[name]
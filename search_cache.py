@@ -0,0 +1,114 @@
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+class SearchCache:
+    '''
+    Persistent on-disk cache for photos.search responses (SQLite file with zlib compressed JSON).
+
+    The cache key is built from all query parameters (bbox, text, tags, licenses, accuracy, upload date window,
+    page, per_page and extras), so the same window or page fetched by a crashed run or another project is served
+    from disk instead of the API.
+        - ttl: responses older than ttl seconds are treated as missing and fetched again
+        - max_bytes: if the cache grows larger, the least recently used responses are evicted
+        - cache_only: offline mode, the API is never called and missing responses are returned as empty pages
+
+    NOTE: queries without max_upload_date use the current time as upper limit, which changes with every run.
+    Set max_upload_date to get cache hits on re-runs.
+    '''
+    def __init__(self, cache_path, ttl=7 * 24 * 3600, max_bytes=2 * 1024 ** 3, cache_only=False):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cache_only = cache_only
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                       key TEXT PRIMARY KEY,
+                                       created REAL,
+                                       accessed REAL,
+                                       size INTEGER,
+                                       data BLOB)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.connection.commit()
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(params):
+        '''
+        :param params: all parameters of the photos.search call
+        :return: sha1 hex digest of the canonical json representation of the parameters
+        '''
+        canonical = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, params):
+        '''
+        :return: cached response (parsed json) or None if missing or expired
+        '''
+        key = SearchCache.make_key(params)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT created, data FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[0] > self.ttl and not self.cache_only):
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[1]).decode('utf-8'))
+
+    def put(self, params, response):
+        key = SearchCache.make_key(params)
+        data = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, now, now, len(data), data))
+            self.total_bytes += len(data)
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        '''
+        Delete the least recently used responses until the cache is below 90% of max_bytes
+        '''
+        target = self.max_bytes * 0.9
+        cursor = self.connection.execute('SELECT key, size FROM responses ORDER BY accessed')
+        to_delete = []
+        for key, size in cursor:
+            if self.total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+# process wide registry with one cache per cache file and settings
+_search_caches = {}
+_search_caches_lock = threading.Lock()
+
+def get_search_cache(cache_path, ttl=7 * 24 * 3600, max_bytes=2 * 1024 ** 3, cache_only=False):
+    '''
+    Return the cache of cache_path shared by all FlickrQuerier objects (and threads) of this process which use the
+    same settings. A FlickrFrame with other settings (e.g. an online run after an offline run with cache_only)
+    gets its own cache object of the same file.
+    '''
+    key = (cache_path, ttl, max_bytes, cache_only)
+    with _search_caches_lock:
+        if key not in _search_caches:
+            _search_caches[key] = SearchCache(cache_path, ttl=ttl, max_bytes=max_bytes, cache_only=cache_only)
+        return _search_caches[key]
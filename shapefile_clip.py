@@ -1,13 +1,54 @@
+import io
 import os
 import re
+import shutil
+import concurrent.futures
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+import shapely
+# the vectorised clipping (prepared parts, STR-tree queries of point arrays, intersects_xy) needs shapely 2.0
+if int(shapely.__version__.split('.')[0]) < 2:
+    raise ImportError(f"shapefile_clip.py requires shapely >= 2.0 (installed: {shapely.__version__}). Upgrade it with 'pip install -U shapely'.")
+# pyarrow is only needed to clip parquet files in chunks (row groups)
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+class RegionMask:
+    '''
+    Clipping mask of a region, built once per shapefile in load_shps and reused for every file of the region.
+
+    The union of all shapes is split into its parts (e.g. the buffered polygons of a multi-part region).
+    Every part is a prepared geometry and the parts are indexed by an STR-tree, so a point is only tested
+    against the parts whose envelope contains it. The tests run vectorised on coordinate arrays (shapely >= 2.0).
+    '''
+    def __init__(self, shape_gdf):
+        self.shape_gdf = shape_gdf
+        self.union = shapely.union_all(shape_gdf.geometry.values)
+        self.parts = shapely.get_parts(self.union)
+        shapely.prepare(self.parts)
+        self.tree = shapely.STRtree(self.parts)
+
+    def contains_xy(self, x, y):
+        '''
+        :return: boolean array, True for the coordinates inside the mask or on its boundary (NaN coordinates are outside)
+        '''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(self.parts) == 1:
+            return shapely.intersects_xy(self.parts[0], x, y)
+        inside = np.zeros(len(x), dtype=bool)
+        points, parts = self.tree.query(shapely.points(x, y))
+        hit = shapely.intersects_xy(self.parts[parts], x[points], y[points])
+        inside[points[hit]] = True
+        return inside
 
 def load_shps():
     '''
     load the shapefiles into a dictionary with the key being the corresponding region name
-    :return: shapes_bin
+    :return: shapes_bin (region name: RegionMask)
     '''
     print('Loading shapefiles...')
     shapes_bin = {}
@@ -21,37 +62,151 @@ def load_shps():
             full_path = os.path.join(shapefile_path, shape)
             shape_gdf = gpd.read_file(full_path)
             # print(shape_gdf.head())
-            #check if the shapefile is in the defined common crs
-            if shape_gdf.crs['init'] == common_crs:
-                shapes_bin[region_name] = shape_gdf
-            #otherwise convert to common crs
-            else:
+            #check if the shapefile is in the defined common crs, otherwise convert to common crs
+            if shape_gdf.crs != common_crs:
                 print(f'crs {shape_gdf.crs} is different from common crs {common_crs}')
-                shape_gdf['geometry'] = shape_gdf['geometry'].to_crs(epsg=common_crs)
+                shape_gdf = shape_gdf.to_crs(common_crs)
+            shapes_bin[region_name] = RegionMask(shape_gdf)
     return shapes_bin
 
 def read_csv_to_gdf(file_path):
-    df = pd.read_csv(file_path, delimiter=";") #, usecols=['lat', 'lng']
+    if file_path.endswith('.parquet'):
+        # typed output of FlickrFrame with output_format='parquet'
+        df = pd.read_parquet(file_path).dropna(subset=['lat', 'lng'])
+    else:
+        df = pd.read_csv(file_path, delimiter=";") #, usecols=['lat', 'lng']
     # print(df.head)
-    gdf = gpd.GeoDataFrame(df, crs={'init': 'epsg:4326'}, geometry=[Point(xy) for xy in zip(df.lng, df.lat)])
+    gdf = gpd.GeoDataFrame(df, crs='epsg:4326', geometry=gpd.points_from_xy(df.lng, df.lat))
+    return region_of(file_path), gdf
+
+def region_of(file_path):
     '''
     finde the region name inside the file_path of fullowing structure: 'metadata_REGION_data'
     '''
     region_pattern = r'metadata_([^_]+)_'
-    region_name = re.search(region_pattern, file_path).group(1)
-    return region_name, gdf
+    return re.search(region_pattern, file_path).group(1)
 
 def clip_shp(gdf, shp_):
     '''
 
     :param gdf: input data that will be clipped
-    :param shp_: shapefile used as mask for clipping
+    :param shp_: RegionMask of the shapefile used as mask for clipping
     :return: clipped dataframe
     '''
-    mask = shp_.geometry.unary_union
-    gdf_clipped = gdf[gdf.geometry.intersects(mask)]
+    gdf_clipped = gdf[shp_.contains_xy(gdf.geometry.x, gdf.geometry.y)]
     return gdf_clipped
 
+def clip_frame(df, shp_):
+    '''
+    Clip a dataframe by its lng/lat columns without building point geometries
+
+    :param shp_: RegionMask of the shapefile used as mask for clipping
+    :return: clipped dataframe
+    '''
+    lng = pd.to_numeric(df.lng, errors='coerce')
+    lat = pd.to_numeric(df.lat, errors='coerce')
+    return df[shp_.contains_xy(lng, lat)]
+
+def file_chunks(file_path, chunk_bytes):
+    '''
+    Split a file into chunks that are read and clipped independently.
+    csv: byte ranges ending at line breaks (the metadata CSV has one post per line, line breaks are removed
+    from the text fields). parquet: row groups.
+
+    :return: list of chunks
+    '''
+    if file_path.endswith('.parquet'):
+        return list(range(pq.ParquetFile(file_path).num_row_groups))
+    size = os.path.getsize(file_path)
+    chunks = []
+    with open(file_path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def init_clip_worker(shapes_path, crs):
+    '''
+    Load the region masks once per worker process of clip_files
+    '''
+    global shapefile_path, common_crs, worker_shapes
+    shapefile_path = shapes_path
+    common_crs = crs
+    worker_shapes = load_shps()
+
+def clip_chunk(file_path, chunk, part_path, header):
+    '''
+    Clip a chunk of a file in a worker process and write the clipped rows to a part file.
+    Only the coordinates of a csv chunk are parsed, the lines of the posts inside the mask are written unchanged.
+
+    :return: amount of rows read and written
+    '''
+    shp_ = worker_shapes[region_of(file_path)]
+    if file_path.endswith('.parquet'):
+        df = pq.ParquetFile(file_path).read_row_group(chunk).to_pandas()
+        df_clipped = clip_frame(df, shp_)
+        df_clipped.to_csv(part_path, sep=';', encoding='utf-8', index=False, header=header)
+        return len(df), len(df_clipped)
+    start, end = chunk
+    with open(file_path, 'rb') as f:
+        header_line = f.readline()
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.splitlines(keepends=True)
+    coordinates = pd.read_csv(io.BytesIO(header_line + data), delimiter=';', usecols=['lat', 'lng'], skip_blank_lines=False)
+    if len(coordinates) != len(lines):
+        raise ValueError(f'{file_path} has line breaks inside fields, clip it with clip_workers = 1')
+    inside = clip_frame(coordinates, shp_).index
+    with open(part_path, 'wb') as part:
+        if header:
+            part.write(header_line)
+        part.writelines(lines[i] for i in inside)
+    return len(lines), len(inside)
+
+def clip_files(files, shapes_path, crs, workers=None, chunk_bytes=64 * 1024 ** 2):
+    '''
+    Clip many (large) files with a process pool. Every file is split into chunks (see file_chunks) and the chunks
+    of all files are spread over the workers, each worker loads the region masks once. A worker only holds the
+    chunk it clips, its rows are written to a part file and the parts are appended to the output file in order.
+
+    :param files: list of (input file, output csv)
+    :param workers: amount of worker processes (default: amount of cores)
+    :param chunk_bytes: size of the csv chunks
+    '''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_clip_worker, initargs=(shapes_path, crs)) as executor:
+        submitted = []
+        for file_path, save_path in files:
+            parts = []
+            for index, chunk in enumerate(file_chunks(file_path, chunk_bytes)):
+                part_path = f'{save_path}.part{index}'
+                parts.append((part_path, executor.submit(clip_chunk, file_path, chunk, part_path, index == 0)))
+            submitted.append((file_path, save_path, parts))
+        for file_path, save_path, parts in submitted:
+            rows_read = 0
+            rows_written = 0
+            try:
+                with open(save_path, 'wb') as output:
+                    for part_path, future in parts:
+                        read, written = future.result()
+                        rows_read += read
+                        rows_written += written
+                        with open(part_path, 'rb') as part:
+                            shutil.copyfileobj(part, output)
+                        os.remove(part_path)
+            except Exception as e:
+                print(f"[-] Clipping {file_path} failed: {e!r}")
+                for part_path, future in parts:
+                    concurrent.futures.wait([future])
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                continue
+            print(f"Saving clipped csv for region: {region_of(file_path)} ({rows_written} of {rows_read} rows)")
+
 if __name__ == '__main__':
     '''
     Purpose: Clip the bounding box query returns from the FlickrAPI and the YFCC100M database
@@ -63,37 +218,49 @@ if __name__ == '__main__':
     common_crs = 'epsg:4326'
     workspace = "C:/Users/mhartman/PycharmProjects/FlickrFrame"
     shapefile_path = "C:/Users/mhartman/PycharmProjects/Ross_query/area_shapefile/split_shapefiles_by_attribute/shps_500m_buffer"
-    # loads all needed shapefiles at once
-    shapes_bin = load_shps()
-    print("-" * 30)
-    #create two new directories for the clipped FlickrAPI and YFCC100M data
-    try:
-        os.mkdir(os.path.join(workspace, 'flickrAPI_clipped'))
-    except FileExistsError:
-        print("Outputfolder for clipped Flickr data exists already.\n Continue.")
-    try:
-        os.mkdir(os.path.join(workspace, 'yfcc100m_clipped'))
-    except FileExistsError:
-        print("Outputfolder for clipped database data exists already.\n Continue.")
-    flickrAPI_clipped = os.path.join(workspace, 'flickrAPI_clipped')
-    yfcc100m_clipped = os.path.join(workspace, 'yfcc100m_clipped')
-    # test_path = "C:/Users/mhartman/PycharmProjects/Ross_query/data/from_YFCC100M_db/metadata_CH_FM_2019_10_24.csv"
-
-    #walk through the directories
-    for (root, dirs, files) in os.walk(workspace, topdown=True):
-        #iterating over both FlickrAPI and CC boundingbox folders
-        if re.search(r'from_FLICKR_API', root): #re.search(r'from_FLICKR_API', root) or
-            for file in files:
-                region, gdf = read_csv_to_gdf(os.path.join(root, file))
-                gdf_clipped = clip_shp(gdf, shapes_bin[region])
-                #convert back into pandas dataframe and dropping the geometry column again
-                df_clipped = pd.DataFrame(gdf_clipped.drop(columns='geometry'))
-                #prepare the saving of clipped dataframe
-                file_name = file[:-4] + '_cropped.csv'
-                if re.search(r'from_FLICKR_API', root):
-                    save_path = os.path.join(workspace, flickrAPI_clipped, file_name)
-                elif re.search(r'from_YFCC100M_db', root):
-                    save_path = os.path.join(workspace, yfcc100m_clipped, file_name)
-                df_clipped.to_csv(save_path, sep=';', encoding='utf-8', index=False)
-                print(f"Saving clipped csv for region: {region}")
-            print(f'--------------------finished: {root}----------------------------------')
\ No newline at end of file
+    # clip the files in chunks with a pool of worker processes (None: amount of cores, 1: one file after another in memory)
+    clip_workers = None
+    if clip_workers != 1:
+        flickrAPI_clipped = os.path.join(workspace, 'flickrAPI_clipped')
+        os.makedirs(flickrAPI_clipped, exist_ok=True)
+        files = []
+        for (root, dirs, files_in_root) in os.walk(workspace, topdown=True):
+            if re.search(r'from_FLICKR_API', root):
+                for file in files_in_root:
+                    files.append((os.path.join(root, file), os.path.join(flickrAPI_clipped, os.path.splitext(file)[0] + '_cropped.csv')))
+        clip_files(files, shapefile_path, common_crs, workers=clip_workers)
+    else:
+        # loads all needed shapefiles at once
+        shapes_bin = load_shps()
+        print("-" * 30)
+        #create two new directories for the clipped FlickrAPI and YFCC100M data
+        try:
+            os.mkdir(os.path.join(workspace, 'flickrAPI_clipped'))
+        except FileExistsError:
+            print("Outputfolder for clipped Flickr data exists already.\n Continue.")
+        try:
+            os.mkdir(os.path.join(workspace, 'yfcc100m_clipped'))
+        except FileExistsError:
+            print("Outputfolder for clipped database data exists already.\n Continue.")
+        flickrAPI_clipped = os.path.join(workspace, 'flickrAPI_clipped')
+        yfcc100m_clipped = os.path.join(workspace, 'yfcc100m_clipped')
+        # test_path = "C:/Users/mhartman/PycharmProjects/Ross_query/data/from_YFCC100M_db/metadata_CH_FM_2019_10_24.csv"
+
+        #walk through the directories
+        for (root, dirs, files) in os.walk(workspace, topdown=True):
+            #iterating over both FlickrAPI and CC boundingbox folders
+            if re.search(r'from_FLICKR_API', root): #re.search(r'from_FLICKR_API', root) or
+                for file in files:
+                    region, gdf = read_csv_to_gdf(os.path.join(root, file))
+                    gdf_clipped = clip_shp(gdf, shapes_bin[region])
+                    #convert back into pandas dataframe and dropping the geometry column again
+                    df_clipped = pd.DataFrame(gdf_clipped.drop(columns='geometry'))
+                    #prepare the saving of clipped dataframe
+                    file_name = os.path.splitext(file)[0] + '_cropped.csv'
+                    if re.search(r'from_FLICKR_API', root):
+                        save_path = os.path.join(workspace, flickrAPI_clipped, file_name)
+                    elif re.search(r'from_YFCC100M_db', root):
+                        save_path = os.path.join(workspace, yfcc100m_clipped, file_name)
+                    df_clipped.to_csv(save_path, sep=';', encoding='utf-8', index=False)
+                    print(f"Saving clipped csv for region: {region}")
+                print(f'--------------------finished: {root}----------------------------------')
\ No newline at end of file